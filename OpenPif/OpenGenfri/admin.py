@@ -1,14 +1,29 @@
 from django.contrib import admin
+from django.db import transaction
 from models import Item, Category, Bill, BillItem, BillItemExtra, Location
+from dbmanager import undo_bills
+from routers import reporting
+import catalog
 
 def make_enabled(modeladmin, request, queryset):
     queryset.update(enabled=True)
+    catalog.items_changed()
+    catalog.catalog_changed()
 
 def make_disabled(modeladmin, request, queryset):
     queryset.update(enabled=False)
+    catalog.items_changed()
+    catalog.catalog_changed()
+
+def make_undone(modeladmin, request, queryset):
+    with transaction.atomic():
+        undone = undo_bills(list(queryset.values_list('id', flat=True)),
+                            request.user)
+    modeladmin.message_user(request, '{} scontrini annullati'.format(undone))
 
 make_enabled.short_description = "Abilita items selezionati"
 make_disabled.short_description = "Disabilita items selezionati"
+make_undone.short_description = "Annulla scontrini selezionati"
 
 class ItemAdmin(admin.ModelAdmin):
     fieldsets = [
@@ -28,9 +43,10 @@ class ItemAdmin(admin.ModelAdmin):
 
 class CategoryAdmin(admin.ModelAdmin):
     fieldsets = [
-        (None, {'fields': ['name', 'priority', 'enabled', 'printable']}),
+        (None, {'fields': ['name', 'priority', 'enabled', 'printable',
+                           'printer']}),
     ]
-    list_display = ('name', 'priority', 'enabled', 'printable')
+    list_display = ('name', 'priority', 'enabled', 'printable', 'printer')
     search_fields = ['name']
     list_filter = ['enabled']
     actions = [make_enabled, make_disabled]
@@ -46,15 +62,26 @@ class LocationAdmin(admin.ModelAdmin):
     actions = [make_enabled, make_disabled]
 
 
-class BillItemInline(admin.StackedInline):
+class ReadOnlyInline(object):
+    """An inline of the lines of the bills, which are summed in the sales
+    rollups: they can't be added, changed or deleted."""
+    extra = 0
+    can_delete = False
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+class BillItemInline(ReadOnlyInline, admin.StackedInline):
     model = BillItem
-    extra = 1
     show_change_link = True
 
 
-class BillItemExtraInline(admin.TabularInline):
+class BillItemExtraInline(ReadOnlyInline, admin.TabularInline):
     model = BillItemExtra
-    extra = 1
 
 
 class BillItemAdmin(admin.ModelAdmin):
@@ -62,20 +89,48 @@ class BillItemAdmin(admin.ModelAdmin):
         (None, {'fields': ['bill', 'item', 'quantity', 'item_price',
                            'category', 'note']}),
     ]
+    # Summed in the sales rollups: only the note can change
+    readonly_fields = ('bill', 'item', 'quantity', 'item_price', 'category')
     inlines = [BillItemExtraInline]
     list_display = ('item', 'quantity', 'bill')
     list_filter = ['bill']
 
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 
 class BillAdmin(admin.ModelAdmin):
     fieldsets = [
         (None, {'fields': ['customer_name', 'customer_id', 'total', 'server',
             'deleted_by']})
     ]
+    # Summed in the sales rollups: the bills are undone by make_undone,
+    # which updates them, and never deleted
+    readonly_fields = ('total', 'server', 'deleted_by')
     inlines = [BillItemInline]
     list_display = ('customer_name', 'customer_id', 'id', 'server', 'date',
             'total', 'is_committed')
     search_fields = ['customer_name', 'customer_id', 'id', 'date', 'server']
+    actions = [make_undone]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        # The actions write, and must read what they change from the default
+        # database
+        if request.method == 'POST':
+            return super(BillAdmin, self).changelist_view(request,
+                                                          extra_context)
+        with reporting:
+            return super(BillAdmin, self).changelist_view(request,
+                                                          extra_context)
 
 
 admin.site.register(Item, ItemAdmin)
@@ -5,3 +5,6 @@ from django.apps import AppConfig
 
 class OpenGenfriConfig(AppConfig):
     name = 'OpenGenfri'
+
+    def ready(self):
+        from . import signals  # noqa
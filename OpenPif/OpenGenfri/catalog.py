@@ -0,0 +1,211 @@
+"""
+Versioning and caching of the catalog shown by the tills.
+
+Every change to the quantity, price or availability of the items bumps a
+monotonic stock version, kept in the default cache together with the ids of
+the items changed by each version. Tills send back the last version they have
+seen, so that they can be told which items changed since then, or that
+nothing did, without querying the database.
+
+Changes to the items and categories themselves also bump a catalog version,
+which tells each process when to rebuild its in memory snapshot of the
+categories, items and extras shown by the order page. The catalog version is
+kept in the database, bumped in the transaction of the edit, and read again
+by each process at most every CATALOG_VERSION_TTL seconds.
+
+The cache must be shared by all the server processes (e.g. memcached) when
+more than one of them is running, otherwise each of them has its own stock
+versions: unless settings.SHARED_CACHE says it is, the tills always get all
+the items.
+"""
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from models import Item, Category, CatalogVersion
+import ledger
+
+
+VERSION_KEY = 'openpif:stock-version'
+CHANGES_KEY = 'openpif:stock-changes:{}'
+# How many versions behind a till can be before it gets a full snapshot
+MAX_DELTA = 200
+CHANGES_TIMEOUT = 60 * 60
+# Seconds after which a process reads the catalog version again
+CATALOG_VERSION_TTL = 1
+
+
+_snapshot = (None, None)
+# The catalog version last read from the database, and when
+_catalog_version = (None, 0)
+_snapshot_lock = threading.Lock()
+
+
+def version():
+    """Returns the current stock version."""
+    return _get_version(VERSION_KEY)
+
+
+def catalog_version():
+    """Returns the current catalog version, as read from the database at most
+    CATALOG_VERSION_TTL seconds ago."""
+    global _catalog_version
+    current, read = _catalog_version
+    if current is None or time.time() - read >= CATALOG_VERSION_TTL:
+        current = CatalogVersion.objects.filter(pk=1).values_list(
+            'version', flat=True).first() or 0
+        _catalog_version = (current, time.time())
+    return current
+
+
+def items_changed(item_ids=None):
+    """Records that the items with the given ids have changed, or that the
+    whole catalog might have if ``item_ids`` is None. The version is bumped
+    when the current transaction commits, so that tills never see a version
+    before the changes it stands for can be read."""
+    if item_ids is not None:
+        item_ids = list(item_ids)
+    transaction.on_commit(lambda: _bump(item_ids))
+
+
+def catalog_changed():
+    """Records that the items or the categories have been edited, bumping the
+    catalog version in the current transaction: the catalog snapshots of all
+    the processes are invalidated when it commits."""
+    global _catalog_version
+    if not CatalogVersion.objects.filter(pk=1).update(
+            version=F('version') + 1):
+        CatalogVersion.objects.create(pk=1, version=int(time.time() * 1000))
+    transaction.on_commit(_forget_catalog_version)
+
+
+def snapshot():
+    """Returns the catalog shown by the order page as a dictionary of the form:
+
+        {"categories": [enabled categories by priority],
+         "items": [enabled items of enabled categories, but extras, by
+                   category, priority and name, each with the list of the
+                   extras of its category as ``extras``],
+         "extras": [all the extras],
+         "enabled_items": [all the enabled items of enabled categories],
+         "catalog_version": the catalog version the snapshot was built for}
+
+    The snapshot is built once per catalog version, with two queries, and
+    then shared by all the requests, which must not modify it."""
+    global _snapshot
+    current = catalog_version()
+    snapshot_version, catalog = _snapshot
+    if snapshot_version != current:
+        with _snapshot_lock:
+            snapshot_version, catalog = _snapshot
+            if snapshot_version != current:
+                catalog = _build_snapshot()
+                catalog['catalog_version'] = current
+                _snapshot = (current, catalog)
+    return catalog
+
+
+def changes_since(since, current):
+    """Returns the set of ids of the items changed after version ``since`` up
+    to version ``current``, or None if the till needs a full snapshot."""
+    if since is None or not current - MAX_DELTA <= since < current:
+        return None
+    keys = [CHANGES_KEY.format(v) for v in range(since + 1, current + 1)]
+    changes = cache.get_many(keys)
+    changed = set()
+    for key in keys:
+        if changes.get(key) is None:
+            return None
+        changed.update(changes[key])
+    return changed
+
+
+def updates(since):
+    """Returns the stock updates for a till that has seen version ``since``
+    (None if it has seen none), as a dictionary of the form:
+
+        { "version": version,
+          "full": true if every item is listed, otherwise only the changed ones,
+          "items": {"item1": (quantity, price), ...},
+          "removed": ["item2", ...]
+        }
+
+    or None, without querying the database, if nothing has changed."""
+    current = version()
+    if not settings.SHARED_CACHE:
+        # The version of this process knows nothing of the changes made by
+        # the others
+        since = None
+    if since == current:
+        return None
+    changed = changes_since(since, current)
+    if changed is None:
+        items = Item.objects.all()
+    else:
+        items = Item.objects.filter(pk__in=changed)
+    output = {'version': current,
+              'full': changed is None,
+              'items': {},
+              'removed': []
+              }
+    items = list(items.select_related('category'))
+    quantities = ledger.quantities({item.id: item.quantity for item in items})
+    for item in items:
+        if item.enabled and item.category and item.category.enabled:
+            output['items'][item.name] = (quantities[item.id], item.price)
+        else:
+            output['removed'].append(item.name)
+    return output
+
+
+def _forget_catalog_version():
+    global _catalog_version
+    _catalog_version = (None, 0)
+
+
+def _build_snapshot():
+    categories = list(Category.objects.filter(enabled=True).order_by(
+        'priority'))
+    enabled_ids = set(category.id for category in categories)
+    all_items = list(Item.objects.select_related('category').order_by('id'))
+    extras = [item for item in all_items if item.extra]
+    enabled_items = [item for item in all_items
+                     if item.enabled and item.category_id in enabled_ids]
+    items = sorted((item for item in enabled_items if not item.extra),
+                   key=lambda item: (item.category_id, item.priority,
+                                     item.name))
+    for item in items:
+        item.extras = [extra for extra in extras
+                       if extra.category_id == item.category_id]
+    return {'categories': categories,
+            'items': items,
+            'extras': extras,
+            'enabled_items': enabled_items}
+
+
+def _get_version(key):
+    current = cache.get(key)
+    if current is None:
+        # Start from the current time in milliseconds, so that the version
+        # keeps growing even if the cache is cleared
+        cache.add(key, int(time.time() * 1000), None)
+        current = cache.get(key)
+    return current
+
+
+def _incr_version(key):
+    _get_version(key)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The version has just been evicted
+        cache.add(key, int(time.time() * 1000), None)
+        return cache.incr(key)
+
+
+def _bump(item_ids):
+    current = _incr_version(VERSION_KEY)
+    if item_ids is not None:
+        cache.set(CHANGES_KEY.format(current), item_ids, CHANGES_TIMEOUT)
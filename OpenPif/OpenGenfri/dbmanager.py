@@ -1,5 +1,20 @@
-from django.contrib.auth.models import User
-from models import Item, Bill, BillItem, BillItemExtra
+import operator
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.db import IntegrityError, transaction
+from django.db.models import (Case, Count, DecimalField, ExpressionWrapper, F,
+                              Func, IntegerField, Q, Sum, Value, When)
+from django.utils import timezone
+from models import (Item, Bill, BillItem, BillItemExtra, Category, SalesRollup,
+                    CashRollup)
+import catalog
+import journal
+import ledger
+
+
+_MONEY = DecimalField(max_digits=12, decimal_places=2)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+IDEMPOTENCY_KEY_LENGTH = Bill._meta.get_field('idempotency_key').max_length
 
 
 class FormatError(Exception):
@@ -10,73 +25,214 @@ def undo_bill(billid, user):
     bill = Bill.objects.get(pk=billid)
     if not bill.is_committed():
         return 'Bill has already been deleted!'
-    for billitem in bill.billitem_set.all():
-        if billitem.item.quantity is not None:
-            billitem.item.quantity += billitem.quantity
-            billitem.item.save()
-        for extra in billitem.billitemextra_set.all():
-            if extra.item.quantity is not None:
-                extra.item.quantity += extra.quantity
-                extra.item.save()
-    bill.deleted_by = user.username
-    bill.save()
+    undo_bills([billid], user)
     return 'Bill #' + billid + ' deleted!'
 
 
+def undo_bills(billids, user):
+    """Deletes all the committed bills among ``billids``, giving their items
+    back to the stock, and returns the number of bills deleted.
+
+    The lines and extras of the bills are fetched all at once and the stock
+    of each item is restored by a single UPDATE."""
+    bills = list(Bill.objects.select_for_update().filter(
+        pk__in=billids, deleted_by='').prefetch_related(
+            'billitem_set__billitemextra_set'))
+    if not bills:
+        return 0
+    restock = {}
+    bill_restock = {}
+    rollups = {}
+    for bill in bills:
+        billitems = bill.billitem_set.all()
+        extras = []
+        stock = bill_restock[bill.id] = {}
+        for billitem in billitems:
+            stock[billitem.item_id] = (stock.get(billitem.item_id, 0) +
+                                       billitem.quantity)
+            for extra in billitem.billitemextra_set.all():
+                stock[extra.item_id] = (stock.get(extra.item_id, 0) +
+                                        extra.quantity)
+                extras.append(extra)
+        for item_id, qty in stock.items():
+            restock[item_id] = restock.get(item_id, 0) + qty
+        key = (_floor_hour(bill.date), bill.server)
+        bill_rollups = rollups.setdefault(key, ([], []))
+        bill_rollups[0].append(bill)
+        bill_rollups[1].extend(_bill_sales(billitems, extras))
+    if restock and ledger.enabled():
+        transaction.on_commit(lambda: ledger.restock(restock))
+        catalog.items_changed(restock.keys())
+    elif restock:
+        add_stock(restock)
+        catalog.items_changed(restock.keys())
+    Bill.objects.filter(pk__in=[bill.pk for bill in bills]).update(
+        deleted_by=user.username)
+    journal.bills_undone(bill_restock, user)
+    for hour_bills, rows in rollups.values():
+        _update_rollup(hour_bills, rows, -1)
+    return len(bills)
+
+
+def add_stock(quantities):
+    """Adds the quantities, by item id, to the stock of the stock-tracked
+    items with a single UPDATE."""
+    if quantities:
+        Item.objects.filter(pk__in=quantities.keys(),
+                            quantity__isnull=False).update(quantity=Case(
+                                *[When(pk=pk, then=F('quantity') + qty)
+                                  for pk, qty in quantities.items()],
+                                default=F('quantity'),
+                                output_field=IntegerField()))
+
+
 def commit_bill(output, reqdata, user):
-    errors = []
+    """Commits the bill described by ``reqdata``, if there is enough stock of
+    all its items.
+
+    The stock is taken first, by a single conditional UPDATE, so that
+    concurrent bills can never oversell an item, and only then the items are
+    read, under the write lock the UPDATE took: on SQLite a transaction which
+    reads before writing can't wait for the lock of another one and fails.
+
+    The optional ``idempotency_key`` of ``reqdata`` is stored with the bill,
+    and an IntegrityError is raised if a bill with the same key was committed
+    already: see committed_bill().
+
+    With the stock ledger the stock is taken from its counters instead, and
+    the items are read from its copy, which ledger.prefetch() refreshes
+    before the transaction: the rows of the items are never locked, and the
+    stock taken is given back if the bill isn't committed."""
+    key = reqdata.get('idempotency_key') or None
+    if key is not None and (not isinstance(key, basestring) or
+                            len(key) > IDEMPOTENCY_KEY_LENGTH):
+        raise FormatError('Invalid idempotency key: {!r}'.format(key))
     to_commit_billitems = []
     to_commit_extras = []
+    reservation = None
     try:
-        items = _get_items(reqdata)
-        bill = Bill(customer_name=reqdata['customer_name'],
-                    server=User.objects.get(pk=user.id).username,
-                    customer_id=output['customer_id'], total=0)
-        for r_billitem in reqdata['items']:
-            # r_data = reqdata['items'][r_billitem]
-            # print r_billitem['name']
-            item = items[r_billitem['name']]
-            billitem, ok = _create_item(r_billitem, BillItem, item)
-            billitem_total = 0
-            if ok:
-                billitem_total += billitem.item_price
-                # print billitem.item.name, billitem.item_price
-                billitem.bill = bill
-                billitem.category = billitem.item.category
-                billitem.note = r_billitem['notes']
-                to_commit_billitems.append(billitem)
+        with transaction.atomic():
+            requested = _requested_stock(reqdata)
+            if ledger.enabled():
+                items = ledger.items(requested)
+                _check_known(requested, items)
+                errors, reservation = ledger.reserve(requested, items)
             else:
-                errors.append((billitem.item.name, billitem.item.quantity))
-            for r_extra in r_billitem['extras']:
-                r_data = r_billitem['extras'][r_extra]
-                item = items[r_extra]
-                extra, ok = _create_item(r_data, BillItemExtra, item)
-                if ok:
-                    billitem_total += extra.item_price * extra.quantity
-                    # print extra.item.name, extra.item_price * extra.quantity
-                    extra.billitem = billitem
-                    to_commit_extras.append(extra)
-                else:
-                    errors.append((extra.item.name, extra.item.quantity))
-            bill.total += billitem_total * billitem.quantity
-            # print billitem.item.name, billitem.quantity
-            # print 'Total', bill.total
+                errors = _reserve_stock(requested)
+            if not errors and reservation is None:
+                items = _get_items(reqdata)
+            if not errors:
+                bill = Bill(customer_name=reqdata['customer_name'],
+                            server=user.username,
+                            customer_id=output['customer_id'], total=0,
+                            idempotency_key=key)
+                for r_billitem in reqdata['items']:
+                    item = items[r_billitem['name']]
+                    billitem = _create_item(r_billitem, BillItem, item)
+                    billitem_total = billitem.item_price
+                    billitem.bill = bill
+                    billitem.category = item.category
+                    billitem.note = r_billitem['notes']
+                    to_commit_billitems.append(billitem)
+                    for r_extra in r_billitem['extras']:
+                        r_data = r_billitem['extras'][r_extra]
+                        extra = _create_item(r_data, BillItemExtra,
+                                             items[r_extra])
+                        billitem_total += extra.item_price * extra.quantity
+                        extra.billitem = billitem
+                        to_commit_extras.append(extra)
+                    bill.total += billitem_total * billitem.quantity
+                catalog.items_changed(item.id for item in items.values()
+                                      if item.quantity is not None)
     except KeyError as e:
+        ledger.release(reservation)
         raise FormatError('Missing key: {}'.format(str(e)))
+    except Exception:
+        ledger.release(reservation)
+        raise
     if errors:
         output['total'] = 0
         output['customer_id'] = None
         output['errors'] = dict(errors)
-        bill = None
-    else:
-        bill = _commit_bill_to_db(bill, to_commit_billitems, to_commit_extras,
-                                  items)
-        output['total'] = bill.total
-        output['customer_id'] = bill.customer_id
-        output['errors'] = {}
-        output['date'] = bill.date
-        output['billid'] = bill.id
-    return output, bill
+        return output, None
+    try:
+        bill = _commit_bill_to_db(bill, to_commit_billitems, to_commit_extras)
+    except Exception:
+        ledger.release(reservation)
+        raise
+    if reservation is not None:
+        transaction.on_commit(lambda: ledger.confirm(reservation))
+    journal.bill_committed(bill, to_commit_billitems, to_commit_extras)
+    return bill_output(output, bill), bill
+
+
+def commit_bills(reqdatas, user):
+    """Commits the bills queued by a till while offline, each one as
+    commit_bill() does, in a single transaction.
+
+    Every bill must have an idempotency key, so that a sync repeated after a
+    lost answer doesn't commit them twice. Returns a list of ``(output,
+    bill)``, in the order of ``reqdatas``: ``bill`` is None for the bills
+    refused for lack of stock, whose ``output['errors']`` lists the items as
+    commit_bill() does, and for the malformed ones, whose ``output['error']``
+    tells why. The bills committed earlier are returned as they were, with
+    ``output['duplicate']`` set."""
+    keys = [reqdata.get('idempotency_key') if isinstance(reqdata, dict)
+            else None for reqdata in reqdatas]
+    # Looked up before the transaction, which must write first
+    committed = {bill.idempotency_key: bill for bill in Bill.objects.filter(
+        idempotency_key__in=[key for key in keys if key])}
+    ledger.prefetch()
+    results = []
+    raced = []
+    with transaction.atomic():
+        for key, reqdata in zip(keys, reqdatas):
+            output = {'errors': {}, 'customer_id': '', 'date': None,
+                      'total': 0, 'idempotency_key': key}
+            bill = committed.get(key)
+            if bill is not None:
+                output['duplicate'] = True
+                results.append((bill_output(output, bill), bill))
+                continue
+            try:
+                if not key:
+                    raise FormatError('Missing idempotency key')
+                with transaction.atomic():
+                    results.append(commit_bill(output, reqdata, user))
+                committed[key] = results[-1][1]
+            except FormatError as e:
+                output['error'] = str(e)
+                results.append((output, None))
+            except IntegrityError:
+                # Committed meanwhile by a concurrent sync of the same bill
+                raced.append(len(results))
+                results.append((output, None))
+    for n in raced:
+        output, _ = results[n]
+        bill = committed_bill(output['idempotency_key'])
+        output['duplicate'] = True
+        results[n] = (bill_output(output, bill), bill)
+    return results
+
+
+def committed_bill(key):
+    """Returns the bill committed with the idempotency key ``key``, if any.
+
+    Tills retrying a bill send its key again: looking it up before committing
+    answers the retry without taking the stock a second time."""
+    if not key:
+        return None
+    return Bill.objects.filter(idempotency_key=key).first()
+
+
+def bill_output(output, bill):
+    """Fills ``output`` as commit_bill() does for the committed ``bill``."""
+    output['total'] = bill.total
+    output['customer_id'] = bill.customer_id
+    output['errors'] = {}
+    output['date'] = bill.date
+    output['billid'] = bill.id
+    return output
 
 
 def _get_items(reqdata):
@@ -93,29 +249,362 @@ def _get_items(reqdata):
 
 
 def _create_item(r_data, BillElementClass, item):
-    ok = True
-    element = BillElementClass(item=item, item_price=item.price)
-    if item.quantity is not None:
-        remaining_quantity = item.quantity - r_data['qty']
-        if remaining_quantity >= 0:
-            item.quantity = remaining_quantity
-        else:
-            ok = False
-    element.quantity = r_data['qty']
-    return element, ok
-
-
-def _commit_bill_to_db(bill, to_commit_billitems, to_commit_extras, items):
-    for item in items.values():
-        item.save()
+    return BillElementClass(item=item, item_price=item.price,
+                            quantity=r_data['qty'])
+
+
+def _requested_stock(reqdata):
+    """Returns the quantity of each item, by name, sold by the bill."""
+    requested = {}
+    for r_billitem in reqdata['items']:
+        name = r_billitem['name']
+        requested[name] = requested.get(name, 0) + r_billitem['qty']
+        for r_extra, r_data in r_billitem['extras'].items():
+            requested[r_extra] = requested.get(r_extra, 0) + r_data['qty']
+    return requested
+
+
+class _StockConflict(Exception):
+    pass
+
+
+def _reserve_stock(requested):
+    """Takes the ``requested`` quantities of the items, by name, from their
+    stock with a single conditional UPDATE, which only matches the items
+    with unlimited or enough stock. If any of them doesn't, nothing is taken
+    and the ``(name, quantity)`` pairs of the missing items are returned as
+    errors."""
+    if not requested:
+        return []
+    enough = reduce(operator.or_, (
+        Q(name=name) & (Q(quantity__isnull=True) | Q(quantity__gte=qty))
+        for name, qty in requested.items()))
+    decrements = [When(name=name, then=F('quantity') - qty)
+                  for name, qty in requested.items()]
+    while True:
+        try:
+            with transaction.atomic():
+                updated = Item.objects.filter(enough).update(quantity=Case(
+                    *decrements, default=F('quantity'),
+                    output_field=IntegerField()))
+                if updated != len(requested):
+                    raise _StockConflict()
+            return []
+        except _StockConflict:
+            stock = dict(Item.objects.filter(
+                name__in=requested.keys()).values_list('name', 'quantity'))
+            _check_known(requested, stock)
+            errors = [(name, quantity) for name, quantity in stock.items()
+                      if quantity is not None and quantity < requested[name]]
+            if errors:
+                return errors
+            # The stock was refilled in the meantime
+
+
+def _check_known(requested, items):
+    unknown = set(requested) - set(items)
+    if unknown:
+        raise FormatError('Unknown items: {}'.format(
+            ', '.join(sorted(unknown))))
+
+
+def _commit_bill_to_db(bill, to_commit_billitems, to_commit_extras):
     if bill.total < 0:
         bill.total = 0
     bill.save()
-    for item in to_commit_billitems:
-        item.bill = item.bill
-        item.save()
-    for item in to_commit_extras:
-        item.billitem = item.billitem
-        if item.billitem:
-            item.save()
+    for billitem in to_commit_billitems:
+        billitem.bill = bill
+    BillItem.objects.bulk_create(to_commit_billitems)
+    if to_commit_extras:
+        # bulk_create doesn't fetch the primary keys back, but they are
+        # assigned in insertion order
+        billitem_ids = bill.billitem_set.order_by('id').values_list('id',
+                                                                    flat=True)
+        for billitem, billitem_id in zip(to_commit_billitems, billitem_ids):
+            billitem.pk = billitem_id
+        for extra in to_commit_extras:
+            extra.billitem = extra.billitem
+        BillItemExtra.objects.bulk_create(to_commit_extras)
+    _update_rollup([bill], _bill_sales(to_commit_billitems, to_commit_extras),
+                   1)
     return bill
+
+
+def bills_page(bills, after=None, size=50):
+    """Returns a page of ``bills``, newest first, and the cursor of the next
+    page, or None on the last one.
+
+    ``after`` is the cursor of the previous page. The page starts after its
+    last bill by (date, id), so reading it costs the same whatever its depth,
+    and the bills committed meanwhile don't shift it. Raises FormatError on a
+    malformed cursor."""
+    bills = bills.order_by('-date', '-id')
+    if after:
+        date, bill_id = _decode_cursor(after)
+        # The range on the date alone is the one an index can serve
+        bills = bills.filter(Q(date__lt=date) | Q(date=date, id__lt=bill_id),
+                             date__lte=date)
+    page = list(bills[:size + 1])
+    if len(page) <= size:
+        return page, None
+    last = page[size - 1]
+    delta = last.date - _EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return page[:size], '{}_{}'.format(micros, last.id)
+
+
+def _decode_cursor(cursor):
+    try:
+        micros, bill_id = [int(part) for part in cursor.split('_')]
+    except ValueError:
+        raise FormatError('Invalid cursor: {}'.format(cursor))
+    return _EPOCH + timedelta(microseconds=micros), bill_id
+
+
+def sales_report(date_start=None, date_end=None, servers=None):
+    """Aggregates the sales of the committed bills by category and item,
+    optionally restricting them to a date range and to a list of server
+    usernames.
+
+    Returns a ``(report, total_earn, total_cash)`` tuple, where ``report`` maps
+    every Category to a dictionary of the form:
+
+        {'itemss': {item: {'quantity': units, 'price': amount}, ...},
+         'items_sold': units,
+         'total_price': amount}
+
+    Bill lines are accounted at their absolute value and only positive ones
+    count towards ``total_earn``, while extras are multiplied by the quantity
+    of their bill line and accounted under its category.
+
+    Whole hours are read from the hourly rollups, so only the bills falling in
+    the partial hours at the edges of the range are aggregated from the raw
+    bill lines."""
+    bills = Bill.objects.filter(deleted_by='')
+    sales = SalesRollup.objects.all()
+    cash = CashRollup.objects.all()
+    if servers:
+        bills = bills.filter(server__in=servers)
+        sales = sales.filter(server__in=servers)
+        cash = cash.filter(server__in=servers)
+    first_hour = _ceil_hour(date_start) if date_start else None
+    last_hour = _floor_hour(date_end) if date_end else None
+    # The bills of each partial hour are aggregated on their own, so that
+    # every query reads a single range of the (deleted_by, date) index
+    edges = []
+    if first_hour and last_hour and first_hour >= last_hour:
+        # The whole range falls within an hour or two
+        edges.append(bills.filter(date__gte=date_start, date__lte=date_end))
+        sales = sales.none()
+        cash = cash.none()
+    else:
+        if first_hour:
+            edges.append(bills.filter(date__gte=date_start,
+                                      date__lt=first_hour))
+            sales = sales.filter(hour__gte=first_hour)
+            cash = cash.filter(hour__gte=first_hour)
+        if last_hour:
+            edges.append(bills.filter(date__gte=last_hour,
+                                      date__lte=date_end))
+            sales = sales.filter(hour__lt=last_hour)
+            cash = cash.filter(hour__lt=last_hour)
+    total_cash = Decimal(0)
+    rows = []
+    for qs in edges + [cash]:
+        total_cash += qs.aggregate(total=Sum('total'))['total'] or 0
+    for edge in edges:
+        rows.extend(_sales_rows(edge))
+    for row in sales.values('category', 'item').annotate(
+            units=Sum('quantity'), revenue=Sum('revenue'), earn=Sum('earn')):
+        rows.append((row['category'], row['item'], row['units'],
+                     row['revenue'], row['earn']))
+    return _build_report(rows, total_cash)
+
+
+def _sales_rows(bills, billitem_model=BillItem, extra_model=BillItemExtra):
+    """Yields ``(category_id, item_id, units, revenue, earn)`` tuples for the
+    lines and the extras sold in ``bills``, using the given models."""
+    line_price = ExpressionWrapper(F('item_price') * F('quantity'),
+                                   output_field=_MONEY)
+    billitems = billitem_model.objects.filter(bill__in=bills).values(
+        'category', 'item').annotate(
+            units=Sum('quantity'),
+            revenue=Sum(Func(line_price, function='ABS', output_field=_MONEY)),
+            earn=Sum(Case(When(item_price__gt=0, then=line_price),
+                          default=Value(0), output_field=_MONEY)))
+    for row in billitems:
+        yield (row['category'], row['item'], row['units'], row['revenue'],
+               row['earn'])
+
+    extra_units = ExpressionWrapper(F('quantity') * F('billitem__quantity'),
+                                    output_field=IntegerField())
+    extra_price = ExpressionWrapper(
+        F('quantity') * F('item_price') * F('billitem__quantity'),
+        output_field=_MONEY)
+    extras = extra_model.objects.filter(billitem__bill__in=bills).values(
+        'billitem__category', 'item').annotate(units=Sum(extra_units),
+                                               revenue=Sum(extra_price))
+    for row in extras:
+        yield (row['billitem__category'], row['item'], row['units'],
+               row['revenue'], row['revenue'])
+
+
+def _build_report(rows, total_cash):
+    categories = dict((c.id, c) for c in Category.objects.all())
+    items = dict((i.id, i) for i in Item.objects.all())
+    report = {}
+    for category in categories.values():
+        report[category] = _empty_category()
+    for item in items.values():
+        if item.category_id in categories:
+            entry_category = report[categories[item.category_id]]
+            entry_category['itemss'][item] = _empty_item()
+    total_earn = Decimal(0)
+    for category_id, item_id, units, revenue, earn in rows:
+        entry_category = report.setdefault(categories.get(category_id),
+                                           _empty_category())
+        entry_category['items_sold'] += units
+        entry_category['total_price'] += revenue
+        entry_item = entry_category['itemss'].setdefault(items[item_id],
+                                                         _empty_item())
+        entry_item['quantity'] += units
+        entry_item['price'] += revenue
+        total_earn += earn
+    return report, total_earn, total_cash
+
+
+def _empty_category():
+    return {'itemss': {},
+            'items_sold': 0,
+            'total_price': Decimal(0.00)
+            }
+
+
+def _empty_item():
+    return {'quantity': 0, 'price': Decimal(0.00)}
+
+
+def rebuild_sales_rollup(apps=None):
+    """Recomputes the hourly rollups from the committed bills, with the
+    historical models of ``apps`` when called by a migration."""
+    models = [Bill, BillItem, BillItemExtra, SalesRollup, CashRollup]
+    if apps is not None:
+        models = [apps.get_model('OpenGenfri', model.__name__)
+                  for model in models]
+    bill_model, billitem_model, extra_model, sales_model, cash_model = models
+    with transaction.atomic():
+        sales_model.objects.all().delete()
+        cash_model.objects.all().delete()
+        committed = bill_model.objects.filter(deleted_by='')
+        dates = committed.values_list('date', flat=True).iterator()
+        for hour in sorted(set(_floor_hour(date) for date in dates)):
+            hour_bills = committed.filter(date__gte=hour,
+                                          date__lt=hour + timedelta(hours=1))
+            servers = hour_bills.values_list('server', flat=True).distinct()
+            for server in servers:
+                bills = hour_bills.filter(server=server)
+                sales_model.objects.bulk_create(
+                    sales_model(hour=hour, server=server,
+                                category_id=category_id, item_id=item_id,
+                                quantity=units, revenue=revenue, earn=earn)
+                    for category_id, item_id, units, revenue, earn
+                    in _sales_rows(bills, billitem_model, extra_model))
+                cash = bills.aggregate(bills=Count('id'), total=Sum('total'))
+                cash_model.objects.create(hour=hour, server=server, **cash)
+
+
+def _bill_sales(billitems, extras):
+    """Yields the same rows as ``_sales_rows`` for the in memory lines and
+    extras of a single bill."""
+    for billitem in billitems:
+        price = billitem.item_price * billitem.quantity
+        yield (billitem.category_id, billitem.item_id, billitem.quantity,
+               abs(price), max(price, 0))
+    for extra in extras:
+        billitem = extra.billitem
+        yield (billitem.category_id, extra.item_id,
+               extra.quantity * billitem.quantity, extra.total_cost,
+               extra.total_cost)
+
+
+def _update_rollup(bills, rows, sign):
+    """Adds (or subtracts, when ``sign`` is -1) the ``rows`` sold by ``bills``
+    to the rollups of the hour they were committed in. All the ``bills`` must
+    belong to the same hour and server."""
+    hour = _floor_hour(bills[0].date)
+    server = bills[0].server
+    cash = sum(bill.total for bill in bills)
+    totals = {}
+    for category_id, item_id, units, revenue, earn in rows:
+        entry = totals.setdefault((category_id, item_id), [0, 0, 0])
+        entry[0] += sign * units
+        entry[1] += sign * revenue
+        entry[2] += sign * earn
+    # The rows missing are created in a savepoint: if a concurrent commit
+    # created them since they were read, they are read again and added to
+    missing = _add_sales_rollup(hour, server, totals, retry=True)
+    if missing:
+        _add_sales_rollup(hour, server, missing)
+    changes = {'bills': F('bills') + sign * len(bills),
+               'total': F('total') + sign * cash}
+    if CashRollup.objects.filter(hour=hour, server=server).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            CashRollup.objects.create(hour=hour, server=server,
+                                      bills=sign * len(bills),
+                                      total=sign * cash)
+    except IntegrityError:
+        CashRollup.objects.filter(hour=hour, server=server).update(**changes)
+
+
+def _add_sales_rollup(hour, server, totals, retry=False):
+    """Adds the ``totals``, as ``{(category_id, item_id): [units, revenue,
+    earn]}``, to the sales rollups of ``hour`` and ``server``, creating the
+    missing ones. With ``retry``, if one of those has been created meanwhile,
+    none is and their totals are returned, as the rows found are added to
+    anyway."""
+    totals = dict(totals)
+    existing = SalesRollup.objects.filter(
+        hour=hour, server=server,
+        item_id__in=set(item_id for _, item_id in totals))
+    whens = {'quantity': [], 'revenue': [], 'earn': []}
+    for rollup in existing.only('id', 'category', 'item'):
+        entry = totals.pop((rollup.category_id, rollup.item_id), None)
+        if entry is None:
+            continue
+        for field, amount in zip(('quantity', 'revenue', 'earn'), entry):
+            whens[field].append(When(pk=rollup.pk, then=F(field) + amount))
+    if whens['quantity']:
+        existing.update(
+            quantity=Case(*whens['quantity'], default=F('quantity'),
+                          output_field=IntegerField()),
+            revenue=Case(*whens['revenue'], default=F('revenue'),
+                         output_field=_MONEY),
+            earn=Case(*whens['earn'], default=F('earn'), output_field=_MONEY))
+    if not totals:
+        return {}
+    rollups = [SalesRollup(hour=hour, server=server, category_id=category_id,
+                           item_id=item_id, quantity=units, revenue=revenue,
+                           earn=earn)
+               for (category_id, item_id), (units, revenue, earn)
+               in totals.items()]
+    if not retry:
+        SalesRollup.objects.bulk_create(rollups)
+        return {}
+    try:
+        with transaction.atomic():
+            SalesRollup.objects.bulk_create(rollups)
+    except IntegrityError:
+        return totals
+    return {}
+
+
+def _floor_hour(date):
+    return date.astimezone(timezone.utc).replace(minute=0, second=0,
+                                                 microsecond=0)
+
+
+def _ceil_hour(date):
+    hour = _floor_hour(date)
+    return hour if hour == date else hour + timedelta(hours=1)
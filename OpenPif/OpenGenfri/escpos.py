@@ -0,0 +1,192 @@
+"""
+ESC/POS output of the tickets for thermal receipt printers.
+
+Each printable category of a bill gets its own ticket, built straight from the
+same context of the PDF tickets and sent to the printer of its station: the
+one set on the category, or else the one configured for it in
+settings.TICKET_PRINTERS, as a dictionary of the form:
+
+    {"Bibite": "tcp://192.168.1.20:9100",
+     "Piatti": "/dev/usb/lp0",
+     "*": "tcp://192.168.1.21:9100"}
+
+where "*" is used for the categories not listed. Printers are either device
+files or network printers listening for raw data on a TCP port.
+
+Every printer has a queue, served by its own thread, so that committing a bill
+never waits for the printers. The tickets which reach a queue within
+BATCH_WINDOW seconds of each other are sent together, and sending is retried
+after each of RETRY_DELAYS seconds before the tickets are given up.
+"""
+import logging
+import Queue
+import socket
+import textwrap
+import threading
+import time
+from django.conf import settings
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+# Characters per line of the font A on 80 mm paper
+COLUMNS = 42
+# Seconds to wait for a network printer
+TIMEOUT = 5
+ENCODING = 'cp858'
+BATCH_WINDOW = 0.5
+BATCH_SIZE = 20
+RETRY_DELAYS = (1, 2, 5, 10, 30)
+
+ESC = b'\x1b'
+GS = b'\x1d'
+INIT = ESC + b'@'
+CODEPAGE = ESC + b't\x13'  # PC858, Latin 1 with the euro sign
+NORMAL = ESC + b'!\x00'
+BOLD = ESC + b'!\x08'
+LARGE = ESC + b'!\x30'  # Double height and width
+CUT = GS + b'V\x42\x03'  # Feed 3 lines, then cut partially
+
+
+_stations = {}
+_stations_lock = threading.Lock()
+
+
+def printer_for(category):
+    """Returns the printer of the category, or None if it has none."""
+    if category.printer:
+        return category.printer
+    printers = settings.TICKET_PRINTERS
+    return printers.get(category.name, printers.get('*'))
+
+
+def render_tickets(context):
+    """Returns the list of the (category, ESC/POS ticket) pairs of the
+    printable categories in the context of a ticket."""
+    bill = context['bill']
+    header = _header(bill)
+    return [(category, _ticket(category, header, lines))
+            for category, lines in context['billitems'].items()]
+
+
+def print_tickets(context):
+    """Queues the tickets of the printable categories for their printers.
+    Returns the number of tickets queued."""
+    queued = 0
+    for category, ticket in render_tickets(context):
+        printer = printer_for(category)
+        if printer:
+            station(printer).put(context['bill'].id, ticket)
+            queued += 1
+    return queued
+
+
+def station(printer):
+    """Returns the station of the printer, starting it if needed."""
+    with _stations_lock:
+        if printer not in _stations:
+            _stations[printer] = Station(printer)
+        return _stations[printer]
+
+
+def join():
+    """Waits until all the queued tickets are printed or given up."""
+    for printer_station in _stations.values():
+        printer_station.jobs.join()
+
+
+def send(printer, data):
+    """Writes raw data to a printer, given as a device file path or as a
+    tcp://host:port address."""
+    if printer.startswith('tcp://'):
+        host, port = printer[len('tcp://'):].rsplit(':', 1)
+        conn = socket.create_connection((host, int(port)), TIMEOUT)
+        try:
+            conn.sendall(data)
+        finally:
+            conn.close()
+    else:
+        with open(printer, 'wb') as device:
+            device.write(data)
+
+
+class Station(object):
+    """The queue of the tickets of a printer and the thread sending them."""
+    def __init__(self, printer):
+        self.printer = printer
+        self.jobs = Queue.Queue()
+        thread = threading.Thread(target=self._run,
+                                  name='Printer {}'.format(printer))
+        thread.daemon = True
+        thread.start()
+
+    def put(self, bill_id, ticket):
+        self.jobs.put((bill_id, ticket))
+
+    def _run(self):
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.time() + BATCH_WINDOW
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.jobs.get(
+                        timeout=max(deadline - time.time(), 0)))
+                except Queue.Empty:
+                    break
+            try:
+                self._send(batch)
+            except Exception:
+                logger.exception('Error printing on {}'.format(self.printer))
+            finally:
+                for _ in batch:
+                    self.jobs.task_done()
+
+    def _send(self, batch):
+        data = b''.join(ticket for _, ticket in batch)
+        for delay in RETRY_DELAYS + (None,):
+            try:
+                send(self.printer, data)
+                return
+            except (IOError, OSError, socket.error) as e:
+                if delay is None:
+                    break
+                logger.warning('Error printing on {}, retrying in {} s: '
+                               '{}'.format(self.printer, delay, e))
+                time.sleep(delay)
+        logger.error('Could not print tickets {} on {}'.format(
+            ', '.join('#{}'.format(bill_id) for bill_id, _ in batch),
+            self.printer))
+
+
+def _header(bill):
+    date = timezone.localtime(bill.date).strftime('%d/%m/%Y %H:%M')
+    lines = [NORMAL + _text('#{} - {}'.format(bill.id, date)),
+             BOLD + _text(u'Cliente: {}'.format(bill.customer_name))]
+    if bill.customer_id:
+        lines.append(BOLD + _text(u'Tavolo: {}'.format(bill.customer_id)))
+    return b''.join(lines)
+
+
+def _ticket(category, header, lines):
+    out = [INIT, CODEPAGE,
+           LARGE + _text(category.name, COLUMNS // 2),
+           header,
+           NORMAL + _text('-' * COLUMNS)]
+    for billitem, extras in lines:
+        out.append(BOLD + _text(u'{} x {}'.format(billitem.quantity,
+                                                  billitem.item)))
+        out.append(NORMAL)
+        for extra in extras:
+            out.append(_text(u'  + {} x {}'.format(extra.quantity,
+                                                   extra.item)))
+        if billitem.note:
+            out.append(_text(u'  ' + billitem.note))
+    out.append(CUT)
+    return b''.join(out)
+
+
+def _text(text, width=COLUMNS):
+    lines = textwrap.wrap(text, width, subsequent_indent='    ') or ['']
+    return u''.join(line + u'\n' for line in lines).encode(ENCODING,
+                                                          'replace')
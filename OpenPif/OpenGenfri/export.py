@@ -0,0 +1,146 @@
+"""
+Export of the committed bills and of their lines, as CSV or JSON streams.
+
+The bills are read in chunks by (date, id), each one a short query of its
+own, so that the memory used stays flat whatever the period exported.
+QuerySet's iterator() doesn't do as much on SQLite, whose backend fetches all
+the rows at once. The order is the one of the (deleted_by, date) index, which
+reads each chunk without sorting the bills after it.
+"""
+import csv
+import json
+from collections import OrderedDict
+from decimal import Decimal
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from models import Bill, BillItem, BillItemExtra
+
+
+# Bills read by each query, within the 999 parameters of older SQLite builds
+CHUNK_SIZE = 500
+
+BILL_COLUMNS = ['id', 'date', 'customer_id', 'customer_name', 'server',
+                'total']
+LINE_COLUMNS = ['bill', 'date', 'server', 'line', 'category', 'item',
+                'extra', 'quantity', 'price', 'note']
+
+# The amounts are written with the decimals of the money fields
+_CENT = Decimal(10) ** -Bill._meta.get_field('total').decimal_places
+
+
+def filtered_bills(date_start=None, date_end=None, servers=None,
+                   categories=None):
+    """Returns the committed bills selected by the filters of ReportForm: the
+    date range, the server usernames and the categories of their lines."""
+    bills = Bill.objects.filter(deleted_by='')
+    if date_start:
+        bills = bills.filter(date__gte=date_start)
+    if date_end:
+        bills = bills.filter(date__lte=date_end)
+    if servers:
+        bills = bills.filter(server__in=servers)
+    if categories:
+        bills = bills.filter(billitem__category__in=categories).distinct()
+    return bills
+
+
+def bill_rows(bills):
+    """Yields a row of BILL_COLUMNS for each of ``bills``."""
+    for chunk in _chunks(bills.values_list(*BILL_COLUMNS)):
+        for row in chunk:
+            yield (row[0], timezone.localtime(row[1])) + row[2:5] + (
+                _money(row[5]),)
+
+
+def line_rows(bills, categories=None):
+    """Yields a row of LINE_COLUMNS for each line of ``bills``, optionally of
+    the given categories, followed by a row for each of its extras."""
+    chunks = _chunks(bills.values_list('id', 'date', 'server'))
+    for chunk in chunks:
+        bill_info = {bill_id: (timezone.localtime(date), server)
+                     for bill_id, date, server in chunk}
+        lines = BillItem.objects.filter(bill_id__in=bill_info)
+        if categories:
+            lines = lines.filter(category__in=categories)
+        extras = {}
+        for extra in BillItemExtra.objects.filter(
+                billitem__in=lines).values_list(
+                    'billitem_id', 'item__name', 'quantity',
+                    'item_price').order_by('id'):
+            extras.setdefault(extra[0], []).append(extra[1:])
+        for bill_id, line_id, category, item, quantity, price, note in (
+                lines.values_list(
+                    'bill_id', 'id', 'category__name', 'item__name',
+                    'quantity', 'item_price', 'note').order_by(
+                        'bill_id', 'id')):
+            date, server = bill_info[bill_id]
+            yield (bill_id, date, server, line_id, category, item, False,
+                   quantity, _money(price), note)
+            for item, quantity, price in extras.get(line_id, ()):
+                yield (bill_id, date, server, line_id, category, item, True,
+                       quantity, _money(price), '')
+
+
+def csv_stream(columns, rows):
+    """Yields the pieces of a CSV file, UTF-8 encoded, with a header."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for piece in _joined(writer.writerow([_csv_value(value)
+                                          for value in row])
+                         for row in rows):
+        yield piece
+
+
+def json_stream(columns, rows):
+    """Yields the pieces of a JSON array of objects with the given keys."""
+    yield '['
+    objects = (json.dumps(OrderedDict(zip(columns, row)),
+                          cls=DjangoJSONEncoder) for row in rows)
+    for n, piece in enumerate(_joined(objects, ',\n')):
+        yield (',\n' if n else '\n') + piece
+    yield '\n]\n'
+
+
+def _chunks(rows):
+    """Yields lists of ``rows``, a values_list of bills starting with the id
+    and the date, by ascending (date, id)."""
+    rows = rows.order_by('date', 'id')
+    chunk = list(rows[:CHUNK_SIZE])
+    while chunk:
+        yield chunk
+        last_id, date = chunk[-1][:2]
+        # The range on the date alone is the one an index can serve
+        chunk = list(rows.filter(Q(date__gt=date) | Q(date=date,
+                                                        id__gt=last_id),
+                                 date__gte=date)[:CHUNK_SIZE])
+
+
+def _money(amount):
+    return str(amount.quantize(_CENT))
+
+
+def _joined(pieces, separator=''):
+    """Joins ``pieces`` by CHUNK_SIZE, to write few and larger chunks."""
+    batch = []
+    for piece in pieces:
+        batch.append(piece)
+        if len(batch) == CHUNK_SIZE:
+            yield separator.join(batch)
+            batch = []
+    if batch:
+        yield separator.join(batch)
+
+
+def _csv_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+class _Echo(object):
+    """File-like object which returns what the csv writer writes to it."""
+    def write(self, value):
+        return value
@@ -0,0 +1,145 @@
+"""
+Substring search of the bills by customer name and server.
+
+On SQLite the names are indexed by trigrams in an FTS5 table, kept in sync by
+triggers on the bills, so that a search reads only the bills it matches. On
+PostgreSQL the icontains lookups are served by pg_trgm indexes instead. Other
+databases, SQLite builds without the trigram tokenizer and searches shorter
+than a trigram scan the bills.
+
+The triggers belong to the bill table: migrations which make SQLite remake it
+drop them, and must be followed by "manage.py rebuild_search_index".
+
+FTS5 reads the configuration of the table the first time a connection uses
+it, which in a transaction inserting a bill first would be a read before its
+first write: see prepare_connection().
+"""
+from django.db import OperationalError, connections, router
+from django.db.models import Q
+from models import Bill
+
+
+TABLE = 'OpenGenfri_bill_search'
+
+SQLITE_CREATE = [
+    'CREATE VIRTUAL TABLE "{table}" USING fts5(customer_name, server, '
+    'content="OpenGenfri_bill", content_rowid="id", tokenize="trigram")',
+    'CREATE TRIGGER "{table}_insert" AFTER INSERT ON "OpenGenfri_bill" BEGIN '
+    'INSERT INTO "{table}" (rowid, customer_name, server) '
+    'VALUES (new.id, new.customer_name, new.server); END',
+    'CREATE TRIGGER "{table}_delete" AFTER DELETE ON "OpenGenfri_bill" BEGIN '
+    'INSERT INTO "{table}" ("{table}", rowid, customer_name, server) '
+    'VALUES (\'delete\', old.id, old.customer_name, old.server); END',
+    'CREATE TRIGGER "{table}_update" AFTER UPDATE OF customer_name, server '
+    'ON "OpenGenfri_bill" BEGIN '
+    'INSERT INTO "{table}" ("{table}", rowid, customer_name, server) '
+    'VALUES (\'delete\', old.id, old.customer_name, old.server); '
+    'INSERT INTO "{table}" (rowid, customer_name, server) '
+    'VALUES (new.id, new.customer_name, new.server); END',
+    'INSERT INTO "{table}" ("{table}") VALUES (\'rebuild\')',
+]
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS "{table}_insert"',
+    'DROP TRIGGER IF EXISTS "{table}_delete"',
+    'DROP TRIGGER IF EXISTS "{table}_update"',
+    'DROP TABLE IF EXISTS "{table}"',
+]
+POSTGRESQL_CREATE = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX "OpenGenfri_bill_customer_name_trgm" ON "OpenGenfri_bill" '
+    'USING gin (UPPER("customer_name"::text) gin_trgm_ops)',
+    'CREATE INDEX "OpenGenfri_bill_server_trgm" ON "OpenGenfri_bill" '
+    'USING gin (UPPER("server"::text) gin_trgm_ops)',
+]
+POSTGRESQL_DROP = [
+    'DROP INDEX IF EXISTS "OpenGenfri_bill_customer_name_trgm"',
+    'DROP INDEX IF EXISTS "OpenGenfri_bill_server_trgm"',
+]
+
+# Whether the databases, by alias, have the FTS5 table
+_indexed = {}
+
+
+def search_bills(text):
+    """Returns the queryset of the bills, not deleted, with ``text`` in their
+    customer name or server."""
+    alias = router.db_for_read(Bill)
+    if len(text) >= 3 and _has_index(alias):
+        # A phrase of trigrams matches the substrings, like icontains. The
+        # deleted bills are left out in the subquery, with the unary + which
+        # keeps SQLite from reading the bills by the deleted_by index instead
+        # of the matches.
+        phrase = '"{}"'.format(text.replace('"', '""'))
+        return Bill.objects.extra(where=[
+            '"OpenGenfri_bill"."id" IN (SELECT "OpenGenfri_bill"."id" '
+            'FROM "{0}" JOIN "OpenGenfri_bill" '
+            'ON "OpenGenfri_bill"."id" = "{0}".rowid '
+            'WHERE "{0}" MATCH %s '
+            'AND +"OpenGenfri_bill"."deleted_by" = \'\')'.format(TABLE)],
+            params=[phrase])
+    return Bill.objects.filter(Q(server__icontains=text) |
+                               Q(customer_name__icontains=text),
+                               deleted_by='')
+
+
+def prepare_connection(connection):
+    """Has a new SQLite connection read the configuration of the FTS5 table,
+    if there is one, outside of any transaction."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT rowid FROM "{}" WHERE rowid = 0'.format(TABLE))
+    except OperationalError:
+        pass
+
+
+def create_index(schema_editor):
+    """Creates the search index of the database, if it supports one."""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite' and _supports_trigrams(schema_editor.connection):
+        statements = SQLITE_CREATE
+    elif vendor == 'postgresql':
+        statements = POSTGRESQL_CREATE
+    else:
+        return
+    for sql in statements:
+        schema_editor.execute(sql.format(table=TABLE))
+    _indexed.clear()
+
+
+def drop_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = SQLITE_DROP
+    elif vendor == 'postgresql':
+        statements = POSTGRESQL_DROP
+    else:
+        return
+    for sql in statements:
+        schema_editor.execute(sql.format(table=TABLE))
+    _indexed.clear()
+
+
+def rebuild_index(schema_editor):
+    """Recreates the search index, after a migration that remade the bill
+    table on SQLite and so dropped its triggers."""
+    drop_index(schema_editor)
+    create_index(schema_editor)
+
+
+def _has_index(alias):
+    if alias not in _indexed:
+        connection = connections[alias]
+        _indexed[alias] = (connection.vendor == 'sqlite' and TABLE in
+                           connection.introspection.table_names())
+    return _indexed[alias]
+
+
+def _supports_trigrams(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute('CREATE VIRTUAL TABLE temp.trigram_check USING '
+                       'fts5(name, tokenize="trigram")')
+    except OperationalError:
+        return False
+    cursor.execute('DROP TABLE temp.trigram_check')
+    return True
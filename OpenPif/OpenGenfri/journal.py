@@ -0,0 +1,422 @@
+"""
+Append-only journal of the bills committed and deleted, and of the stock
+edited by the admin, from which "manage.py replay_journal" rebuilds them.
+
+Every entry is a line of settings.TRANSACTION_JOURNAL holding a compact JSON
+array, with the dates in UTC as "YYYY-MM-DD HH:MM:SS.ffffff":
+
+    ["commit", bill id, date, server, customer name, customer id, total,
+     idempotency key, [[item id, category id, quantity, price, note,
+                        [[extra item id, quantity, price], ...]], ...]]
+    ["undo", date, username, [[bill id, [[item id, quantity], ...]], ...]]
+    ["stock", date, item id, quantity before, quantity after]
+
+where undo lists the stock given back by each bill. The entries are queued
+when their transaction commits, and written by a thread of each process,
+which gathers the entries of GROUP_WINDOW seconds in a single write, synced
+to disk if settings.TRANSACTION_JOURNAL_SYNC: committing a bill never waits
+for the disk, and a crash loses at most the entries of the last group.
+
+The replay inserts the bills missing from the database, deletes the ones
+still committed and puts their stock back or takes it again. An item edited
+by the admin gets the quantity of its last edit, changed by all the entries
+after it; the others the changes of the entries replayed. Replaying the same
+journal twice changes nothing the second time.
+"""
+import atexit
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from models import (Bill, BillItem, BillItemExtra, CashRollup, Item,
+                    SalesRollup)
+import dbmanager
+import ledger
+
+
+logger = logging.getLogger(__name__)
+
+GROUP_WINDOW = 0.05
+GROUP_SIZE = 1000
+# Entries replayed together, checking their bills with queries of
+# CHUNK_SIZE ids within the 999 parameters of older SQLite builds
+REPLAY_BATCH = 10000
+CHUNK_SIZE = 500
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def enabled():
+    return bool(settings.TRANSACTION_JOURNAL)
+
+
+def bill_committed(bill, billitems, extras):
+    """Journals ``bill``, just committed with its lines and their extras,
+    when the transaction commits."""
+    if not enabled():
+        return
+    line_extras = {}
+    for extra in extras:
+        line_extras.setdefault(id(extra.billitem), []).append(
+            [extra.item_id, extra.quantity, str(extra.item_price)])
+    lines = [[billitem.item_id, billitem.category_id, billitem.quantity,
+              str(billitem.item_price), billitem.note,
+              line_extras.get(id(billitem), [])]
+             for billitem in billitems]
+    _write_on_commit(['commit', bill.id, _utc(bill.date), bill.server,
+                      bill.customer_name, bill.customer_id, str(bill.total),
+                      bill.idempotency_key, lines])
+
+
+def bills_undone(restock, user):
+    """Journals the deletion of the bills by ``user``, with the stock given
+    back by each of them as ``{bill id: {item id: quantity}}``."""
+    if enabled():
+        _write_on_commit(['undo', _utc(timezone.now()), user.username,
+                          [[bill_id, stock.items()]
+                           for bill_id, stock in restock.items()]])
+
+
+def stock_changed(item, before, after):
+    """Journals the edit of the stock of ``item``."""
+    if enabled() and before != after:
+        _write_on_commit(['stock', _utc(timezone.now()), item.id, before,
+                          after])
+
+
+def flush():
+    """Waits for the entries queued by this process to be written."""
+    if _writer is not None:
+        _writer.entries.join()
+
+
+def replay(paths):
+    """Replays the journal files ``paths``, in order, and returns the
+    numbers of entries read, bills committed and deleted, and stock edits
+    applied, as a dictionary."""
+    counts = {'entries': 0, 'committed': 0, 'undone': 0, 'stock': 0}
+    state = _Replay(counts)
+    batch = []
+    for path in paths:
+        with open(path) as journal:
+            for line in journal:
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    # Torn by a crash while being written
+                    continue
+                if len(batch) == REPLAY_BATCH:
+                    state.apply(batch)
+                    batch = []
+    state.apply(batch)
+    state.finish()
+    return counts
+
+
+def _utc(date):
+    return date.astimezone(timezone.utc).strftime(DATE_FORMAT)
+
+
+def _write_on_commit(entry):
+    transaction.on_commit(lambda: _get_writer().entries.put(entry))
+
+
+def _get_writer():
+    global _writer
+    with _writer_lock:
+        # A forked process starts a writer of its own
+        if (_writer is None or _writer.pid != os.getpid() or
+                _writer.path != settings.TRANSACTION_JOURNAL):
+            _writer = _Writer(settings.TRANSACTION_JOURNAL)
+        return _writer
+
+
+class _Writer(object):
+    """The queue of the entries of a process and the thread writing them."""
+    def __init__(self, path):
+        self.pid = os.getpid()
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.journal = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                               0o644)
+        self.entries = Queue.Queue()
+        thread = threading.Thread(target=self._run, name='Journal')
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.entries.join)
+
+    def _run(self):
+        while True:
+            batch = [self.entries.get()]
+            deadline = time.time() + GROUP_WINDOW
+            while len(batch) < GROUP_SIZE:
+                try:
+                    batch.append(self.entries.get(
+                        timeout=max(deadline - time.time(), 0)))
+                except Queue.Empty:
+                    break
+            try:
+                # A single write, which O_APPEND keeps whole among those of
+                # the other processes
+                os.write(self.journal, ''.join(
+                    json.dumps(entry, separators=(',', ':')) + '\n'
+                    for entry in batch))
+                if settings.TRANSACTION_JOURNAL_SYNC:
+                    os.fsync(self.journal)
+            except Exception:
+                logger.exception('Error writing {} journal entries'.format(
+                    len(batch)))
+            finally:
+                for _ in batch:
+                    self.entries.task_done()
+
+
+class _Replay(object):
+    """The state of a replay across its batches of entries."""
+    def __init__(self, counts):
+        self.counts = counts
+        # The stock changed by the entries replayed, by item id, and for the
+        # items edited by the admin their last edit and all the changes after
+        self.applied = {}
+        self.edited = {}
+        # The sales of the bills committed and deleted, by hour and server,
+        # as the number of bills, their cash and the totals by category and
+        # item, in cents
+        self.sales = {}
+        self.next_line = (BillItem.objects.aggregate(Max('id'))['id__max'] or
+                          0) + 1
+
+    def apply(self, entries):
+        self.counts['entries'] += len(entries)
+        bill_ids = set()
+        for entry in entries:
+            if entry[0] == 'commit':
+                bill_ids.add(entry[1])
+            elif entry[0] == 'undo':
+                bill_ids.update(bill_id for bill_id, _ in entry[3])
+        ids = list(bill_ids)
+        # The deleted_by of the bills in the database and of those inserted
+        state = {}
+        for n in range(0, len(ids), CHUNK_SIZE):
+            state.update(Bill.objects.filter(
+                pk__in=ids[n:n + CHUNK_SIZE]).values_list('id', 'deleted_by'))
+        inserted = {}
+        undone = []
+        for entry in entries:
+            if entry[0] == 'commit':
+                self._commit(entry, state, inserted)
+            elif entry[0] == 'undo':
+                self._undo(entry, state, inserted, undone)
+            elif entry[0] == 'stock':
+                _, _, item_id, _, after = entry
+                self.edited[item_id] = [after, 0]
+                self.applied.pop(item_id, None)
+                self.counts['stock'] += 1
+        if inserted or undone:
+            with transaction.atomic():
+                self._insert(inserted.values(), state)
+                self._delete(undone)
+
+    def finish(self):
+        with transaction.atomic():
+            dbmanager.add_stock(self.applied)
+            for item_id, (quantity, delta) in self.edited.items():
+                Item.objects.filter(pk=item_id).update(
+                    quantity=None if quantity is None else quantity + delta)
+            self._write_sales()
+            cursor = connection.cursor()
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [Bill, BillItem, BillItemExtra]):
+                cursor.execute(sql)
+        if ledger.enabled():
+            ledger.reload()
+
+    def _write_sales(self):
+        """Adds the sales of the replay to the hourly rollups, as
+        dbmanager._update_rollup() does for the bills of a request."""
+        hours = set(timezone.make_aware(
+            datetime.strptime(hour, '%Y-%m-%d %H'), timezone.utc)
+            for hour, _ in self.sales)
+        cash_rows = set((_utc(hour)[:13], server) for hour, server in
+                        CashRollup.objects.filter(hour__in=hours).values_list(
+                            'hour', 'server'))
+        sales_rows = set((_utc(hour)[:13], server, category_id, item_id)
+                         for hour, server, category_id, item_id in
+                         SalesRollup.objects.filter(hour__in=hours).values_list(
+                             'hour', 'server', 'category', 'item'))
+        cash = ([], [])
+        sales = ([], [])
+        for (hour, server), (bills, total, totals) in self.sales.items():
+            date = hour + ':00:00'
+            if (hour, server) in cash_rows:
+                cash[0].append((bills, _money(total), date, server))
+            elif bills or total:
+                cash[1].append((date, server, bills, _money(total)))
+            for (category_id, item_id), (units, revenue, earn) in (
+                    totals.items()):
+                if (hour, server, category_id, item_id) in sales_rows:
+                    sales[0].append((units, _money(revenue), _money(earn),
+                                     date, server, category_id, item_id))
+                elif units or revenue or earn:
+                    sales[1].append((date, server, category_id, item_id,
+                                     units, _money(revenue), _money(earn)))
+        cursor = connection.cursor()
+        cursor.executemany(
+            'UPDATE "{}" SET "bills" = "bills" + %s, "total" = "total" + %s '
+            'WHERE "hour" = %s AND "server" = %s'.format(
+                CashRollup._meta.db_table), cash[0])
+        cursor.executemany(
+            'INSERT INTO "{}" ("hour", "server", "bills", "total") VALUES '
+            '(%s, %s, %s, %s)'.format(CashRollup._meta.db_table), cash[1])
+        update = ('UPDATE "{}" SET "quantity" = "quantity" + %s, "revenue" = '
+                  '"revenue" + %s, "earn" = "earn" + %s WHERE "hour" = %s AND '
+                  '"server" = %s AND "item_id" = %s AND "category_id" '.format(
+                      SalesRollup._meta.db_table))
+        cursor.executemany(update + '= %s', [row[:5] + (row[6], row[5])
+                                             for row in sales[0]
+                                             if row[5] is not None])
+        cursor.executemany(update + 'IS NULL', [row[:5] + (row[6],)
+                                                for row in sales[0]
+                                                if row[5] is None])
+        cursor.executemany(
+            'INSERT INTO "{}" ("hour", "server", "category_id", "item_id", '
+            '"quantity", "revenue", "earn") VALUES (%s, %s, %s, %s, %s, %s, '
+            '%s)'.format(SalesRollup._meta.db_table), sales[1])
+
+    def _commit(self, entry, state, inserted):
+        bill_id, bill_lines = entry[1], entry[8]
+        stock = {}
+        for item_id, _, qty, _, _, line_extras in bill_lines:
+            stock[item_id] = stock.get(item_id, 0) - qty
+            for extra_id, extra_qty, _ in line_extras:
+                stock[extra_id] = stock.get(extra_id, 0) - extra_qty
+        known = bill_id in state
+        self._change_stock(stock, not known)
+        if not known:
+            state[bill_id] = ''
+            inserted[bill_id] = entry
+            self.counts['committed'] += 1
+
+    def _undo(self, entry, state, inserted, undone):
+        _, _, username, restock = entry
+        for bill_id, stock in restock:
+            if bill_id not in state:
+                # Committed before the journal and missing from the database
+                continue
+            committed = state[bill_id] == ''
+            self._change_stock(dict(stock), committed)
+            if committed:
+                state[bill_id] = username
+                if bill_id not in inserted:
+                    undone.append((username, bill_id))
+                self.counts['undone'] += 1
+
+    def _change_stock(self, stock, apply):
+        for item_id, qty in stock.items():
+            if item_id in self.edited:
+                self.edited[item_id][1] += qty
+            elif apply:
+                self.applied[item_id] = self.applied.get(item_id, 0) + qty
+
+    def _add_sales(self, date, server, total, lines, sign):
+        sales = self.sales.setdefault((date[:13], server), [0, 0, {}])
+        sales[0] += sign
+        sales[1] += sign * _cents(total)
+        totals = sales[2]
+        for item_id, category_id, qty, price, _, line_extras in lines:
+            amount = _cents(price) * qty
+            entry = totals.setdefault((category_id, item_id), [0, 0, 0])
+            entry[0] += sign * qty
+            entry[1] += sign * abs(amount)
+            entry[2] += sign * max(amount, 0)
+            for extra_id, extra_qty, extra_price in line_extras:
+                units = extra_qty * qty
+                amount = _cents(extra_price) * units
+                entry = totals.setdefault((category_id, extra_id), [0, 0, 0])
+                entry[0] += sign * units
+                entry[1] += sign * amount
+                entry[2] += sign * amount
+
+    def _insert(self, entries, state):
+        bills = []
+        lines = []
+        extras = []
+        for (_, bill_id, date, server, customer_name, customer_id, total,
+             key, bill_lines) in entries:
+            deleted_by = state[bill_id]
+            bills.append((bill_id, customer_id, customer_name, date, total,
+                          server, deleted_by, key))
+            if not deleted_by:
+                self._add_sales(date, server, total, bill_lines, 1)
+            for (item_id, category_id, qty, price, note,
+                 line_extras) in bill_lines:
+                lines.append((self.next_line, qty, price, note, bill_id,
+                              category_id, item_id))
+                for extra_id, extra_qty, extra_price in line_extras:
+                    extras.append((extra_qty, extra_price, self.next_line,
+                                   extra_id))
+                self.next_line += 1
+        cursor = connection.cursor()
+        cursor.executemany(
+            'INSERT INTO "{}" ("id", "customer_id", "customer_name", "date", '
+            '"total", "server", "deleted_by", "idempotency_key") VALUES (%s, '
+            '%s, %s, %s, %s, %s, %s, %s)'.format(Bill._meta.db_table), bills)
+        cursor.executemany(
+            'INSERT INTO "{}" ("id", "quantity", "item_price", "note", '
+            '"bill_id", "category_id", "item_id") VALUES (%s, %s, %s, %s, '
+            '%s, %s, %s)'.format(BillItem._meta.db_table), lines)
+        cursor.executemany(
+            'INSERT INTO "{}" ("quantity", "item_price", "billitem_id", '
+            '"item_id") VALUES (%s, %s, %s, %s)'.format(
+                BillItemExtra._meta.db_table), extras)
+
+    def _delete(self, undone):
+        """Deletes the bills of the database in ``undone``, as ``(username,
+        bill id)`` pairs, taking their sales off the rollups."""
+        ids = [bill_id for _, bill_id in undone]
+        for n in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[n:n + CHUNK_SIZE]
+            lines = {}
+            line_extras = {}
+            for line_id, item_id, qty, price in BillItemExtra.objects.filter(
+                    billitem__bill__in=chunk).values_list(
+                        'billitem', 'item', 'quantity', 'item_price'):
+                line_extras.setdefault(line_id, []).append(
+                    [item_id, qty, str(price)])
+            for bill_id, line_id, item_id, category_id, qty, price in (
+                    BillItem.objects.filter(bill__in=chunk).values_list(
+                        'bill', 'id', 'item', 'category', 'quantity',
+                        'item_price')):
+                lines.setdefault(bill_id, []).append(
+                    [item_id, category_id, qty, str(price), '',
+                     line_extras.get(line_id, [])])
+            for bill_id, date, server, total in Bill.objects.filter(
+                    pk__in=chunk).values_list('id', 'date', 'server',
+                                              'total'):
+                self._add_sales(_utc(date), server, str(total),
+                                lines.get(bill_id, []), -1)
+        connection.cursor().executemany(
+            'UPDATE "{}" SET "deleted_by" = %s WHERE "id" = %s'.format(
+                Bill._meta.db_table), undone)
+
+
+def _cents(amount):
+    return int(round(float(amount) * 100))
+
+
+def _money(cents):
+    return '{}{}.{:02d}'.format('-' if cents < 0 else '', *divmod(abs(cents),
+                                                                  100))
@@ -0,0 +1,396 @@
+"""
+Stock ledger, an optional stock engine keeping the stock of the items in the
+cache rather than in their rows.
+
+With settings.STOCK_LEDGER every stock-tracked item has a counter in the
+STOCK_LEDGER_CACHE cache, which must be shared by the server processes as the
+default one is for OpenGenfri.catalog (e.g. memcached), and must never evict
+the counters: one missing is loaded again from its item, which lags behind
+by the changes not flushed by the other processes. Bills take their items
+from the counters, an atomic decrement each, and never lock the rows of the
+items: a thread of each process writes the changes to Item.quantity in
+batches, every STOCK_LEDGER_FLUSH_INTERVAL seconds. The counters are the
+authority, and Item.quantity trails them by the changes not flushed yet.
+
+A reservation is taken before the bill is written and confirmed when its
+transaction commits; one neither confirmed nor released within
+RESERVATION_TIMEOUT seconds belonged to a transaction rolled back, and its
+stock is given back.
+
+The confirmed changes are appended to the STOCK_LEDGER_JOURNAL file, and each
+flush records the last change it wrote in the StockFlush row of its process,
+in the same transaction. After a crash "manage.py recover_stock", run with the
+server stopped, writes the changes left in the journal and loads the counters
+again from the items. The journal is not synced to disk, and survives the
+crash of a process but not the one of the machine.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, When
+from models import Item, StockFlush
+import catalog
+
+
+logger = logging.getLogger(__name__)
+
+COUNTER_KEY = 'openpif:stock:{}'
+# Added to the counters, which memcached can't decrement below zero
+OFFSET = 2 ** 40
+RESERVATION_TIMEOUT = 60
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+_items = (None, None)
+_items_lock = threading.Lock()
+
+
+def enabled():
+    return settings.STOCK_LEDGER
+
+
+def items(names):
+    """Returns the items, by name, among ``names``.
+
+    The items are read once per catalog version and shared by all the
+    requests, which must not modify them, so that committing a bill doesn't
+    read from the database before writing to it."""
+    by_name = _by_name()
+    return {name: by_name[name] for name in names if name in by_name}
+
+
+def prefetch():
+    """Reads the items for items() if the catalog changed, when the ledger is
+    enabled: called before a transaction, which on SQLite must write before
+    reading."""
+    if enabled():
+        _by_name()
+
+
+def reserve(requested, items):
+    """Takes the ``requested`` quantities of ``items``, both by name, from
+    their counters. Returns a ``(errors, reservation)`` pair: if any item
+    hasn't enough stock nothing is taken, and ``errors`` lists the
+    ``(name, quantity)`` pairs of the missing ones, as
+    dbmanager._reserve_stock() does. Otherwise the reservation must be passed
+    to confirm() once the bill is committed, or to release()."""
+    taken = {}
+    errors = []
+    for name, qty in sorted(requested.items()):
+        item = items[name]
+        if item.quantity is None:
+            continue
+        left = _add(item.id, -qty)
+        if left is None:
+            continue
+        if left < 0:
+            _add(item.id, qty)
+            errors.append((name, left + qty))
+        else:
+            taken[item.id] = qty
+    if errors:
+        for item_id, qty in taken.items():
+            _add(item_id, qty)
+        return errors, None
+    return [], _get_ledger().reserve(taken)
+
+
+def confirm(reservation):
+    """Records the stock taken by a reservation as sold."""
+    _get_ledger().confirm(reservation)
+
+
+def release(reservation):
+    """Gives back the stock taken by a reservation, if any."""
+    if reservation is not None:
+        _get_ledger().release(reservation)
+
+
+def restock(quantities):
+    """Gives back the quantities of the items, by id, of deleted bills: must
+    be called once their deletion is committed."""
+    tracked = set(item.id for item in _by_name().values()
+                  if item.quantity is not None)
+    deltas = {}
+    for item_id, qty in quantities.items():
+        if item_id in tracked and _add(item_id, qty) is not None:
+            deltas[item_id] = qty
+    if deltas:
+        _get_ledger().record(deltas)
+
+
+def quantities(stored):
+    """Returns ``stored``, the quantities of the items by id as read from the
+    database, with those of the counters instead when the ledger is
+    enabled."""
+    if not enabled():
+        return stored
+    keys = {COUNTER_KEY.format(item_id): item_id
+            for item_id, quantity in stored.items() if quantity is not None}
+    current = dict(stored)
+    for key, value in _cache().get_many(keys.keys()).items():
+        current[keys[key]] = value - OFFSET
+    return current
+
+
+def item_saved(item, before, after):
+    """Applies the edit of the stock of ``item`` to ``after`` to its counter,
+    once it is committed. The edit is taken as a change from ``before``, the
+    stock read from the database, which the flushes keep changing by the
+    bills meanwhile."""
+    transaction.on_commit(lambda: _adjust(item.id, before, after))
+
+
+def item_deleted(item):
+    transaction.on_commit(
+        lambda: _cache().delete(COUNTER_KEY.format(item.id)))
+
+
+def flush():
+    """Writes the changes of this process to the items, and returns the
+    number of items written."""
+    return _get_ledger().flush()
+
+
+def close():
+    """Flushes the changes of this process and stops its flushing thread."""
+    global _ledger
+    with _ledger_lock:
+        ledger, _ledger = _ledger, None
+    if ledger is not None:
+        ledger.close()
+
+
+def reload():
+    """Sets the counters to the stock of the items, as stored."""
+    stored = list(Item.objects.values_list('id', 'quantity'))
+    counters = _cache()
+    counters.set_many({COUNTER_KEY.format(item_id): OFFSET + quantity
+                       for item_id, quantity in stored
+                       if quantity is not None}, None)
+    counters.delete_many([COUNTER_KEY.format(item_id)
+                          for item_id, quantity in stored if quantity is None])
+
+
+def recover():
+    """Writes to the items the changes of the journal which weren't flushed,
+    empties the journal and reloads the counters. Must run while no server
+    process uses the ledger. Returns the number of changes written."""
+    path = settings.STOCK_LEDGER_JOURNAL
+    flushed = dict(StockFlush.objects.values_list('process', 'seq'))
+    deltas = {}
+    last = {}
+    changes = 0
+    if os.path.exists(path):
+        with open(path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn by the crash while being written
+                    continue
+                process, seq = entry['process'], entry['seq']
+                if seq <= flushed.get(process, 0):
+                    continue
+                changes += 1
+                last[process] = max(seq, last.get(process, 0))
+                for item_id, qty in entry['stock'].items():
+                    deltas[int(item_id)] = deltas.get(int(item_id), 0) + qty
+    with transaction.atomic():
+        _write(deltas)
+        for process, seq in last.items():
+            StockFlush.objects.update_or_create(process=process,
+                                                defaults={'seq': seq})
+    open(path, 'w').close()
+    StockFlush.objects.all().delete()
+    reload()
+    catalog.items_changed(deltas.keys())
+    return changes
+
+
+def _cache():
+    return caches[settings.STOCK_LEDGER_CACHE]
+
+
+def _by_name():
+    global _items
+    current = catalog.catalog_version()
+    items_version, by_name = _items
+    if items_version != current:
+        with _items_lock:
+            items_version, by_name = _items
+            if items_version != current:
+                by_name = {item.name: item for item in
+                           Item.objects.select_related('category')}
+                _items = (current, by_name)
+    return by_name
+
+
+def _add(item_id, delta):
+    """Adds ``delta`` to the counter of the item, loading it from the item
+    first if missing. Returns the stock left, or None if the item isn't
+    stock-tracked."""
+    key = COUNTER_KEY.format(item_id)
+    try:
+        return _cache().incr(key, delta) - OFFSET
+    except ValueError:
+        quantity = Item.objects.filter(pk=item_id).values_list(
+            'quantity', flat=True).first()
+        if quantity is None:
+            return None
+        logger.warning('Stock counter of item {} loaded again'.format(
+            item_id))
+        if _ledger is not None:
+            quantity += _ledger.pending.get(item_id, 0)
+        _cache().add(key, OFFSET + quantity, None)
+        return _cache().incr(key, delta) - OFFSET
+
+
+def _adjust(item_id, before, after):
+    key = COUNTER_KEY.format(item_id)
+    if after is None:
+        _cache().delete(key)
+    elif before is None:
+        _cache().set(key, OFFSET + after, None)
+    elif after != before:
+        _add(item_id, after - before)
+
+
+def _write(deltas):
+    if deltas:
+        Item.objects.filter(pk__in=deltas.keys(),
+                            quantity__isnull=False).update(quantity=Case(
+                                *[When(pk=pk, then=F('quantity') + delta)
+                                  for pk, delta in deltas.items()],
+                                default=F('quantity'),
+                                output_field=IntegerField()))
+
+
+def _get_ledger():
+    global _ledger
+    with _ledger_lock:
+        # A forked process starts a ledger of its own
+        if _ledger is None or _ledger.pid != os.getpid():
+            _ledger = _Ledger()
+        return _ledger
+
+
+class _Ledger(object):
+    """The reservations and the changes of a process not flushed yet, and
+    the thread flushing them."""
+    def __init__(self):
+        self.pid = os.getpid()
+        self.process = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.reservations = {}
+        self.pending = {}
+        self.seq = 0
+        self.flushed_seq = 0
+        self.journal = os.open(settings.STOCK_LEDGER_JOURNAL,
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='Stock ledger')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def reserve(self, deltas):
+        reservation = (uuid.uuid4().hex, deltas)
+        with self.lock:
+            self.reservations[reservation[0]] = reservation, time.time()
+        return reservation
+
+    def confirm(self, reservation):
+        key, deltas = reservation
+        with self.lock:
+            expired = self.reservations.pop(key, None) is None
+        if expired:
+            # Given back by expire(): take it again
+            logger.error('Stock reservation confirmed after {} s, the stock '
+                         'might be oversold'.format(RESERVATION_TIMEOUT))
+            for item_id, qty in deltas.items():
+                _add(item_id, -qty)
+        self.record({item_id: -qty for item_id, qty in deltas.items()})
+
+    def release(self, reservation):
+        key, deltas = reservation
+        with self.lock:
+            if self.reservations.pop(key, None) is None:
+                return
+        for item_id, qty in deltas.items():
+            _add(item_id, qty)
+
+    def record(self, deltas):
+        """Journals a change of the stock, and queues it for the flush."""
+        with self.lock:
+            self.seq += 1
+            os.write(self.journal, json.dumps({'process': self.process,
+                                               'seq': self.seq,
+                                               'stock': deltas}) + '\n')
+            for item_id, delta in deltas.items():
+                self.pending[item_id] = self.pending.get(item_id, 0) + delta
+
+    def expire(self):
+        deadline = time.time() - RESERVATION_TIMEOUT
+        with self.lock:
+            expired = [reservation for reservation, taken
+                       in self.reservations.values() if taken < deadline]
+            for key, _ in expired:
+                del self.reservations[key]
+        for _, deltas in expired:
+            for item_id, qty in deltas.items():
+                _add(item_id, qty)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                seq = self.seq
+            if seq == self.flushed_seq:
+                return 0
+            try:
+                with transaction.atomic():
+                    _write(pending)
+                    if not StockFlush.objects.filter(
+                            process=self.process).update(seq=seq):
+                        StockFlush.objects.create(process=self.process,
+                                                  seq=seq)
+            except Exception:
+                with self.lock:
+                    for item_id, delta in pending.items():
+                        self.pending[item_id] = (
+                            self.pending.get(item_id, 0) + delta)
+                raise
+            self.flushed_seq = seq
+            return len(pending)
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Error flushing the stock')
+        os.close(self.journal)
+
+    def _run(self):
+        while not self.stopped.wait(settings.STOCK_LEDGER_FLUSH_INTERVAL):
+            try:
+                self.expire()
+                self.flush()
+            except Exception:
+                logger.exception('Error flushing the stock')
+            finally:
+                connection.close()
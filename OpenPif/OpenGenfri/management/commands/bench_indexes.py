@@ -0,0 +1,157 @@
+import os
+import random
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from OpenGenfri.fulltext import search_bills
+from OpenGenfri.models import Bill, BillItem, BillItemExtra, Category, Item
+from OpenGenfri.dbmanager import sales_report, rebuild_sales_rollup
+
+
+# Migration before and after the indexes
+WITHOUT_INDEXES = '0005_category_printer'
+WITH_INDEXES = '0007_bill_search'
+
+SERVERS = ['cassa{}'.format(n) for n in range(1, 13)]
+NAMES = ['Mario', 'Luigi', 'Anna', 'Giulia', 'Marco', 'Sara', 'Paolo',
+         'Chiara', 'Luca', 'Marta', 'Franco', 'Elena', 'Darozzo', 'Lonfo']
+DAYS = 30
+START = datetime(2016, 6, 1, 16, tzinfo=timezone.utc)
+
+
+class Command(BaseCommand):
+    help = ('Measures the report and search queries on a synthetic history '
+            'of bills, without and with the indexes of migration {}. It '
+            'runs on its own SQLite database, a temporary one unless --path '
+            'is given, which is filled only if empty.'.format(WITH_INDEXES))
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path')
+        parser.add_argument('--lines', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark runs on SQLite only.')
+        path = options['path'] or tempfile.mktemp(suffix='.sqlite3')
+        name = connection.settings_dict['NAME']
+        connection.close()
+        connection.settings_dict['NAME'] = path
+        try:
+            # Without the query log kept by DEBUG
+            with override_settings(DEBUG=False):
+                self._bench(options)
+        finally:
+            connection.close()
+            connection.settings_dict['NAME'] = name
+            if not options['path']:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+
+    def _bench(self, options):
+        call_command('migrate', verbosity=0)
+        if not Bill.objects.exists():
+            self.stdout.write('Generating {} lines...'.format(
+                options['lines']))
+            self._generate(options['lines'])
+            rebuild_sales_rollup()
+        self.stdout.write('{} bills, {} lines, {} extras'.format(
+            Bill.objects.count(), BillItem.objects.count(),
+            BillItemExtra.objects.count()))
+        call_command('migrate', 'OpenGenfri', WITHOUT_INDEXES, verbosity=0)
+        before = self._measure(options['repeat'])
+        call_command('migrate', 'OpenGenfri', WITH_INDEXES, verbosity=0)
+        after = self._measure(options['repeat'])
+        self.stdout.write('{:<42} {:>10} {:>10}'.format('', 'before',
+                                                         'after'))
+        for (label, seconds), (_, seconds_after) in zip(before, after):
+            self.stdout.write('{:<42} {:>7.1f} ms {:>7.1f} ms'.format(
+                label, seconds * 1000, seconds_after * 1000))
+
+    def _measure(self, repeat):
+        day = START + timedelta(days=DAYS // 2)
+        evening_start = day + timedelta(hours=2, minutes=20)
+        evening_end = day + timedelta(hours=6, minutes=40)
+        servers = SERVERS[:2]
+        queries = [
+            ('report, a week',
+             lambda: sales_report(day, day + timedelta(days=7))),
+            ('report, an evening',
+             lambda: sales_report(evening_start, evening_end)),
+            ('report, an evening, 2 servers',
+             lambda: sales_report(evening_start, evening_end, servers)),
+            ('report check, an evening, 2 servers',
+             lambda: Bill.objects.filter(
+                 deleted_by='', date__gte=evening_start,
+                 date__lte=evening_end, server__in=servers).exists()),
+            ('bills of an evening, by date',
+             lambda: list(Bill.objects.filter(
+                 deleted_by='', date__gte=evening_start,
+                 date__lte=evening_end).order_by('date')[:50])),
+            # As the search view, which counts the bills and reads a page
+            ('search "darozzo", first page and count',
+             lambda: self._search_page('darozzo')),
+            ('search "mario 12", first page and count',
+             lambda: self._search_page('mario 12')),
+            ('catalog items',
+             lambda: list(Item.objects.filter(enabled=True, extra=False,
+                                              category__enabled=True))),
+        ]
+        return [(label, min(timeit.repeat(query, repeat=repeat, number=1)))
+                for label, query in queries]
+
+    def _search_page(self, text):
+        bills = search_bills(text)
+        return bills.count(), list(bills.order_by('-id')[:50])
+
+    def _generate(self, lines):
+        categories = [Category.objects.create(name='Categoria {}'.format(n))
+                      for n in range(8)]
+        items = [Item.objects.create(name='Prodotto {}.{}'.format(c.id, n),
+                                     category=c, price=random.randint(1, 12),
+                                     extra=n >= 8)
+                 for c in categories for n in range(10)]
+        products = [item for item in items if not item.extra]
+        extras = [item for item in items if item.extra]
+        n_bills = lines // 4
+        bill_rows = []
+        line_rows = []
+        extra_rows = []
+        for bill_id in range(1, n_bills + 1):
+            # Evenings from 18:00 to 24:00, Italian time
+            date = START + timedelta(days=random.randrange(DAYS),
+                                     seconds=random.randrange(6 * 3600))
+            bill_rows.append((
+                bill_id, str(random.randrange(1, 60)),
+                '{} {}'.format(random.choice(NAMES), random.randrange(1000)),
+                date.strftime('%Y-%m-%d %H:%M:%S'), 20,
+                random.choice(SERVERS),
+                'admin' if random.random() < 0.02 else ''))
+            for _ in range(4):
+                item = random.choice(products)
+                line_rows.append((len(line_rows) + 1, random.randint(1, 3),
+                                  item.price, '', bill_id, item.category_id,
+                                  item.id))
+                if random.random() < 0.05:
+                    extra = random.choice(extras)
+                    extra_rows.append((1, extra.price, len(line_rows),
+                                       extra.id))
+        cursor = connection.cursor()
+        cursor.executemany(
+            'INSERT INTO {} (id, customer_id, customer_name, date, total, '
+            'server, deleted_by) VALUES (%s, %s, %s, %s, %s, %s, %s)'.format(
+                Bill._meta.db_table), bill_rows)
+        cursor.executemany(
+            'INSERT INTO {} (id, quantity, item_price, note, bill_id, '
+            'category_id, item_id) VALUES (%s, %s, %s, %s, %s, %s, '
+            '%s)'.format(BillItem._meta.db_table), line_rows)
+        cursor.executemany(
+            'INSERT INTO {} (quantity, item_price, billitem_id, item_id) '
+            'VALUES (%s, %s, %s, %s)'.format(BillItemExtra._meta.db_table),
+            extra_rows)
@@ -0,0 +1,126 @@
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from OpenGenfri import journal
+from OpenGenfri.models import Bill, BillItem, Category, Item
+
+
+START = datetime(2016, 6, 1, 16, tzinfo=timezone.utc)
+SERVERS = ['cassa{}'.format(n) for n in range(1, 13)]
+
+
+class Command(BaseCommand):
+    help = ('Measures the journal: the entries written per second by the '
+            'group-committed writer, against a synced write each, and the '
+            'replay of a synthetic journal into an empty temporary SQLite '
+            'database, then again once all its bills are there.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entries', type=int, default=1000000)
+        parser.add_argument('--writes', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark runs on SQLite only.')
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'bench.sqlite3')
+        name = connection.settings_dict['NAME']
+        connection.close()
+        connection.settings_dict['NAME'] = path
+        try:
+            with override_settings(DEBUG=False):
+                self._bench(folder, options)
+        finally:
+            connection.close()
+            connection.settings_dict['NAME'] = name
+            for filename in os.listdir(folder):
+                os.remove(os.path.join(folder, filename))
+            os.rmdir(folder)
+
+    def _bench(self, folder, options):
+        call_command('migrate', verbosity=0)
+        categories = [Category.objects.create(name='Categoria {}'.format(n))
+                      for n in range(8)]
+        items = [Item.objects.create(name='Prodotto {}.{}'.format(c.id, n),
+                                     category=c, price=random.randint(1, 12),
+                                     quantity=30000, extra=n >= 8)
+                 for c in categories for n in range(10)]
+        entries = self._entries(items, options['entries'])
+        self._bench_writes(folder, entries[:options['writes']])
+        path = os.path.join(folder, 'transactions.jsonl')
+        with open(path, 'w') as out:
+            for entry in entries:
+                out.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        del entries
+        self.stdout.write('{} entries, {:.1f} MB'.format(
+            options['entries'], os.path.getsize(path) / 1e6))
+        for label in ('replay, empty database', 'replay, bills there'):
+            start = time.time()
+            counts = journal.replay([path])
+            elapsed = time.time() - start
+            self.stdout.write(
+                '{:<24} {:>7.1f} s {:>9.0f} entries/s ({committed} '
+                'committed, {undone} deleted)'.format(
+                    label, elapsed, counts['entries'] / elapsed, **counts))
+        self.stdout.write('{} bills, {} lines'.format(
+            Bill.objects.count(), BillItem.objects.count()))
+
+    def _bench_writes(self, folder, entries):
+        path = os.path.join(folder, 'writes.jsonl')
+        with override_settings(TRANSACTION_JOURNAL=path):
+            start = time.time()
+            writer = journal._get_writer()
+            for entry in entries:
+                writer.entries.put(entry)
+            journal.flush()
+            grouped = time.time() - start
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        start = time.time()
+        for entry in entries:
+            os.write(fd, json.dumps(entry, separators=(',', ':')) + '\n')
+            os.fsync(fd)
+        synced = time.time() - start
+        os.close(fd)
+        self.stdout.write('{:<24} {:>9.0f} entries/s'.format(
+            'group-committed writes', len(entries) / grouped))
+        self.stdout.write('{:<24} {:>9.0f} entries/s'.format(
+            'synced write each', len(entries) / synced))
+
+    def _entries(self, items, count):
+        products = [item for item in items if not item.extra]
+        extras = [item for item in items if item.extra]
+        entries = []
+        committed = []
+        for bill_id in xrange(1, count + 1):
+            if committed and random.random() < 0.02:
+                undone = committed.pop(random.randrange(len(committed)))
+                entries.append(['undo', undone[2], 'admin',
+                                [[undone[1], [[line[0], line[2]]
+                                              for line in undone[8]]]]])
+                continue
+            date = START + timedelta(seconds=bill_id * 3)
+            lines = []
+            total = 0
+            for item in random.sample(products, random.randint(1, 4)):
+                qty = random.randint(1, 3)
+                line_extras = []
+                if random.random() < 0.05:
+                    extra = random.choice(extras)
+                    line_extras.append([extra.id, 1, str(extra.price)])
+                lines.append([item.id, item.category_id, qty, str(item.price),
+                              '', line_extras])
+                total += item.price * qty
+            entry = ['commit', bill_id, journal._utc(date),
+                     random.choice(SERVERS), 'Cliente {}'.format(bill_id),
+                     str(bill_id % 60), str(total), None, lines]
+            entries.append(entry)
+            committed.append(entry)
+        return entries
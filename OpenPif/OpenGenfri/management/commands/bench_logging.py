@@ -0,0 +1,73 @@
+import logging
+import logging.handlers
+import os
+import shutil
+import tempfile
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from OpenPif.log_handlers import QueueHandler
+
+
+# The handlers measured: no file, the file handlers as they used to be, and
+# as they are now
+SETUPS = [('no file', None, False),
+          ('file, rotated at 1 KB', 1024, False),
+          ('file, rotated at 10 MB', 10 * 1024 * 1024, False),
+          ('queued, rotated at 10 MB', 10 * 1024 * 1024, True)]
+
+
+class Command(BaseCommand):
+    help = ('Measures the time a request spends logging a record, with the '
+            'log file written by the request itself, rotated every KB as it '
+            'used to be or every 10 MB, or queued for the thread of a '
+            'QueueHandler: the mean, the 99th percentile and the worst, and '
+            'the time until the records are written. The log files are '
+            'written in a temporary folder.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=20000)
+        parser.add_argument('--pause', type=float, default=0.0001,
+                            help='Seconds between two records, as between '
+                                 'the requests logging them.')
+
+    def handle(self, *args, **options):
+        folder = tempfile.mkdtemp()
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        try:
+            for n, (label, max_bytes, queued) in enumerate(SETUPS):
+                handler = logging.NullHandler()
+                if max_bytes is not None:
+                    handler = logging.handlers.RotatingFileHandler(
+                        os.path.join(folder, 'bench{}.log'.format(n)),
+                        maxBytes=max_bytes, backupCount=10)
+                    if queued:
+                        handler = QueueHandler(handler)
+                handler.setFormatter(logging.Formatter(
+                    settings.LOGGING['formatters']['verbose']['format']))
+                root.handlers[:] = [handler]
+                self._bench(label, handler, options)
+                handler.close()
+        finally:
+            root.handlers[:] = handlers
+            shutil.rmtree(folder)
+
+    def _bench(self, label, handler, options):
+        logger = logging.getLogger('OpenGenfri.bench')
+        count = options['records']
+        times = []
+        start = time.time()
+        for record in xrange(count):
+            before = time.time()
+            logger.warning('Record %s of the benchmark', record)
+            times.append(time.time() - before)
+            time.sleep(options['pause'])
+        handler.flush()
+        written = time.time() - start
+        times.sort()
+        self.stdout.write(
+            '{:<26} {:>6.1f} us mean, {:>6.1f} us p99, {:>8.1f} us worst, '
+            'written in {:.2f} s'.format(
+                label, sum(times) * 1e6 / count,
+                times[int(count * 0.99)] * 1e6, times[-1] * 1e6, written))
@@ -0,0 +1,87 @@
+import timeit
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from OpenGenfri.models import Bill, BillItem, BillItemExtra, Category, Item
+from easy_pdf.rendering import html_to_pdf
+from OpenGenfri import escpos, tickets
+
+
+class Rollback(Exception):
+    pass
+
+
+def _time(function, number):
+    # Without the query log kept by DEBUG
+    with override_settings(DEBUG=False):
+        seconds = min(timeit.repeat(function, repeat=3, number=number))
+    return seconds * 1000 / number
+
+
+class Command(BaseCommand):
+    help = ('Measures the queries and the time needed to render the HTML of '
+            'the tickets of bills of different sizes, and then the time '
+            'needed to convert it to PDF or to build the ESC/POS tickets. '
+            'The bills are created in a transaction which is then rolled '
+            'back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, nargs='+',
+                            default=[1, 10, 50])
+        parser.add_argument('--categories', type=int, default=8)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                items, extras = self._make_catalog(options['categories'])
+                for lines in options['lines']:
+                    bill = self._make_bill(lines, items, extras)
+                    with CaptureQueriesContext(connection) as queries:
+                        tickets.render_ticket_html(bill.id)
+                    context = tickets.ticket_context(bill.id)
+                    html = tickets.render_ticket_html(bill.id, context)
+                    repeat = options['repeat']
+                    self.stdout.write(
+                        '{:>3} lines: {:>4} queries, html {:7.2f} ms, '
+                        'pdf {:7.2f} ms, escpos {:5.2f} ms'.format(
+                            lines, len(queries),
+                            _time(lambda: tickets.render_ticket_html(
+                                bill.id), repeat),
+                            _time(lambda: html_to_pdf(
+                                html, link_callback=tickets._link_callback),
+                                max(1, repeat // 10)),
+                            _time(lambda: escpos.render_tickets(context),
+                                  repeat)))
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _make_catalog(self, n_categories):
+        items, extras = [], []
+        for c in range(n_categories):
+            category = Category.objects.create(
+                name='Bench category {}'.format(c), printable=c % 2 == 0)
+            for i in range(5):
+                items.append(Item.objects.create(
+                    name='Bench item {}.{}'.format(c, i), category=category,
+                    price=5, quantity=None))
+            extras.append(Item.objects.create(
+                name='Bench extra {}'.format(c), category=category, price=1,
+                quantity=None, extra=True))
+        return items, extras
+
+    def _make_bill(self, lines, items, extras):
+        bill = Bill.objects.create(customer_name='Bench', server='bench',
+                                   total=0)
+        for n in range(lines):
+            item = items[n % len(items)]
+            billitem = BillItem.objects.create(
+                bill=bill, item=item, category=item.category, quantity=1,
+                item_price=item.price)
+            if n % 3 == 0:
+                extra = [e for e in extras
+                         if e.category_id == item.category_id][0]
+                BillItemExtra.objects.create(billitem=billitem, item=extra,
+                                             quantity=1, item_price=1)
+        return bill
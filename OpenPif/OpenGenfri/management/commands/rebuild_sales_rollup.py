@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from OpenGenfri.dbmanager import rebuild_sales_rollup
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the hourly sales rollups used by the report from the '
+            'committed bills. Must be run after the bills are changed '
+            'other than by the tills and the undo of the admin, e.g. in '
+            'the database.')
+
+    def handle(self, *args, **options):
+        rebuild_sales_rollup()
+        self.stdout.write('Sales rollups rebuilt.')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from OpenGenfri import fulltext
+
+
+class Command(BaseCommand):
+    help = ('Recreates the search index of the bills, which is needed after '
+            'a migration that remade the bill table on SQLite.')
+
+    def handle(self, *args, **options):
+        with connection.schema_editor() as schema_editor:
+            fulltext.rebuild_index(schema_editor)
+        self.stdout.write('Search index rebuilt.')
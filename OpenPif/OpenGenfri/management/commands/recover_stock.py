@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from OpenGenfri import ledger
+
+
+class Command(BaseCommand):
+    help = ('Writes to the items the stock changes of the ledger journal '
+            'left unflushed by a crash, and reloads the stock counters from '
+            'the items. Run it with the server stopped.')
+
+    def handle(self, *args, **options):
+        changes = ledger.recover()
+        self.stdout.write('{} stock changes recovered.'.format(changes))
@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand
+from OpenGenfri import journal
+
+
+class Command(BaseCommand):
+    help = ('Replays journal files, in the order given, rebuilding the bills '
+            'and the stock they record: the bills missing are committed, '
+            'the ones deleted are deleted and the stock is updated. Run it '
+            'with the server stopped, after "manage.py recover_stock" when '
+            'the stock ledger is enabled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', metavar='path')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        counts = journal.replay(options['paths'])
+        self.stdout.write(
+            '{entries} entries replayed in {seconds:.1f} s: {committed} bills '
+            'committed, {undone} deleted, {stock} stock edits.'.format(
+                seconds=time.time() - start, **counts))
@@ -0,0 +1,31 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from OpenGenfri.routers import snapshot_sqlite
+
+
+class Command(BaseCommand):
+    help = ('Copies the default SQLite database to the reporting one, once '
+            'or every --interval seconds.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0)
+
+    def handle(self, *args, **options):
+        alias = settings.REPORTING_DATABASE
+        if not alias:
+            raise CommandError('settings.REPORTING_DATABASE is not set.')
+        if (connections[DEFAULT_DB_ALIAS].vendor != 'sqlite' or
+                connections[alias].vendor != 'sqlite'):
+            raise CommandError('Only SQLite databases can be copied, use a '
+                               'replica of the others.')
+        path = connections[alias].settings_dict['NAME']
+        while True:
+            start = time.time()
+            snapshot_sqlite(path)
+            self.stdout.write('Reporting database copied to {} in '
+                              '{:.2f} s.'.format(path, time.time() - start))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, OperationalError
+from django.test.utils import override_settings
+from django.utils import timezone
+from OpenGenfri.models import (Bill, BillItem, CashRollup, Category, Item,
+                               SalesRollup)
+from OpenGenfri.dbmanager import commit_bill, sales_report
+from OpenGenfri import ledger
+
+
+class Command(BaseCommand):
+    help = ('Commits bills for a single item from several threads at once, '
+            'checks that its stock is never oversold and reports the commits '
+            'per second, optionally while another thread keeps computing the '
+            'sales report. The item and its bills are deleted at the end. '
+            'With --ledger the stock is kept by the stock ledger, with a '
+            'journal of its own, instead of the row of the item.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--bills', type=int, default=50,
+                            help='Bills attempted by each thread')
+        parser.add_argument('--stock', type=int, default=200)
+        parser.add_argument('--qty', type=int, default=1,
+                            help='Units of the item in each bill')
+        parser.add_argument('--report', action='store_true',
+                            help='Compute the sales report meanwhile')
+        parser.add_argument('--pragma', action='append', default=[],
+                            metavar='NAME=VALUE',
+                            help='Overrides one of settings.SQLITE_PRAGMAS')
+        parser.add_argument('--ledger', action='store_true',
+                            help='Keep the stock with the stock ledger')
+
+    def handle(self, *args, **options):
+        pragmas = OrderedDict(settings.SQLITE_PRAGMAS)
+        for pragma in options['pragma']:
+            key, _, value = pragma.partition('=')
+            pragmas[key] = value
+        ledger_settings = {}
+        if options['ledger']:
+            journal = tempfile.mktemp(suffix='.journal')
+            ledger_settings = {'STOCK_LEDGER': True,
+                               'STOCK_LEDGER_JOURNAL': journal}
+        # Connect again with the pragmas
+        connection.close()
+        try:
+            with override_settings(SQLITE_PRAGMAS=pragmas.items(),
+                                   **ledger_settings):
+                self._stress(options)
+        finally:
+            if options['ledger']:
+                ledger.close()
+                if os.path.exists(journal):
+                    os.remove(journal)
+
+    def _stress(self, options):
+        name = 'stress-{}'.format(uuid.uuid4().hex[:8])
+        category = Category.objects.create(name=name, printable=False)
+        item = Item.objects.create(name=name, category=category, price=1,
+                                   quantity=options['stock'])
+        user = User(username=name)
+        results = {'committed': 0, 'sold out': 0, 'failed': 0, 'reports': 0}
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def till():
+            reqdata = {'customer_name': name,
+                       'items': [{'name': name, 'qty': options['qty'],
+                                  'notes': '', 'extras': {}}]}
+            try:
+                for _ in range(options['bills']):
+                    output = {'errors': [], 'bill_id': None,
+                              'customer_id': '', 'date': None, 'total': 0}
+                    try:
+                        ledger.prefetch()
+                        with transaction.atomic():
+                            output, bill = commit_bill(output, reqdata, user)
+                        result = 'committed' if bill else 'sold out'
+                    except OperationalError as e:
+                        self.stderr.write(str(e))
+                        result = 'failed'
+                    with lock:
+                        results[result] += 1
+            finally:
+                connection.close()
+
+        def report():
+            try:
+                while not done.is_set():
+                    try:
+                        # Not on whole hours, to read the bills of the last
+                        # hour
+                        sales_report(timezone.now() - timedelta(minutes=90),
+                                     timezone.now())
+                        results['reports'] += 1
+                    except OperationalError as e:
+                        self.stderr.write('Report: {}'.format(e))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=till)
+                   for _ in range(options['threads'])]
+        reporter = threading.Thread(target=report)
+        start = time.time()
+        if options['report']:
+            reporter.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        done.set()
+        if options['report']:
+            reporter.join()
+        try:
+            if options['ledger']:
+                ledger.flush()
+            item.refresh_from_db()
+            sold = BillItem.objects.filter(item=item).count() * options['qty']
+            self.stdout.write(
+                '{committed} committed, {sold out} sold out, {failed} failed'
+                .format(**results))
+            self.stdout.write('{:.1f} commits/s, {:.1f} attempts/s'.format(
+                results['committed'] / elapsed,
+                (results['committed'] + results['sold out'] +
+                 results['failed']) / elapsed))
+            if options['report']:
+                self.stdout.write('{:.1f} reports/s'.format(
+                    results['reports'] / elapsed))
+            self.stdout.write('Stock left: {}, sold: {} of {}'.format(
+                item.quantity, sold, options['stock']))
+            if (item.quantity < 0 or
+                    item.quantity + sold != options['stock'] or
+                    sold != results['committed'] * options['qty']):
+                raise CommandError('Stock oversold or lost')
+        finally:
+            Bill.objects.filter(server=name).delete()
+            SalesRollup.objects.filter(server=name).delete()
+            CashRollup.objects.filter(server=name).delete()
+            item.delete()
+            category.delete()
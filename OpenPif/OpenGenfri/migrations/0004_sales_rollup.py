@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 14:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_rollups(apps, schema_editor):
+    from OpenGenfri.dbmanager import rebuild_sales_rollup
+    rebuild_sales_rollup(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenGenfri', '0003_item_extra'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CashRollup',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('hour', models.DateTimeField()),
+                ('server', models.CharField(max_length=40)),
+                ('bills', models.IntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('hour', models.DateTimeField()),
+                ('server', models.CharField(max_length=40)),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('earn', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('category', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='OpenGenfri.Category')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='extra',
+            field=models.BooleanField(default=False, verbose_name=b'Aggiunta'),
+        ),
+        migrations.AddField(
+            model_name='salesrollup',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='OpenGenfri.Item'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cashrollup',
+            unique_together=set([('hour', 'server')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='salesrollup',
+            unique_together=set([('hour', 'server', 'category', 'item')]),
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
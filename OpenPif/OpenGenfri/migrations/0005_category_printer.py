@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 14:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenGenfri', '0004_sales_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='printer',
+            field=models.CharField(blank=True, max_length=100, verbose_name=b'Stampante'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 14:37
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenGenfri', '0005_category_printer'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='bill',
+            index_together=set([('deleted_by', 'server', 'date'), ('deleted_by', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='item',
+            index_together=set([('enabled', 'extra', 'category')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from OpenGenfri import fulltext
+
+
+def create_search_index(apps, schema_editor):
+    fulltext.create_index(schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    fulltext.drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenGenfri', '0006_bill_item_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
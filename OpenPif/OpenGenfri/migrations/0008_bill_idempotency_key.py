@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 15:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from OpenGenfri import fulltext
+
+
+def rebuild_search_index(apps, schema_editor):
+    # SQLite remakes the bill table to add the field, dropping the triggers
+    # which keep the search index in sync
+    if schema_editor.connection.vendor == 'sqlite':
+        fulltext.rebuild_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenGenfri', '0007_bill_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, rebuild_search_index),
+        migrations.AddField(
+            model_name='bill',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(rebuild_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 15:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenGenfri', '0008_bill_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockFlush',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('process', models.CharField(max_length=32, unique=True)),
+                ('seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
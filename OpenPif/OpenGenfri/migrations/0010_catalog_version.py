@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.db import migrations, models
+
+
+def create_version(apps, schema_editor):
+    # Started from the current time in milliseconds, so that it never goes
+    # back to a version snapshotted before
+    CatalogVersion = apps.get_model('OpenGenfri', 'CatalogVersion')
+    CatalogVersion.objects.create(pk=1, version=int(time.time() * 1000))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenGenfri', '0009_stock_flush'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
@@ -23,6 +23,9 @@ class Category(models.Model):
     priority = models.PositiveSmallIntegerField(default=10)
     enabled = models.BooleanField(default=True)
     printable = models.BooleanField(default=True)
+    # Thermal printer of the station, see escpos.printer_for
+    printer = models.CharField(max_length=100, blank=True,
+                               verbose_name='Stampante')
 
     class Meta:
         verbose_name_plural = 'Categories'
@@ -50,6 +53,21 @@ class Item(models.Model):
     is_available.boolean = True
     is_available.short_description = 'Available?'
 
+    class Meta:
+        # The enabled items and extras of the catalog
+        index_together = [('enabled', 'extra', 'category')]
+
+    def save(self, *args, **kwargs):
+        # With the stock ledger the pre_save signal writes the stock as a
+        # change of the one stored (see OpenGenfri.signals): the item keeps
+        # its own, even if the save fails
+        quantity = self.quantity
+        try:
+            super(Item, self).save(*args, **kwargs)
+        finally:
+            self.quantity = quantity
+            self.__dict__.pop('_edited_quantity', None)
+
     def __unicode__(self):
         return self.name
 
@@ -63,6 +81,16 @@ class Bill(models.Model):
     total = models.DecimalField(max_digits=12, decimal_places=2)
     server = models.CharField(max_length=40)
     deleted_by = models.CharField(max_length=40, blank=True)
+    # Key sent by the till with the bill, so that its retries don't commit it
+    # twice
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True,
+                                       unique=True, editable=False)
+
+    class Meta:
+        # The committed bills of a period, optionally of some servers, read
+        # by the report and listed by date
+        index_together = [('deleted_by', 'date'),
+                          ('deleted_by', 'server', 'date')]
 
     def is_committed(self):
         if self.deleted_by == '':
@@ -107,3 +135,51 @@ class BillItemExtra(models.Model):
     @property
     def total_cost(self):
         return self.quantity * self.item_price * self.billitem.quantity
+
+
+# Hourly rollups of the sales, updated together with the bills by dbmanager so
+# that reports don't need to go through the whole bill history. They can be
+# rebuilt from the bills with the rebuild_sales_rollup management command.
+
+class SalesRollup(models.Model):
+    id = models.AutoField(primary_key=True)
+    hour = models.DateTimeField()
+    server = models.CharField(max_length=40)
+    category = models.ForeignKey('Category', null=True,
+                                 on_delete=models.SET_NULL)
+    item = models.ForeignKey('Item', on_delete=models.DO_NOTHING)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    earn = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('hour', 'server', 'category', 'item')
+
+
+class CashRollup(models.Model):
+    id = models.AutoField(primary_key=True)
+    hour = models.DateTimeField()
+    server = models.CharField(max_length=40)
+    bills = models.IntegerField(default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('hour', 'server')
+
+
+# Last change of the stock ledger journal written to the items by each server
+# process, in the transaction of the write (see OpenGenfri.ledger).
+
+class StockFlush(models.Model):
+    id = models.AutoField(primary_key=True)
+    process = models.CharField(max_length=32, unique=True)
+    seq = models.BigIntegerField(default=0)
+
+
+# Version of the items and categories, bumped by their edits in the same
+# transaction, from which every server process knows when to rebuild its
+# catalog snapshot (see OpenGenfri.catalog).
+
+class CatalogVersion(models.Model):
+    id = models.AutoField(primary_key=True)
+    version = models.BigIntegerField(default=0)
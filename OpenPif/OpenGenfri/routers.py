@@ -0,0 +1,74 @@
+"""
+Routing of the back office reads to a reporting database.
+
+The report, search and bill pages, and the bill list of the admin, read from
+settings.REPORTING_DATABASE when it is set, so that they don't compete with
+the tills for the default database. It can be a replica of the default
+database or, with SQLite, a copy of it refreshed by the snapshot_reporting
+command. Everything else, and every write, uses the default database.
+"""
+import os
+import sqlite3
+import threading
+from functools import wraps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+_local = threading.local()
+
+
+class Reporting(object):
+    """Sends the reads of the current thread to the reporting database, as a
+    context manager or as a decorator of views."""
+    def __enter__(self):
+        _local.depth = getattr(_local, 'depth', 0) + 1
+
+    def __exit__(self, *exc_info):
+        _local.depth -= 1
+
+    def __call__(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with self:
+                return view(*args, **kwargs)
+        return wrapper
+
+reporting = Reporting()
+
+
+class ReportingRouter(object):
+    def db_for_read(self, model, **hints):
+        if getattr(_local, 'depth', 0) and settings.REPORTING_DATABASE:
+            return settings.REPORTING_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Even for the objects read from the reporting database
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.REPORTING_DATABASE:
+            return False
+        return None
+
+
+def snapshot_sqlite(path):
+    """Atomically replaces the SQLite database at ``path`` with a copy of the
+    default one."""
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connections[DEFAULT_DB_ALIAS].cursor().execute('VACUUM INTO %s',
+                                                   [tmp_path])
+    # In WAL mode the readers would leave a -wal file next to the copy, which
+    # doesn't belong to the next one
+    snapshot = sqlite3.connect(tmp_path)
+    try:
+        snapshot.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        snapshot.close()
+    os.rename(tmp_path, path)
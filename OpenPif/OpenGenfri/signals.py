@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+from models import Item, Category
+import catalog
+import fulltext
+import journal
+import ledger
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def item_changed(sender, instance, **kwargs):
+    catalog.items_changed([instance.pk])
+    catalog.catalog_changed()
+
+
+@receiver(pre_save, sender=Item)
+def item_saving(sender, instance, **kwargs):
+    """Reads the stock of the item before its edit, for the ledger and the
+    journal. With the ledger the edit is written as a change of the stock
+    stored, as it is applied to the counter: a flush committed between the
+    read and the write is kept, and Item.save() puts the stock edited back
+    on the item."""
+    if instance.pk is not None and (ledger.enabled() or journal.enabled()):
+        before = Item.objects.filter(pk=instance.pk).values_list(
+            'quantity', flat=True).first()
+        instance._stored_quantity = before
+        if (ledger.enabled() and before is not None
+                and isinstance(instance.quantity, (int, long))):
+            instance._edited_quantity = instance.quantity
+            instance.quantity = F('quantity') + (instance.quantity - before)
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, **kwargs):
+    before = getattr(instance, '_stored_quantity', None)
+    after = getattr(instance, '_edited_quantity', instance.quantity)
+    if ledger.enabled():
+        ledger.item_saved(instance, before, after)
+    journal.stock_changed(instance, before, after)
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    if ledger.enabled():
+        ledger.item_deleted(instance)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    catalog.items_changed()
+    catalog.catalog_changed()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Sets settings.SQLITE_PRAGMAS on the new SQLite connections, and has
+    them read the search index."""
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    # The migrations remake the tables renaming them, which since SQLite 3.26
+    # also points the foreign keys of the other tables to the old copy
+    cursor.execute('PRAGMA legacy_alter_table = ON')
+    for pragma, value in settings.SQLITE_PRAGMAS:
+        if (pragma == 'journal_mode' and
+                connection.alias == settings.REPORTING_DATABASE):
+            # Reporting copies are never written, and replaced as a whole
+            continue
+        cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+    fulltext.prepare_connection(connection)
@@ -7,7 +7,25 @@ function OrderModel () {
         /** @type {Object[]} The store. An object formatted as { id_item : { "category" : id_category, "id" : id_item, "name" : "item_name", "price" : item_price, "qty" : item_ordered_qty, "notes" : item_notes } } */
         aStore      = [],
         /** @type {Object} The categories object formatted as { id_number : { "id" : number, "name" : string, "priority" : number } */
-        hCategories = {};
+        hCategories = {},
+        /** @type {Number} The last stock version received from the server. */
+        nVersion    = 0,
+        /** @type {?String} The idempotency key of the bill being committed, sent again by its retries. */
+        sBillKey    = null,
+        /** @type {Number} The timeout of a commit in milliseconds, after which it's retried. */
+        COMMIT_TIMEOUT     = 5 * 1000,
+        /** @type {Number} The retries of a commit before giving up. */
+        COMMIT_RETRIES     = 3,
+        /** @type {Number} The delay before retrying a commit in milliseconds. */
+        COMMIT_RETRY_DELAY = 500,
+        /** @type {String} The localStorage key of the bills queued while offline. */
+        PENDING_BILLS      = 'pif.pendingBills',
+        /** @type {Number} The interval between two syncs of the queued bills in milliseconds. */
+        SYNC_INTERVAL      = 30 * 1000,
+        /** @type {Number} The bills sent by a request of a sync, as many as the server commits at once. */
+        SYNC_CHUNK         = 50,
+        /** @type {Boolean} Whether a sync of the queued bills is running. */
+        bSyncing           = false;
 
     /**
      * Add a product to the store.
@@ -251,15 +269,27 @@ function OrderModel () {
     };
 
     /**
-     * Commit the bill to the server.
+     * Empty the bill, for the next one.
+     */
+    that.clearBill = function () {
+        aStore.length = 0;
+        sBillKey = null;
+        triggerAddToBill();
+    };
+
+    /**
+     * Commit the bill to the server. When the server can't be reached the bill is queued, to be synced when it's
+     * back.
      * @param {String}      sCustomerName The customer name.
      * @param {AjaxSuccess} fnSuccess     The success callback.
      * @param {AjaxFailure} fnFailure     The failure callback.
+     * @param {Function}    [fnQueued]    The callback of the bills queued, instead of fnFailure.
      */
-    that.commitBill = function (sCustomerName, fnSuccess, fnFailure) {
+    that.commitBill = function (sCustomerName, fnSuccess, fnFailure, fnQueued) {
         var hData = {
-            customer_name : sCustomerName,
-            items         : []
+            customer_name   : sCustomerName,
+            idempotency_key : getBillKey(),
+            items           : []
         };
 
         $.each(aStore, function (nIdx, hProduct) {
@@ -271,17 +301,194 @@ function OrderModel () {
             });
         });
 
+        postBill(JSON.stringify(hData), COMMIT_RETRIES, fnSuccess, function (jqXHR, sStatus) {
+            if (fnQueued && (sStatus === 'timeout' || jqXHR.status === 0)) {
+                queueBill(hData);
+                fnQueued(hData);
+            } else {
+                fnFailure(jqXHR, sStatus);
+            }
+        });
+    };
+
+    /**
+     * @returns {Object[]} The bills queued while offline.
+     */
+    that.getPendingBills = function () {
+        try {
+            return JSON.parse(window.localStorage.getItem(PENDING_BILLS)) || [];
+        } catch (e) {
+            return [];
+        }
+    };
+
+    function setPendingBills (aBills) {
+        window.localStorage.setItem(PENDING_BILLS, JSON.stringify(aBills));
+    }
+
+    function queueBill (hData) {
+        var aBills = that.getPendingBills();
+
+        aBills.push(hData);
+        setPendingBills(aBills);
+    }
+
+    /**
+     * Send the queued bills to the server, SYNC_CHUNK at a time. The bills answered are removed from the queue, the
+     * others are kept for the next sync.
+     * @fires OrderModel#syncedBills
+     */
+    that.syncPendingBills = function () {
+        if (bSyncing || that.getPendingBills().length === 0) {
+            return;
+        }
+        bSyncing = true;
+        syncChunk({});
+    };
+
+    /**
+     * Send the first SYNC_CHUNK queued bills not sent yet by this sync, then the next ones.
+     * @param {Object} hSent The idempotency keys of the bills sent by this sync.
+     */
+    function syncChunk (hSent) {
+        var aBills = $.grep(that.getPendingBills(), function (hBill) {
+            return !hSent[hBill.idempotency_key];
+        }).slice(0, SYNC_CHUNK);
+
+        if (aBills.length === 0) {
+            bSyncing = false;
+            return;
+        }
+        $.each(aBills, function (nIdx, hBill) {
+            hSent[hBill.idempotency_key] = true;
+        });
         $.pif.ajaxCall({
-            url    : '/webpos/commit/',
-            params : JSON.stringify(hData)
-        }, fnSuccess, fnFailure);
+            url    : '/webpos/sync/',
+            params : JSON.stringify({bills : aBills})
+        }, function (hResponse) {
+            var hAnswered = {};
+
+            $.each(hResponse.results, function (nIdx, hResult) {
+                hAnswered[hResult.idempotency_key] = true;
+            });
+            // Bills queued during the sync stay
+            setPendingBills($.grep(that.getPendingBills(), function (hBill) {
+                return !hAnswered[hBill.idempotency_key];
+            }));
+            /**
+             * @event OrderModel#syncedBills
+             * @type {Object[]} The results, each as answered by the commit of a single bill.
+             */
+            that.trigger('syncedBills', hResponse.results);
+            syncChunk(hSent);
+        }, function () {
+            bSyncing = false;
+        });
+    }
+
+    /**
+     * Sync the queued bills now, when the browser is back online and periodically.
+     */
+    that.listenOnline = function () {
+        that.syncPendingBills();
+        $(window).on('online', that.syncPendingBills);
+        setInterval(that.syncPendingBills, SYNC_INTERVAL);
     };
 
+    /**
+     * Post a bill, retrying it when the server doesn't answer in time. The idempotency key of the bill makes the
+     * retries safe: the server answers those of a committed bill without committing it again.
+     */
+    function postBill (sData, nRetries, fnSuccess, fnFailure) {
+        $.pif.ajaxCall({
+            url     : '/webpos/commit/',
+            params  : sData,
+            timeout : COMMIT_TIMEOUT
+        }, fnSuccess, function (jqXHR, sStatus) {
+            if (nRetries > 0 && (sStatus === 'timeout' || jqXHR.status === 0 || jqXHR.status >= 500)) {
+                setTimeout(function () {
+                    postBill(sData, nRetries - 1, fnSuccess, fnFailure);
+                }, COMMIT_RETRY_DELAY);
+            } else {
+                fnFailure(jqXHR, sStatus);
+            }
+        });
+    }
+
+    /**
+     * The key is generated with the first commit of the bill and kept by the following ones, until the page is
+     * reloaded for the next bill.
+     * @returns {String}
+     */
+    function getBillKey () {
+        var aBytes;
+
+        if (!sBillKey) {
+            if (window.crypto && window.crypto.getRandomValues) {
+                aBytes = window.crypto.getRandomValues(new Uint8Array(16));
+            } else {
+                aBytes = $.map(new Array(16), function () {
+                    return Math.floor(Math.random() * 256);
+                });
+            }
+            sBillKey = $.map(aBytes, function (nByte) {
+                return (nByte + 0x100).toString(16).substr(1);
+            }).join('');
+        }
+        return sBillKey;
+    }
+
+    /**
+     * Ask the server for the items changed since the last version received.
+     */
     that.getUpdates = function () {
         $.pif.ajaxCall({
-            url : '/webpos/refresh/'
+            url    : '/webpos/refresh/',
+            params : {version : nVersion}
         }, function (hResponse) {
-            that.trigger('refreshButtons', hResponse);
+            // Nothing changed (304)
+            if (hResponse) {
+                receiveUpdates(hResponse);
+            }
         });
     };
-}
\ No newline at end of file
+
+    /**
+     * Listen to the stock updates pushed by the server when it streams them, falling back to polling them when
+     * either the browser or the server can't.
+     * @param {Number}  nPollInterval The polling interval in milliseconds.
+     * @param {Boolean} bStream       Whether the server streams the updates.
+     */
+    that.listenUpdates = function (nPollInterval, bStream) {
+        var hSource;
+
+        if (!bStream || !window.EventSource) {
+            setInterval(that.getUpdates, nPollInterval);
+            return;
+        }
+        hSource = new EventSource('/webpos/stock-events/?version=' + nVersion);
+        hSource.onmessage = function (evt) {
+            receiveUpdates(JSON.parse(evt.data));
+        };
+        hSource.onerror = function () {
+            // The browser retries by itself unless the server refused the stream
+            if (hSource.readyState === EventSource.CLOSED) {
+                setInterval(that.getUpdates, nPollInterval);
+            }
+        };
+    };
+
+    /**
+     * @fires OrderModel#refreshButtons
+     */
+    function receiveUpdates (hResponse) {
+        nVersion = hResponse.version;
+        /**
+         * @event OrderModel#refreshButtons
+         * @type {Object}
+         * @property {Object}   items   The changed items formatted as { "item_name" : [quantity, price] }.
+         * @property {String[]} removed The names of the items no longer available.
+         */
+        that.trigger('refreshButtons', hResponse);
+    }
+}
@@ -73,6 +73,7 @@ function orderPresenter (hModel) {
         fnAttachEvents    = function () {
             hMod.on('addToBill', addToBill);
             hMod.on('refreshButtons', refreshButtons);
+            hMod.on('syncedBills', syncedBills);
 
             ref.$CategoryContainer.on('click touch', 'a', onClickBtnCategory);
             ref.$ProductsContainer.on('click touch', ".big-btn", onClickBtnProduct);
@@ -448,9 +449,33 @@ function orderPresenter (hModel) {
 
         hMod.commitBill(ref.$NameInput.val(), fnAjaxSuccess, function () {
             showAlert("<p>Errore di comunicazione col server</p>Ritenta o chiama un tecnico");
+        }, function () {
+            // The page can't be reloaded while offline
+            hMod.clearBill();
+            ref.$NameInput.val('');
+            showAlert("<p>Server non raggiungibile</p>Il conto è stato salvato e verrà inviato al ritorno della connessione");
         });
     }
 
+    /**
+     * Report the queued bills the server refused.
+     * @param {Object[]} aResults The results of the sync.
+     */
+    function syncedBills (aResults) {
+        var aRefused = [];
+
+        $.each(aResults, function (nIdx, hResult) {
+            if (!hResult.billid) {
+                aRefused.push(hResult.error || $.map(hResult.errors, function (nQty, sName) {
+                    return nQty + ' ' + sName;
+                }).join('; '));
+            }
+        });
+        if (aRefused.length) {
+            showAlert("<p>Conti salvati offline non accettati</p>" + aRefused.join('<br>'));
+        }
+    }
+
     function disableEvent (evt) {
         evt.preventDefault();
     }
@@ -470,14 +495,9 @@ function orderPresenter (hModel) {
         return hCat;
     }
 
-    function setUploadLoop () {
-        return setInterval(function () {
-            hMod.getUpdates();
-        }, 1000);// 1 s
-    }
-
-    function refreshButtons (hItems) {
-        var sName,
+    function refreshButtons (hUpdates) {
+        var hItems = hUpdates.items,
+            sName,
             aValues,
             nQty,
             $Button,
@@ -496,16 +516,20 @@ function orderPresenter (hModel) {
                 elButton.dataset.badge = nQty;
                 $Button.toggleClass('disabled', nQty === 0);
             } else {
-                $Button.removeClass('badge');
+                $Button.removeClass('badge disabled');
                 delete elButton.dataset.badge
             }
         }
+        $.each(hUpdates.removed, function (nIdx, sRemoved) {
+            $("[data-name='" + sRemoved + "']").addClass('disabled');
+        });
     }
 
     fnAttachEvents();
 
     hMod.setCategories(getCategories());
-    setUploadLoop();
+    hMod.listenUpdates(1000, $("main").data("stock-events"));// 1 s
+    hMod.listenOnline();
 }
 
 new orderPresenter(new OrderModel());
@@ -1,7 +1,43 @@
-from django.test import TestCase
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import skipUnless
+from decimal import Decimal
+from StringIO import StringIO
+from django.core.cache import cache, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.db.models.signals import pre_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.contrib.auth.models import User
-from models import Item, Bill, BillItem, BillItemExtra, Category
-from dbmanager import commit_bill, undo_bill
+from django.utils import timezone
+from models import (Item, Bill, BillItem, BillItemExtra, Category, StockFlush,
+                    SalesRollup, CashRollup, CatalogVersion)
+from OpenPif.log_handlers import mk_log_folder_handler
+import catalog
+import dbmanager
+import escpos
+import export
+import fulltext
+import journal
+import ledger
+import routers
+import tickets
+import views
+from dbmanager import (commit_bill, undo_bill, undo_bills, sales_report,
+                       rebuild_sales_rollup)
 
 
 class BillTestCase(TestCase):
@@ -149,6 +185,177 @@ class BillTestCase(TestCase):
         self.assertTrue(result['errors']['Pizza Margherita'] == 5)
         self.assertTrue(result['errors']['Peperoni'] == 10)
 
+    def _bill_queries(self, lines):
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [
+                       {'name': 'Coca Cola',
+                        'qty': 1,
+                        'notes': '',
+                        'extras': {'Peperoni': {'qty': 1}},
+                       } for _ in range(lines)]
+                  }
+        with CaptureQueriesContext(connection) as queries:
+            result, billhd = commit_bill(dict(self.output), reqdata,
+                                         self.lonfo)
+        self.assertEqual(result['errors'], {})
+        self.assertEqual(billhd.billitem_set.count(), lines)
+        self.assertEqual(BillItemExtra.objects.filter(
+            billitem__bill=billhd).count(), lines)
+        return len(queries)
+
+    def test_commit_bill_queries(self):
+        self._bill_queries(1)  # Creates the rollups for this hour
+        self.assertEqual(self._bill_queries(1), self._bill_queries(5))
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 4)
+        self.assertEqual(Item.objects.get(name='Peperoni').quantity, 3)
+
+    def test_commit_bill_stale_stock(self):
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [
+                       {'name': 'Coca Cola',
+                        'qty': 3,
+                        'notes': '',
+                        'extras': {},
+                       },
+                       {'name': 'Acqua',
+                        'qty': 2,
+                        'notes': '',
+                        'extras': {},
+                       },
+                   ]
+                  }
+        # Another till sells the last bottles of water just before this bill
+        # takes its stock
+        requested_stock = dbmanager._requested_stock
+
+        def _requested_stock(reqdata):
+            Item.objects.filter(name='Acqua').update(quantity=1)
+            return requested_stock(reqdata)
+        dbmanager._requested_stock = _requested_stock
+        try:
+            result, billhd = commit_bill(self.output, reqdata, self.lonfo)
+        finally:
+            dbmanager._requested_stock = requested_stock
+        self.assertIsNone(billhd)
+        self.assertEqual(result['errors'], {'Acqua': 1})
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 11)
+        self.assertEqual(Item.objects.get(name='Acqua').quantity, 1)
+
+    def _post_bill(self, key):
+        reqdata = {'customer_name': 'Darozzo', 'idempotency_key': key,
+                   'items': [{'name': 'Coca Cola', 'qty': 2, 'notes': '',
+                              'extras': {}}]}
+        response = self.client.post(reverse('webpos:commit'),
+                                    json.dumps(reqdata),
+                                    content_type='application/json')
+        return json.loads(response.content)
+
+    def test_commit_bill_idempotent(self):
+        self.client.force_login(self.lonfo)
+        first = self._post_bill('f81d4fae7dec11d0')
+        with self.assertNumQueries(1):
+            retry = self._post_bill('f81d4fae7dec11d0')
+        self.assertEqual(retry, first)
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 9)
+        self.assertNotEqual(self._post_bill('a765-00a0c91e')['billid'],
+                            first['billid'])
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 7)
+        self.assertEqual(Bill.objects.filter(customer_name='Darozzo').count(),
+                         2)
+
+    def test_commit_bill_idempotent_race(self):
+        self.client.force_login(self.lonfo)
+        first = self._post_bill('f81d4fae7dec11d0')
+        lookups = []
+        committed_bill = dbmanager.committed_bill
+
+        def late_committed_bill(key):
+            # The retry looks the key up before the first commit ends
+            lookups.append(key)
+            return committed_bill(key) if len(lookups) > 1 else None
+        dbmanager.committed_bill = late_committed_bill
+        try:
+            retry = self._post_bill('f81d4fae7dec11d0')
+        finally:
+            dbmanager.committed_bill = committed_bill
+        self.assertEqual(retry, first)
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 9)
+        with self.assertRaises(dbmanager.FormatError):
+            commit_bill(dict(customer_id=''), {'idempotency_key': 'x' * 65},
+                        self.lonfo)
+
+    def test_sync_bills(self):
+        self.client.force_login(self.lonfo)
+        bills = [{'customer_name': 'Darozzo', 'idempotency_key': 'k1',
+                  'items': [{'name': 'Coca Cola', 'qty': 2, 'notes': '',
+                             'extras': {}}]},
+                 {'customer_name': 'Lonfo', 'idempotency_key': 'k2',
+                  'items': [{'name': 'Panino Salsiccia', 'qty': 1,
+                             'notes': '', 'extras': {}}]},
+                 {'customer_name': 'Simo',
+                  'items': [{'name': 'Acqua', 'qty': 1, 'notes': '',
+                             'extras': {}}]},
+                 {'customer_name': 'Daro', 'idempotency_key': 'k4',
+                  'items': [{'name': 'Acqua', 'qty': 1, 'notes': '',
+                             'extras': {'Peperoni': {'qty': 1}}}]}]
+
+        tickets_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tickets_dir)
+
+        def sync():
+            with self.settings(TICKET_WORKERS=0, TICKETS_DIR=tickets_dir):
+                response = self.client.post(reverse('webpos:sync'),
+                                            json.dumps({'bills': bills}),
+                                            content_type='application/json')
+            return json.loads(response.content)['results']
+        results = sync()
+        self.assertEqual([result['idempotency_key'] for result in results],
+                         ['k1', 'k2', None, 'k4'])
+        self.assertEqual(results[0]['total'], '7.00')
+        self.assertTrue(results[0]['pdf_url'])
+        self.assertEqual(results[1]['errors'], {'Panino Salsiccia': 0})
+        self.assertIsNone(results[1].get('billid'))
+        self.assertEqual(results[2]['error'], 'Missing idempotency key')
+        self.assertEqual(results[3]['total'], '1.50')
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 9)
+        self.assertEqual(Item.objects.get(name='Peperoni').quantity, 9)
+        self.assertEqual(len(os.listdir(tickets_dir)), 2)
+        # The answer was lost, the till syncs again
+        again = sync()
+        self.assertEqual([result.get('billid') for result in again],
+                         [result.get('billid') for result in results])
+        self.assertTrue(again[0]['duplicate'])
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 9)
+        response = self.client.post(reverse('webpos:sync'), '{"bills": 1}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        # Larger queues are sent in chunks
+        response = self.client.post(
+            reverse('webpos:sync'),
+            json.dumps({'bills': bills * (views.SYNC_MAX_BILLS // 4 + 1)}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_admin_bill_read_only(self):
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin'))
+        url = reverse('admin:OpenGenfri_bill_change', args=[self.billhd.id])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.post(url, {
+            'customer_name': 'Darozzo', 'customer_id': '1', 'total': '1.00',
+            'server': 'Lonfo', 'deleted_by': 'Lonfo',
+            'billitem_set-TOTAL_FORMS': '0',
+            'billitem_set-INITIAL_FORMS': '0'})
+        self.assertEqual(response.status_code, 302)
+        bill = Bill.objects.get(pk=self.billhd.id)
+        self.assertEqual(bill.customer_name, 'Darozzo')
+        self.assertEqual((bill.total, bill.server, bill.deleted_by),
+                         (Decimal('9.50'), 'Simo', ''))
+        response = self.client.get(reverse('admin:OpenGenfri_bill_delete',
+                                           args=[self.billhd.id]))
+        self.assertEqual(response.status_code, 403)
+
     def test_undo_bill_success(self):
         msg = undo_bill(str(self.billhd.id), self.lonfo)
         deleted_bill = Bill.objects.get(pk=self.billhd.id)
@@ -160,6 +367,27 @@ class BillTestCase(TestCase):
         self.assertEqual(Item.objects.get(name='Pizza Margherita').quantity, 6)
         self.assertEqual(Item.objects.get(name='Peperoni').quantity, 11)
 
+    def test_undo_bills(self):
+        coca = Item.objects.get(name='Coca Cola')
+        bread = Item.objects.create(name='Pane', category=coca.category,
+                                    price=1.00)
+        other = Bill.objects.create(customer_name='Darozzo', total=4.50,
+                                    server='Simo')
+        BillItem.objects.create(bill=other, item=coca, category=coca.category,
+                                quantity=1, item_price=3.50)
+        BillItem.objects.create(bill=other, item=bread, category=coca.category,
+                                quantity=1, item_price=1.00)
+        # The rollups missing are created in savepoints
+        with self.assertNumQueries(13):
+            undone = undo_bills([self.billhd.id, other.id], self.lonfo)
+        self.assertEqual(undone, 2)
+        self.assertEqual(undo_bills([self.billhd.id, other.id], self.lonfo), 0)
+        self.assertEqual(Bill.objects.filter(deleted_by='Lonfo').count(), 2)
+        self.assertEqual(Item.objects.get(name='Coca Cola').quantity, 12)
+        self.assertIsNone(Item.objects.get(name='Pane').quantity)
+        self.assertEqual(Item.objects.get(name='Acqua').quantity, 6)
+        self.assertEqual(Item.objects.get(name='Peperoni').quantity, 11)
+
     def test_undo_bill_failure(self):
         self.billhd.deleted_by = 'Lonfo'
         self.billhd.save()
@@ -172,3 +400,981 @@ class BillTestCase(TestCase):
         self.assertEqual(Item.objects.get(name='Pizza Margherita').quantity, 5)
         self.assertEqual(Item.objects.get(name='Peperoni').quantity, 10)
 
+
+class ReportTestCase(TestCase):
+    """Checks the aggregated sales report against the per-bill loop the
+    report view used to run, on a generated festival night."""
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(1984)
+        categories = [Category.objects.create(name='Cat {}'.format(n))
+                      for n in range(5)]
+        items, extras = [], {}
+        for n in range(40):
+            category = categories[n % len(categories)]
+            price = Decimal(rnd.randint(-200, 1500)) / 100
+            item = Item.objects.create(name='Item {}'.format(n),
+                                       category=category, price=price,
+                                       extra=n % 4 == 0)
+            if item.extra:
+                extras.setdefault(category, []).append(item)
+            else:
+                items.append(item)
+        servers = ['Simo', 'Luca', 'Lorenzo']
+        cls.opening = timezone.make_aware(datetime(2016, 6, 10, 18, 0))
+        for n in range(300):
+            bill = Bill.objects.create(customer_name='Cliente {}'.format(n),
+                                       server=rnd.choice(servers), total=0,
+                                       deleted_by=rnd.choice(['', '', 'Simo']))
+            total = Decimal(0)
+            for item in rnd.sample(items, rnd.randint(1, 6)):
+                billitem = BillItem.objects.create(
+                    bill=bill, item=item, category=item.category,
+                    quantity=rnd.randint(0, 4), item_price=item.price)
+                total += billitem.item_price * billitem.quantity
+                for extra in extras.get(item.category, []):
+                    if rnd.random() < 0.3:
+                        billextra = BillItemExtra.objects.create(
+                            billitem=billitem, item=extra,
+                            quantity=rnd.randint(1, 2), item_price=extra.price)
+                        total += billextra.total_cost
+            bill.total = max(total, 0)
+            bill.save()
+            bill.date = cls.opening + timedelta(seconds=rnd.randint(0, 21600))
+            bill.save()
+        rebuild_sales_rollup()
+
+    def _legacy_report(self, qs):
+        report_dict = {}
+        for category in Category.objects.all():
+            report_dict[category] = {'itemss': {},
+                                     'items_sold': 0,
+                                     'total_price': Decimal(0.00)
+                                     }
+            for item in category.item_set.all():
+                clear = {'quantity': 0, 'price': Decimal(0.00)}
+                report_dict[category]['itemss'][item] = clear
+        total_earn = Decimal(0)
+        total_cash = Decimal(0)
+        for bill in qs:
+            total_cash += bill.total
+            for billitem in bill.billitem_set.all():
+                quantity = billitem.quantity
+                price = billitem.item_price * billitem.quantity
+                entry_category = report_dict[billitem.category]
+                entry_category['items_sold'] += quantity
+                entry_category['total_price'] += abs(price)
+                entry_item = entry_category['itemss'][billitem.item]
+                entry_item['quantity'] += quantity
+                entry_item['price'] += abs(price)
+                if price > 0:
+                    total_earn += price
+                for extra in billitem.billitemextra_set.all():
+                    entry_category['items_sold'] += extra.quantity * billitem.quantity
+                    entry_category['total_price'] += extra.total_cost
+                    entry_item = entry_category['itemss'][extra.item]
+                    entry_item['quantity'] += extra.quantity * billitem.quantity
+                    entry_item['price'] += extra.total_cost
+                    total_earn += extra.total_cost
+        return report_dict, total_earn, total_cash
+
+    def _assert_report(self, date_start=None, date_end=None, servers=None):
+        qs = Bill.objects.filter(deleted_by='')
+        if date_start:
+            qs = qs.filter(date__gte=date_start)
+        if date_end:
+            qs = qs.filter(date__lte=date_end)
+        if servers:
+            qs = qs.filter(server__in=servers)
+        self.assertEqual(sales_report(date_start, date_end, servers),
+                         self._legacy_report(qs))
+
+    def test_sales_report_matches_legacy_loop(self):
+        self._assert_report()
+        self._assert_report(servers=['Luca'])
+        minutes = lambda m: self.opening + timedelta(minutes=m)
+        self._assert_report(minutes(20), minutes(290), ['Simo', 'Lorenzo'])
+        self._assert_report(date_start=minutes(60))
+        self._assert_report(date_end=minutes(200))
+        self._assert_report(minutes(75), minutes(130))
+
+    def test_sales_report_query_count(self):
+        # Totals and lines of each partial hour, rollups, categories and items
+        with self.assertNumQueries(10):
+            sales_report(self.opening + timedelta(minutes=10),
+                         self.opening + timedelta(minutes=300))
+
+    def test_rollup_follows_commit_and_undo(self):
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [
+                       {'name': 'Item 5',
+                        'qty': 2,
+                        'notes': '',
+                        'extras': {'Item 0': {'qty': 1}},
+                       },
+                       {'name': 'Item 7',
+                        'qty': 1,
+                        'notes': '',
+                        'extras': {},
+                       },
+                   ]
+                  }
+        server = User.objects.create(username='Simo')
+        output = {'customer_id': None}
+        commit_bill(output, reqdata, server)
+        undo_bill(str(Bill.objects.filter(deleted_by='')[0].id), server)
+        report = sales_report()
+        self.assertEqual(report, self._legacy_report(
+            Bill.objects.filter(deleted_by='')))
+        rebuild_sales_rollup()
+        self.assertEqual(report, sales_report())
+
+    def test_rollup_created_concurrently(self):
+        # The rollup of Item 9 is created by the commit of another till after
+        # this one read the rollups, as it can happen on PostgreSQL: the read
+        # misses it, and the insert conflicts. The one of Item 7 was there
+        seen, raced = (Item.objects.get(name='Item 7'),
+                       Item.objects.get(name='Item 9'))
+        hour = dbmanager._floor_hour(timezone.now())
+        for item in seen, raced:
+            SalesRollup.objects.create(hour=hour, server='Nuovo',
+                                       category=item.category, item=item,
+                                       quantity=1, revenue=0, earn=0)
+        CashRollup.objects.create(hour=hour, server='Nuovo', bills=1, total=0)
+
+        def stale(manager, **hidden):
+            read = manager.filter
+
+            def filter(*args, **kwargs):
+                del manager.filter
+                if hidden:
+                    return read(*args, **kwargs).exclude(**hidden)
+                return read(*args, **kwargs).none()
+            manager.filter = filter
+
+        stale(SalesRollup.objects, item=raced)
+        stale(CashRollup.objects)
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [{'name': 'Item 7', 'qty': 3, 'notes': '',
+                              'extras': {}},
+                             {'name': 'Item 9', 'qty': 2, 'notes': '',
+                              'extras': {}}]}
+        try:
+            commit_bill({'customer_id': None}, reqdata,
+                        User.objects.create(username='Nuovo'))
+        finally:
+            vars(SalesRollup.objects).pop('filter', None)
+            vars(CashRollup.objects).pop('filter', None)
+        self.assertEqual(SalesRollup.objects.get(server='Nuovo',
+                                                 item=seen).quantity, 4)
+        self.assertEqual(SalesRollup.objects.get(server='Nuovo',
+                                                 item=raced).quantity, 3)
+        self.assertEqual(CashRollup.objects.get(server='Nuovo').bills, 2)
+
+
+@override_settings(SHARED_CACHE=True)
+class RefreshTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        bibite = Category.objects.create(name='Bibite')
+        Item.objects.create(name='Coca Cola', category=bibite, quantity=11,
+                            price=3.50)
+        Item.objects.create(name='Acqua', category=bibite, quantity=5,
+                            price=1.00)
+        self.lonfo = User.objects.create(username='Lonfo')
+
+    def _refresh(self, data):
+        response = self.client.post(reverse('webpos:refresh'), data)
+        if response.status_code == 304:
+            return None
+        return json.loads(response.content)
+
+    def test_refresh_legacy(self):
+        self.assertEqual(set(self._refresh({})), set(['Coca Cola', 'Acqua']))
+
+    def test_refresh_versions(self):
+        full = self._refresh({'version': ''})
+        self.assertTrue(full['full'])
+        self.assertEqual(full['items']['Acqua'][0], 5)
+        self.assertEqual(len(full['items']), 2)
+        with self.assertNumQueries(0):
+            self.assertIsNone(self._refresh({'version': full['version']}))
+
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [{'name': 'Acqua', 'qty': 2, 'notes': '',
+                              'extras': {}}]}
+        commit_bill({'customer_id': None}, reqdata, self.lonfo)
+        coca = Item.objects.get(name='Coca Cola')
+        coca.enabled = False
+        coca.save()
+        delta = self._refresh({'version': full['version']})
+        self.assertFalse(delta['full'])
+        self.assertEqual(delta['version'], full['version'] + 2)
+        self.assertEqual(delta['items'].keys(), ['Acqua'])
+        self.assertEqual(delta['items']['Acqua'][0], 3)
+        self.assertEqual(delta['removed'], ['Coca Cola'])
+        self.assertIsNone(self._refresh({'version': delta['version']}))
+
+    @override_settings(SHARED_CACHE=False)
+    def test_refresh_local_cache(self):
+        full = self._refresh({'version': ''})
+        # Another process might have changed the items
+        again = self._refresh({'version': full['version']})
+        self.assertTrue(again['full'])
+        self.assertEqual(len(again['items']), 2)
+        with self.settings(STOCK_EVENTS=True):
+            self.assertEqual(self.client.get(
+                reverse('webpos:stock-events')).status_code, 404)
+
+    def test_stock_events_disabled(self):
+        self.client.force_login(self.lonfo)
+        response = self.client.get(reverse('webpos:order'))
+        self.assertContains(response, 'data-stock-events="false"')
+        self.assertEqual(self.client.get(
+            reverse('webpos:stock-events')).status_code, 404)
+        with self.settings(STOCK_EVENTS=True):
+            response = self.client.get(reverse('webpos:order'))
+        self.assertContains(response, 'data-stock-events="true"')
+
+    @override_settings(STOCK_EVENTS=True)
+    def test_stock_events(self):
+        response = self.client.get(reverse('webpos:stock-events'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = iter(response.streaming_content)
+        self.assertEqual(next(events), 'retry: 1000\n\n')
+        event_id, data = next(events).strip().splitlines()
+        full = json.loads(data[len('data: '):])
+        self.assertEqual(event_id, 'id: {}'.format(full['version']))
+        self.assertTrue(full['full'])
+
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [{'name': 'Acqua', 'qty': 5, 'notes': '',
+                              'extras': {}}]}
+        commit_bill({'customer_id': None}, reqdata, self.lonfo)
+        event_id, data = next(events).strip().splitlines()
+        delta = json.loads(data[len('data: '):])
+        self.assertEqual(delta['items'], {'Acqua': [0, '1.00']})
+        response.close()
+
+
+class CatalogTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        panini = Category.objects.create(name='Panini', priority=2)
+        bibite = Category.objects.create(name='Bibite', priority=1)
+        Category.objects.create(name='Chiuso', enabled=False)
+        Item.objects.create(name='Panino Salsiccia', category=panini,
+                            price=6.50)
+        Item.objects.create(name='Panino Porchetta', category=panini,
+                            price=6.00, priority=1)
+        Item.objects.create(name='Peperoni', category=panini, price=0.50,
+                            extra=True)
+        Item.objects.create(name='Coca Cola', category=bibite, price=3.50)
+        self.lonfo = User.objects.create(username='Lonfo')
+        self.client.force_login(self.lonfo)
+
+    def test_order_catalog(self):
+        response = self.client.get(reverse('webpos:order'))
+        categories = Category.objects.filter(enabled=True).order_by('priority')
+        items = Item.objects.filter(enabled=True, extra=False,
+                                    category__in=categories).order_by(
+                                        'category', 'priority', 'name')
+        self.assertEqual(list(response.context['categories']),
+                         list(categories))
+        self.assertEqual(response.context['items'], list(items))
+        for item in response.context['items']:
+            self.assertEqual(item.extras,
+                             list(item.category.item_set.filter(extra=True)))
+        version = response.context['catalog_version']
+        fragment = cache.get(make_template_fragment_key('order_buttons',
+                                                        [version]))
+        self.assertIn('Panino Porchetta', fragment)
+        # Session and user
+        with self.assertNumQueries(2):
+            self.client.get(reverse('webpos:order'))
+
+        coca = Item.objects.get(name='Coca Cola')
+        coca.name = 'Coca Cola Zero'
+        coca.save()
+        response = self.client.get(reverse('webpos:order'))
+        self.assertIn('Coca Cola Zero',
+                      [item.name for item in response.context['items']])
+        self.assertContains(response, 'Coca Cola Zero')
+        self.assertContains(self.client.get(reverse('webpos:index')),
+                            'Coca Cola Zero')
+
+    def test_edit_by_another_process(self):
+        self.client.get(reverse('webpos:order'))
+        # Disabled by the admin served by another process
+        with transaction.atomic():
+            Item.objects.filter(name='Coca Cola').update(enabled=False)
+            CatalogVersion.objects.update(version=F('version') + 1)
+        response = self.client.get(reverse('webpos:order'))
+        self.assertIn('Coca Cola',
+                      [item.name for item in response.context['items']])
+        # Read again once CATALOG_VERSION_TTL has passed
+        catalog._catalog_version = (catalog._catalog_version[0], 0)
+        response = self.client.get(reverse('webpos:order'))
+        self.assertNotIn('Coca Cola',
+                         [item.name for item in response.context['items']])
+        self.assertNotContains(response, 'Coca Cola')
+
+
+class TicketTestCase(TransactionTestCase):
+    def setUp(self):
+        self.tickets_dir = tempfile.mkdtemp()
+        bibite = Category.objects.create(name='Bibite')
+        piatti = Category.objects.create(name='Piatti', printable=False)
+        Item.objects.create(name='Coca Cola', category=bibite, quantity=11,
+                            price=3.50)
+        Item.objects.create(name='Pasta al ragu', category=piatti,
+                            quantity=3, price=8.50)
+        self.lonfo = User.objects.create(username='Lonfo')
+        self.client.force_login(self.lonfo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tickets_dir)
+
+    def _commit(self):
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [
+                       {'name': 'Coca Cola', 'qty': 2, 'notes': '',
+                        'extras': {}},
+                       {'name': 'Pasta al ragu', 'qty': 1, 'notes': 'Scotta',
+                        'extras': {}},
+                   ]
+                  }
+        response = self.client.post(reverse('webpos:commit'),
+                                    json.dumps(reqdata),
+                                    content_type='application/json')
+        return json.loads(response.content)
+
+    def test_ticket_rendered_on_commit(self):
+        with self.settings(TICKET_WORKERS=0, TICKETS_DIR=self.tickets_dir):
+            result = self._commit()
+            bill = Bill.objects.get()
+            self.assertTrue(os.path.exists(tickets.ticket_path(bill.id)))
+            response = self.client.get(result['pdf_url'])
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(response.content.startswith('%PDF'))
+
+    def test_ticket_worker_pool(self):
+        with self.settings(TICKET_WORKERS=1, TICKETS_DIR=self.tickets_dir):
+            result = self._commit()
+            response = self.client.get(result['pdf_url'])
+        self.assertTrue(response.content.startswith('%PDF'))
+
+    def test_ticket_not_queued(self):
+        with self.settings(TICKET_WORKERS=0, TICKETS_DIR=self.tickets_dir):
+            result = self._commit()
+            os.remove(tickets.ticket_path(Bill.objects.get().id))
+            # Rendered at once, as no worker is rendering it
+            start = time.time()
+            response = self.client.get(result['pdf_url'])
+            self.assertLess(time.time() - start, tickets.WAIT_TIMEOUT)
+            self.assertTrue(response.content.startswith('%PDF'))
+            response = self.client.get(reverse('webpos:pdf-bill', args=[99]))
+            self.assertEqual(response.status_code, 404)
+
+    def test_ticket_logo_is_shared(self):
+        with self.settings(TICKET_WORKERS=0, TICKETS_DIR=self.tickets_dir):
+            self._commit()
+        html = tickets.render_ticket_html(Bill.objects.get().id)
+        self.assertNotIn('base64', html)
+        self.assertIn('/static/img/ticket_logo.jpg', html)
+        path = tickets._link_callback('/static/img/ticket_logo.jpg', None)
+        self.assertTrue(path.endswith(os.path.join('img', 'ticket_logo.jpg')))
+        self.assertTrue(os.path.exists(path))
+
+    def test_ticket_html_queries(self):
+        with self.settings(TICKET_WORKERS=0, TICKETS_DIR=self.tickets_dir):
+            self._commit()
+            self._commit()
+        bill = Bill.objects.first()
+        with self.assertNumQueries(3):
+            html = tickets.render_ticket_html(bill.id)
+        self.assertIn('Pasta al ragu', html)
+        # Only the printable categories get a ticket of their own
+        self.assertEqual(html.count('<h1>Bibite'), 1)
+        self.assertEqual(html.count('<h1>Piatti'), 0)
+
+
+class PrinterStandIn(object):
+    """A network printer listening on a local port, which keeps everything it
+    receives."""
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.address = 'tcp://127.0.0.1:{}'.format(
+            self.server.getsockname()[1])
+        self.received = []
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error:
+                return
+            chunks = []
+            chunk = conn.recv(4096)
+            while chunk:
+                chunks.append(chunk)
+                chunk = conn.recv(4096)
+            conn.close()
+            self.received.append(b''.join(chunks))
+
+    def wait_received(self, count, timeout=1):
+        for _ in range(int(timeout / 0.01)):
+            if len(self.received) >= count:
+                break
+            time.sleep(0.01)
+        return self.received
+
+    def close(self):
+        self.server.close()
+
+
+class EscPosTestCase(TransactionTestCase):
+    def setUp(self):
+        self.tickets_dir = tempfile.mkdtemp()
+        bibite = Category.objects.create(name='Bibite', priority=1)
+        piatti = Category.objects.create(name='Piatti', priority=2)
+        Category.objects.create(name='Casse', printable=False)
+        Item.objects.create(name='Coca Cola', category=bibite, quantity=11,
+                            price=3.50)
+        Item.objects.create(name=u'Pasta al rag\xf9', category=piatti,
+                            quantity=3, price=8.50)
+        Item.objects.create(name='Parmigiano', category=piatti, price=0.50,
+                            extra=True)
+        self.printer = PrinterStandIn()
+        self.device = os.path.join(self.tickets_dir, 'lp0')
+
+    def tearDown(self):
+        self.printer.close()
+        shutil.rmtree(self.tickets_dir)
+
+    def _commit(self):
+        reqdata = {'customer_name': 'Darozzo',
+                   'items': [
+                       {'name': 'Coca Cola', 'qty': 2, 'notes': '',
+                        'extras': {}},
+                       {'name': u'Pasta al rag\xf9', 'qty': 1,
+                        'notes': 'Scotta',
+                        'extras': {'Parmigiano': {'qty': 1}}},
+                   ]
+                  }
+        _, bill = commit_bill(dict(errors=[], bill_id=None, customer_id='12',
+                                   date=None, total=0), reqdata,
+                              User.objects.get_or_create(username='Lonfo')[0])
+        return bill
+
+    def test_render_tickets(self):
+        bill = self._commit()
+        rendered = escpos.render_tickets(tickets.ticket_context(bill.id))
+        self.assertEqual([c.name for c, _ in rendered], ['Bibite', 'Piatti'])
+        piatti = rendered[1][1]
+        self.assertTrue(piatti.startswith(escpos.INIT))
+        self.assertTrue(piatti.endswith(escpos.CUT))
+        self.assertIn(u'1 x Pasta al rag\xf9'.encode('cp858'), piatti)
+        self.assertIn(b'  + 1 x Parmigiano', piatti)
+        self.assertIn(b'Scotta', piatti)
+        self.assertIn(b'Tavolo: 12', piatti)
+        self.assertNotIn(b'Coca Cola', piatti)
+
+    def test_print_queued_ticket(self):
+        bill = self._commit()
+        printers = {'Piatti': self.device, '*': self.printer.address}
+        with self.settings(TICKET_WORKERS=0, TICKETS_DIR=self.tickets_dir,
+                           TICKET_PRINTERS=printers):
+            tickets.queue_ticket(bill.id)
+            # The PDF is still archived
+            self.assertTrue(os.path.exists(tickets.ticket_path(bill.id)))
+        escpos.join()
+        with open(self.device, 'rb') as device:
+            self.assertIn(b'Parmigiano', device.read())
+        self.assertEqual(len(self.printer.wait_received(1)), 1)
+        self.assertIn(b'2 x Coca Cola', self.printer.received[0])
+
+    def test_category_printer(self):
+        Category.objects.filter(name='Piatti').update(
+            printer=self.printer.address)
+        bill = self._commit()
+        with self.settings(TICKET_PRINTERS={'*': self.device}):
+            queued = escpos.print_tickets(tickets.ticket_context(bill.id))
+        self.assertEqual(queued, 2)
+        escpos.join()
+        self.assertIn(b'Parmigiano', self.printer.wait_received(1)[0])
+        with open(self.device, 'rb') as device:
+            self.assertNotIn(b'Parmigiano', device.read())
+
+    def test_batching(self):
+        self._commit()
+        self._commit()
+        with self.settings(TICKET_PRINTERS={'*': self.printer.address}):
+            for bill in Bill.objects.all():
+                escpos.print_tickets(tickets.ticket_context(bill.id))
+        escpos.join()
+        # Four tickets, sent at once
+        received = self.printer.wait_received(1)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].count(escpos.CUT), 4)
+
+    def test_retry(self):
+        bill = self._commit()
+        sent = []
+
+        def send(printer, data):
+            if not sent:
+                sent.append(None)
+                raise IOError('Out of paper')
+            sent.append(data)
+
+        old_send, old_delays = escpos.send, escpos.RETRY_DELAYS
+        escpos.send, escpos.RETRY_DELAYS = send, (0.01,)
+        try:
+            with self.settings(TICKET_PRINTERS={'Bibite': 'retry'}):
+                escpos.print_tickets(tickets.ticket_context(bill.id))
+            escpos.join()
+        finally:
+            escpos.send, escpos.RETRY_DELAYS = old_send, old_delays
+        self.assertEqual(len(sent), 2)
+        self.assertIn(b'2 x Coca Cola', sent[1])
+
+
+class StockStressTestCase(TransactionTestCase):
+    def test_no_oversell(self):
+        out = StringIO()
+        call_command('stress_stock', threads=4, bills=10, stock=25,
+                     stdout=out)
+        self.assertIn('25 committed, 15 sold out, 0 failed', out.getvalue())
+        call_command('stress_stock', threads=4, bills=10, stock=25,
+                     ledger=True, stdout=out)
+        self.assertEqual(out.getvalue().count(
+            '25 committed, 15 sold out, 0 failed'), 2)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite only')
+    def test_sqlite_pragmas(self):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode')
+        self.assertEqual(cursor.fetchone()[0], 'wal')
+        cursor.execute('PRAGMA synchronous')
+        self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+        cursor.execute('PRAGMA busy_timeout')
+        self.assertEqual(cursor.fetchone()[0], 5000)
+
+
+class LedgerTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        caches['stock'].clear()
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.journal = os.path.join(journal_dir, 'stock.journal')
+        settings = self.settings(
+            STOCK_LEDGER=True, STOCK_LEDGER_JOURNAL=self.journal,
+            STOCK_LEDGER_FLUSH_INTERVAL=3600)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(ledger.close)
+        bibite = Category.objects.create(name='Bibite')
+        self.birra = Item.objects.create(name='Birra', category=bibite,
+                                         quantity=5, price=4)
+        Item.objects.create(name='Acqua', category=bibite, price=1)
+        self.lonfo = User.objects.create(username='Lonfo')
+
+    def _commit(self, qty, key=None):
+        reqdata = {'customer_name': 'Darozzo', 'idempotency_key': key,
+                   'items': [{'name': 'Birra', 'qty': qty, 'notes': '',
+                              'extras': {}},
+                             {'name': 'Acqua', 'qty': 1, 'notes': '',
+                              'extras': {}}]}
+        with transaction.atomic():
+            return commit_bill(dict(customer_id=''), reqdata, self.lonfo)
+
+    def _stock(self):
+        """Returns the stock of the counter, or the stored one if it has
+        none, and the stored one."""
+        stored = Item.objects.get(name='Birra').quantity
+        return (ledger.quantities({self.birra.id: stored})[self.birra.id],
+                stored)
+
+    def test_commit_bill(self):
+        output, bill = self._commit(3, key='k1')
+        self.assertEqual(self._stock(), (2, 5))
+        output, _ = self._commit(3)
+        self.assertEqual(output['errors'], {'Birra': 2})
+        with self.assertRaises(IntegrityError):
+            self._commit(1, key='k1')
+        self.assertEqual(self._stock(), (2, 5))
+        self.assertEqual(ledger.flush(), 1)
+        self.assertEqual(self._stock(), (2, 2))
+        undo_bills([bill.id], self.lonfo)
+        self.assertEqual(self._stock(), (5, 2))
+        # Edits of the admin change the stock by the difference
+        birra = Item.objects.get(name='Birra')
+        birra.quantity = 10
+        birra.save()
+        self.assertEqual(self._stock(), (13, 10))
+        ledger.flush()
+        self.assertEqual(self._stock(), (13, 13))
+        # A flush committed while the edit is saved is kept
+        self._commit(2)
+
+        def flush(sender, **kwargs):
+            ledger.flush()
+        pre_save.connect(flush, sender=Item)
+        try:
+            birra = Item.objects.get(name='Birra')
+            birra.quantity = 20
+            birra.save()
+        finally:
+            pre_save.disconnect(flush, sender=Item)
+        self.assertEqual(birra.quantity, 20)
+        self.assertEqual(self._stock(), (18, 18))
+        # A failed edit leaves the item with its stock
+        birra.name = 'Acqua'
+        birra.quantity = 15
+        with self.assertRaises(IntegrityError):
+            birra.save()
+        self.assertEqual(birra.quantity, 15)
+        self.assertEqual(self._stock(), (18, 18))
+
+    def test_recover(self):
+        self._commit(2)
+        self._commit(1)
+        ledger.flush()
+        self._commit(1)
+        # The process dies before flushing the last bill, and the counters
+        # are lost with the cache
+        crashed, ledger._ledger = ledger._ledger, None
+        crashed.stopped.set()
+        os.close(crashed.journal)
+        caches['stock'].clear()
+        self.assertEqual(self._stock(), (2, 2))
+        out = StringIO()
+        call_command('recover_stock', stdout=out)
+        self.assertEqual(out.getvalue(), '1 stock changes recovered.\n')
+        self.assertEqual(self._stock(), (1, 1))
+        self.assertEqual(os.path.getsize(self.journal), 0)
+        self.assertFalse(StockFlush.objects.exists())
+
+
+class JournalTestCase(TransactionTestCase):
+    def setUp(self):
+        bibite = Category.objects.create(name='Bibite')
+        fritti = Category.objects.create(name='Fritti')
+        self.birra = Item.objects.create(name='Birra', category=bibite,
+                                         quantity=10, price=4)
+        Item.objects.create(name='Patatine', category=fritti, price=3)
+        self.ketchup = Item.objects.create(name='Ketchup', category=fritti,
+                                           quantity=5, price=0.5, extra=True)
+        self.lonfo = User.objects.create(username='Lonfo')
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.journal = os.path.join(journal_dir, 'transactions.jsonl')
+        settings = self.settings(TRANSACTION_JOURNAL=self.journal)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def _commit(self, birre, patatine=0):
+        lines = [{'name': 'Birra', 'qty': birre, 'notes': 'fresca',
+                  'extras': {}}]
+        if patatine:
+            lines.append({'name': 'Patatine', 'qty': patatine, 'notes': '',
+                          'extras': {'Ketchup': {'qty': 1}}})
+        with transaction.atomic():
+            return commit_bill(dict(customer_id='7'),
+                               {'customer_name': 'Darozzo', 'items': lines},
+                               self.lonfo)[1]
+
+    def _state(self):
+        bills = [(bill.id, bill.date, bill.customer_name, bill.customer_id,
+                  bill.total, bill.server, bill.deleted_by,
+                  [(line.item_id, line.category_id, line.quantity,
+                    line.item_price, line.note,
+                    [(extra.item_id, extra.quantity, extra.item_price)
+                     for extra in line.billitemextra_set.all()])
+                   for line in bill.billitem_set.order_by('id')])
+                 for bill in Bill.objects.order_by('id')]
+        sales = sorted(SalesRollup.objects.values_list(
+            'hour', 'server', 'item', 'quantity', 'revenue', 'earn'))
+        cash = sorted(CashRollup.objects.values_list('hour', 'server',
+                                                     'bills', 'total'))
+        return (bills, dict(Item.objects.values_list('name', 'quantity')),
+                sales, cash)
+
+    def test_replay(self):
+        first = self._commit(2, patatine=1)
+        self._commit(1)
+        with transaction.atomic():
+            undo_bills([first.id], self.lonfo)
+        birra = Item.objects.get(name='Birra')
+        birra.quantity = 20
+        birra.save()
+        self._commit(3)
+        journal.flush()
+        with open(self.journal) as entries:
+            self.assertEqual([json.loads(entry)[0] for entry in entries],
+                             ['commit', 'commit', 'undo', 'stock', 'commit'])
+        state = self._state()
+        self.assertEqual(state[1], {'Birra': 17, 'Patatine': None,
+                                    'Ketchup': 5})
+        # Back to a backup taken after the first bill
+        Bill.objects.exclude(pk=first.pk).delete()
+        Bill.objects.filter(pk=first.pk).update(deleted_by='')
+        Item.objects.filter(name='Birra').update(quantity=8)
+        Item.objects.filter(name='Ketchup').update(quantity=4)
+        rebuild_sales_rollup()
+        out = StringIO()
+        call_command('replay_journal', self.journal, stdout=out)
+        self.assertIn('2 bills committed, 1 deleted, 1 stock edits',
+                      out.getvalue())
+        self.assertEqual(self._state(), state)
+        call_command('replay_journal', self.journal, stdout=out)
+        self.assertIn('0 bills committed, 0 deleted, 1 stock edits',
+                      out.getvalue())
+        self.assertEqual(self._state(), state)
+
+
+class QueueHandlerTestCase(SimpleTestCase):
+    def test_queued(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'logs', 'test.log')
+        handler = mk_log_folder_handler(
+            os.path.dirname(path), path,
+            'logging.handlers.RotatingFileHandler', queued=True,
+            maxBytes=1024 * 1024, backupCount=1)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        logger = logging.getLogger('OpenGenfri.tests.queued')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        records = []
+        original = logging.Handler()
+        original.emit = records.append
+        logger.addHandler(original)
+        self.addCleanup(logger.removeHandler, original)
+        try:
+            raise ValueError('Birra finita')
+        except ValueError:
+            logger.exception('Bill %s not committed', 42)
+        handler.flush()
+        with open(path) as log:
+            text = log.read()
+        self.assertTrue(text.startswith('ERROR Bill 42 not committed\n'))
+        self.assertIn('ValueError: Birra finita', text)
+        # The other handlers get the record as it was logged
+        self.assertEqual(records[0].args, (42,))
+        self.assertIsNotNone(records[0].exc_info)
+        handler.close()
+        self.assertFalse(handler.listener.thread.is_alive())
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        for n in range(60):
+            Bill.objects.create(customer_name='Darozzo {}'.format(n),
+                                total=5, server='Lonfo')
+        Bill.objects.create(customer_name='Marta', total=5, server='Lonfo')
+        Bill.objects.create(customer_name='Mario', total=5, server='Lonfo',
+                            deleted_by='admin')
+
+    def _names(self, text):
+        return sorted(fulltext.search_bills(text)
+                      .values_list('customer_name', flat=True))
+
+    def test_search(self):
+        self.assertEqual(self._names('ROZZO 1'),
+                         ['Darozzo 1'] + ['Darozzo 1{}'.format(n)
+                                          for n in range(10)])
+        self.assertEqual(len(self._names('lonf')), 61)
+        self.assertEqual(self._names('mario'), [])
+        self.assertEqual(self._names('"'), [])
+        bill = Bill.objects.get(customer_name='Darozzo 7')
+        bill.customer_name = 'Amelia'
+        bill.save()
+        self.assertEqual(self._names('meli'), ['Amelia'])
+        self.assertEqual(self._names('Darozzo 7'), [])
+        bill.delete()
+        self.assertEqual(self._names('meli'), [])
+        # Shorter than a trigram
+        self.assertEqual(self._names('ma'), ['Marta'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite only')
+    def test_search_uses_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._names('darozzo')
+        self.assertIn('MATCH', queries[-1]['sql'])
+
+    def test_search_view(self):
+        user = User.objects.create_user('Lonfo')
+        self.client.force_login(user)
+        url = reverse('webpos:search')
+        response = self.client.get(url, {'search': 'darozzo'})
+        self.assertEqual(len(response.context['queryset']), 50)
+        self.assertEqual(response.context['queryset'][0].customer_name,
+                         'Darozzo 59')
+        cursor = response.context['next_cursor']
+        self.assertContains(response,
+                            '?search=darozzo&amp;after={}'.format(cursor))
+        response = self.client.get(url, {'search': 'darozzo',
+                                         'after': cursor})
+        self.assertEqual(len(response.context['queryset']), 10)
+        self.assertContains(response, 'Darozzo 0<')
+        self.assertIsNone(response.context['next_cursor'])
+        response = self.client.get(url, {'search': 'mario'})
+        self.assertTrue(response.context['qs_empty'])
+
+    def test_bills_page(self):
+        # Bills of the same second are ordered by id
+        Bill.objects.filter(customer_name__in=['Darozzo 20', 'Darozzo 21',
+                                               'Darozzo 22']).update(
+            date=timezone.now())
+        bills = Bill.objects.filter(deleted_by='')
+        names, after = [], None
+        while True:
+            page, after = dbmanager.bills_page(bills, after, size=7)
+            names.extend(bill.customer_name for bill in page)
+            if after is None:
+                break
+        self.assertEqual(names, [bill.customer_name for bill in
+                                 bills.order_by('-date', '-id')])
+        self.assertEqual(len(names), 61)
+        with self.assertRaises(dbmanager.FormatError):
+            dbmanager.bills_page(bills, 'Darozzo')
+
+    def test_bill_list(self):
+        user = User.objects.create_user('Lonfo')
+        self.client.force_login(user)
+        url = reverse('webpos:bill-list')
+        data = json.loads(self.client.get(url, {'search': 'rozzo 5',
+                                                'size': 5}).content)
+        self.assertEqual([bill['customer_name'] for bill in data['bills']],
+                         ['Darozzo 59', 'Darozzo 58', 'Darozzo 57',
+                          'Darozzo 56', 'Darozzo 55'])
+        self.assertEqual(data['bills'][0]['total'], '5.00')
+        data = json.loads(self.client.get(url, {'search': 'rozzo 5',
+                                                'after': data['next']}
+                                          ).content)
+        self.assertEqual(len(data['bills']), 6)
+        self.assertIsNone(data['next'])
+        data = json.loads(self.client.get(url, {'server': 'Nobody'}).content)
+        self.assertEqual(data['bills'], [])
+        response = self.client.get(url, {'after': '12'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.lonfo = User.objects.create_user('Lonfo')
+        bibite = Category.objects.create(name='Bibite')
+        self.panini = Category.objects.create(name='Panini')
+        birra = Item.objects.create(name='Birra', category=bibite, price=4)
+        panino = Item.objects.create(name=u'Panino pi\xf9', price=6,
+                                     category=self.panini)
+        cipolla = Item.objects.create(name='Cipolla', category=self.panini,
+                                      price=0.5, extra=True)
+        for n in range(5):
+            bill = Bill.objects.create(customer_name='Cliente {}'.format(n),
+                                       total=10, server='Lonfo')
+            BillItem.objects.create(bill=bill, item=birra, category=bibite,
+                                    quantity=1, item_price=4)
+            if n % 2:
+                line = BillItem.objects.create(bill=bill, item=panino,
+                                               category=self.panini,
+                                               quantity=1, item_price=6)
+                BillItemExtra.objects.create(billitem=line, item=cipolla,
+                                             quantity=2, item_price=0.5)
+        Bill.objects.create(customer_name='Cliente 5', total=10,
+                            server='Lonfo', deleted_by='admin')
+        self.client.force_login(self.lonfo)
+        self._chunk_size = export.CHUNK_SIZE
+        export.CHUNK_SIZE = 2
+
+    def tearDown(self):
+        export.CHUNK_SIZE = self._chunk_size
+
+    def _get(self, kind, fmt, **filters):
+        response = self.client.get(reverse('webpos:export',
+                                           args=(kind, fmt)), filters)
+        self.assertEqual(response.status_code, 200)
+        return ''.join(response.streaming_content)
+
+    def test_export_bills(self):
+        rows = self._get('bills', 'csv').splitlines()
+        self.assertEqual(rows[0], ','.join(export.BILL_COLUMNS))
+        self.assertEqual([row.split(',')[3] for row in rows[1:]],
+                         ['Cliente {}'.format(n) for n in range(5)])
+        bills = json.loads(self._get('bills', 'json',
+                                     sel_category=self.panini.id))
+        self.assertEqual([bill['customer_name'] for bill in bills],
+                         ['Cliente 1', 'Cliente 3'])
+        self.assertEqual(bills[0]['total'], '10.00')
+        self.assertEqual(json.loads(self._get('bills', 'json',
+                                              sel_server=self.lonfo.id,
+                                              date_end_0='2000-01-01',
+                                              date_end_1='00:00')), [])
+
+    def test_export_lines(self):
+        lines = json.loads(self._get('lines', 'json'))
+        self.assertEqual(len(lines), 9)
+        self.assertEqual([(line['item'], line['extra'], line['quantity'])
+                          for line in lines[1:4]],
+                         [('Birra', False, 1), (u'Panino pi\xf9', False, 1),
+                          ('Cipolla', True, 2)])
+        self.assertEqual(lines[3]['category'], 'Panini')
+        self.assertEqual([line['price'] for line in lines[1:4]],
+                         ['4.00', '6.00', '0.50'])
+        rows = self._get('lines', 'csv',
+                         sel_category=self.panini.id).splitlines()
+        self.assertEqual(len(rows), 5)
+        self.assertIn('Panino pi\xc3\xb9', rows[1])
+
+    def test_export_stream_reads_reporting(self):
+        router = routers.ReportingRouter()
+        with self.settings(REPORTING_DATABASE='reporting'):
+            stream = views._reporting_stream(
+                router.db_for_read(Bill) for _ in range(2))
+            self.assertEqual(list(stream), ['reporting', 'reporting'])
+            self.assertIsNone(router.db_for_read(Bill))
+
+
+class ReportingTestCase(TransactionTestCase):
+    def test_router(self):
+        router = routers.ReportingRouter()
+        with self.settings(REPORTING_DATABASE='reporting'):
+            self.assertIsNone(router.db_for_read(Bill))
+            with routers.reporting:
+                self.assertEqual(router.db_for_read(Bill), 'reporting')
+                self.assertEqual(router.db_for_write(Bill), 'default')
+            self.assertIsNone(router.db_for_read(Bill))
+            self.assertFalse(router.allow_migrate('reporting', 'OpenGenfri'))
+        with routers.reporting:
+            self.assertIsNone(router.db_for_read(Bill))
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite only')
+    def test_snapshot(self):
+        Bill.objects.create(customer_name='Darozzo', total=5, server='Lonfo')
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'reporting.sqlite3')
+        try:
+            routers.snapshot_sqlite(path)
+            Bill.objects.create(customer_name='Darozzo', total=5,
+                                server='Lonfo')
+            snapshot = sqlite3.connect(path)
+            self.assertEqual(snapshot.execute(
+                'SELECT COUNT(*) FROM OpenGenfri_bill').fetchone()[0], 1)
+            self.assertEqual(snapshot.execute(
+                'PRAGMA journal_mode').fetchone()[0], 'delete')
+            snapshot.close()
+            routers.snapshot_sqlite(path)
+            snapshot = sqlite3.connect(path)
+            self.assertEqual(snapshot.execute(
+                'SELECT COUNT(*) FROM OpenGenfri_bill').fetchone()[0], 2)
+            snapshot.close()
+        finally:
+            shutil.rmtree(tmp_dir)
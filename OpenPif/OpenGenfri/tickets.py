@@ -0,0 +1,181 @@
+"""
+Rendering of the PDF tickets of the bills.
+
+The HTML of a ticket is rendered as soon as its bill is committed, and so is
+the much slower conversion to PDF, unless settings.TICKET_WORKERS is set:
+then it runs in a pool of that many worker processes, so that the tills don't
+wait for it. The pool is forked from the server process, which must be safe
+to fork (e.g. a server running a process per request).
+
+PDFs are stored in settings.TICKETS_DIR, named after the bill id, and served
+from there by the pdf view. A ticket queued for the workers is marked by an
+empty "<bill id>.queued" file until it is stored, so that the pdf view waits
+only for the tickets being rendered.
+
+The tickets of the printable categories with a printer are also queued as
+ESC/POS for the thermal printers of their stations, and then the PDF is kept
+only for archival (see escpos).
+"""
+import errno
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.db.models import Prefetch
+from django.template.loader import get_template
+from easy_pdf.rendering import html_to_pdf, fetch_resources
+from models import Bill, BillItemExtra
+import escpos
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a queued ticket before rendering it in the request
+WAIT_TIMEOUT = 5
+WAIT_INTERVAL = 0.05
+
+_pool = None
+_pool_lock = threading.Lock()
+# The compiled ticket template and the paths of the static files it uses are
+# looked up once per process
+_template = None
+_resources = {}
+
+
+def queue_ticket(bill_id):
+    """Renders the ticket of the bill in the background."""
+    try:
+        context = ticket_context(bill_id)
+        escpos.print_tickets(context)
+        html = render_ticket_html(bill_id, context)
+        if settings.TICKET_WORKERS:
+            _mark_queued(bill_id)
+            _get_pool().apply_async(_render_in_worker, (bill_id, html))
+        else:
+            _store_ticket(bill_id, html)
+    except Exception:
+        # The pdf view will try again
+        logger.exception('Error queueing ticket #{}'.format(bill_id))
+
+
+def get_ticket(bill_id):
+    """Returns the PDF of the ticket of the bill, waiting a bit for it if it
+    is queued for the workers, or rendering it if it isn't there."""
+    path = ticket_path(bill_id)
+    waited = 0
+    while (not os.path.exists(path) and
+           os.path.exists(_queued_path(bill_id)) and waited < WAIT_TIMEOUT):
+        time.sleep(WAIT_INTERVAL)
+        waited += WAIT_INTERVAL
+    if not os.path.exists(path):
+        if waited:
+            logger.warning('Ticket #{} not rendered in {} s, rendering '
+                           'it'.format(bill_id, WAIT_TIMEOUT))
+        _store_ticket(bill_id, render_ticket_html(bill_id))
+    with open(path, 'rb') as ticket:
+        return ticket.read()
+
+
+def ticket_path(bill_id):
+    return os.path.join(settings.TICKETS_DIR, '{}.pdf'.format(bill_id))
+
+
+def _queued_path(bill_id):
+    return os.path.join(settings.TICKETS_DIR, '{}.queued'.format(bill_id))
+
+
+def render_ticket_html(bill_id, context=None):
+    if context is None:
+        context = ticket_context(bill_id)
+    return _ticket_template().render(context)
+
+
+def ticket_context(bill_id):
+    """Returns the context of the ticket of the bill, with its lines and
+    extras fetched at once and grouped by category, in order of priority."""
+    bill = Bill.objects.get(pk=bill_id)
+    items = bill.billitem_set.filter(category__isnull=False).select_related(
+        'item', 'category').prefetch_related(
+            Prefetch('billitemextra_set',
+                     queryset=BillItemExtra.objects.select_related('item')))
+    grouped = {}
+    for item in items.order_by('id'):
+        grouped.setdefault(item.category, []).append(
+            (item, item.billitemextra_set.all()))
+    billitems = OrderedDict()
+    headeritems = OrderedDict()
+    for cat in sorted(grouped, key=lambda cat: (cat.priority, cat.id)):
+        if cat.printable:
+            billitems[cat] = grouped[cat]
+        headeritems[cat] = grouped[cat]
+    return {'bill': bill,
+            'billitems': billitems,
+            'headeritems': headeritems}
+
+
+def _ticket_template():
+    global _template
+    if _template is None:
+        _template = get_template('webpos/comanda.html')
+    return _template
+
+
+def _link_callback(uri, rel):
+    """Resolves the static files referenced by the tickets, like the logo,
+    straight from the static directories."""
+    path = _resources.get(uri)
+    if path is None:
+        if uri.startswith(settings.STATIC_URL):
+            path = finders.find(uri[len(settings.STATIC_URL):])
+        if path is None:
+            path = fetch_resources(uri, rel)
+        _resources[uri] = path
+    return path
+
+
+def _store_ticket(bill_id, html):
+    """Converts the HTML of a ticket to PDF and atomically stores it."""
+    pdf = html_to_pdf(html, link_callback=_link_callback)
+    _make_tickets_dir()
+    fd, tmp_path = tempfile.mkstemp(dir=settings.TICKETS_DIR)
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(pdf)
+    os.rename(tmp_path, ticket_path(bill_id))
+    try:
+        os.remove(_queued_path(bill_id))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _mark_queued(bill_id):
+    _make_tickets_dir()
+    open(_queued_path(bill_id), 'w').close()
+
+
+def _make_tickets_dir():
+    try:
+        os.makedirs(settings.TICKETS_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _render_in_worker(bill_id, html):
+    try:
+        _store_ticket(bill_id, html)
+    except Exception:
+        logger.exception('Error rendering ticket #{}'.format(bill_id))
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(settings.TICKET_WORKERS)
+        return _pool
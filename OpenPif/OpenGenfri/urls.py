@@ -9,14 +9,22 @@ urlpatterns = [
         name='order'),
     url(r'^refresh/$', views.refresh_buttons,
         name='refresh'),
+    url(r'^stock-events/$', views.stock_events,
+        name='stock-events'),
     url(r'^commit/$', views.bill_handler,
         name='commit'),
+    url(r'^sync/$', views.sync_bills,
+        name='sync'),
     url(r'^report/(\?(\w=[0-9A-Z%]&?)+)?$', login_required(views.report),
         name='report'),
+    url(r'^export/(?P<kind>bills|lines)\.(?P<fmt>csv|json)$',
+        login_required(views.export), name='export'),
     url(r'^bill/(?P<pk>\d+)/$', login_required(views.BillDetailView.as_view()),
         name='bill-detail'),
     url(r'^search/(\?search=[0-9a-zA-Z%]*)?$', login_required(views.search),
         name='search'),
+    url(r'^bills/$', login_required(views.bill_list),
+        name='bill-list'),
     url(r'^pdf/(?P<bill_id>\d+)$', login_required(views.pdf_view),
         name='pdf-bill'),
     url(r'^undo-bill/$', login_required(views.undo_bill),
@@ -1,18 +1,25 @@
 import json
 import re
-from decimal import Decimal
-from easy_pdf.rendering import render_to_pdf_response
-from django.shortcuts import render  # , get_object_or_404
-from django.http import JsonResponse, HttpResponseRedirect, HttpResponse
+import time
+from django.conf import settings
+from django.shortcuts import render, get_object_or_404
+from django.http import (JsonResponse, HttpResponseRedirect, HttpResponse,
+                         StreamingHttpResponse, Http404)
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse
+from django.utils.decorators import method_decorator
 from django.views import generic
 from django.views.decorators.csrf import csrf_protect
-from django.db import transaction
-from django.db.models import Q
+from django.db import IntegrityError, transaction
 
-from django.contrib.auth.models import User
 from models import Item, Category, BillItem, Bill
 from . import dbmanager as dbmng
+from . import catalog
+from . import export as exp
+from . import fulltext
+from . import ledger
+from . import tickets
+from .routers import reporting
 from forms import ReportForm, SearchForm
 
 from django.template import RequestContext
@@ -21,6 +28,12 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+SEARCH_PAGE_SIZE = 50
+BILL_LIST_MAX_SIZE = 200
+# The bills committed by a sync in a single transaction, which holds the
+# database: the tills send their queue in chunks of this size
+SYNC_MAX_BILLS = 50
+
 
 def index(request):
     """Testing view. If the request has an authenticated user token, the view
@@ -31,11 +44,12 @@ def index(request):
         logger.info(
                 "User " + request.user.get_username() + " authenticated fine"
                 )
-        enabled_categories = Category.objects.filter(enabled=True)
-        display_items = Item.objects.filter(enabled=True, category__in=enabled_categories)
-        server = User.objects.get(pk=request.user.id)
+        quantities = ledger.quantities(
+            dict(Item.objects.values_list('id', 'quantity')))
+        display_items = [(item, quantities.get(item.id))
+                         for item in catalog.snapshot()['enabled_items']]
         return render(request, 'webpos/index.html', {'items': display_items,
-                                                     'server': server
+                                                     'server': request.user
                                                      })
     else:
         logger.info("Anonymous user, redirecting")
@@ -44,45 +58,117 @@ def index(request):
 
 def order(request):
     if request.user.is_authenticated():
-        categories = Category.objects.filter(enabled=True).order_by('priority')
-        items = Item.objects.filter(enabled=True, extra=False, category__in=categories).order_by('category',
-                                                                        'priority',
-                                                                        'name')
-        for item in items:
-            item.extras = item.category.item_set.filter(extra=True)
-
-        extras = Item.objects.filter(extra=True)
-
-        return render(request, 'webpos/order.html', {'categories': categories,
-                                                     'items': items,
-                                                     'extras': extras
-                                                     })
+        context = dict(catalog.snapshot(), stock_events=_stock_events())
+        return render(request, 'webpos/order.html', context)
     else:
         return HttpResponseRedirect(reverse('login'))
 
 ### AJAX REFRESH
 
+# INPUT POST
+# version=<last version received> (optional)
+
 # OUTPUT JSON
-# {"item1": (quantity, price), ...}
+# {"item1": (quantity, price), ...}  when no version is sent, otherwise
+# the stock updates described by catalog.updates, or an empty 304 response if
+# nothing changed since the version sent.
 
 
 @csrf_protect
 def refresh_buttons(request):
     """
-    Tentative view that should be polled by the client in order to refresh
-    quantities and prices of the displayed buttons first created by index view
+    View polled by the client in order to refresh quantities and prices of the
+    displayed buttons first created by the order view.
+
+    Clients sending the last version they received only get the items changed
+    since then, and unchanged polls are answered without hitting the database,
+    when settings.SHARED_CACHE is set.
     """
 
     if request.method == 'POST':  # and request.is_ajax():
-        enabled_categories = Category.objects.filter(enabled=True)
-        items = dict([(item.name, (item.quantity, item.price))
-                      for item in Item.objects.filter(enabled=True, category__in=enabled_categories)])
-        return JsonResponse(items)
-
+        if 'version' not in request.POST:
+            enabled_categories = Category.objects.filter(enabled=True)
+            items = list(Item.objects.filter(enabled=True, category__in=enabled_categories))
+            quantities = ledger.quantities({item.id: item.quantity
+                                            for item in items})
+            items = dict([(item.name, (quantities[item.id], item.price))
+                          for item in items])
+            return JsonResponse(items)
+        try:
+            since = int(request.POST['version'])
+        except ValueError:
+            since = None
+        output = catalog.updates(since)
+        if output is None:
+            return HttpResponse(status=304)
+        return JsonResponse(output)
+
+
+# Server-sent events stream of the stock updates, alternative to the polling
+# of refresh_buttons. Every event carries the JSON of catalog.updates and has
+# the stock version as id, so that reconnecting clients resume from there.
+
+# Seconds between two checks of the stock version, and between keepalives
+STOCK_EVENTS_INTERVAL = 0.2
+STOCK_EVENTS_KEEPALIVE = 15
+# Seconds after which the stream is closed and the client has to reconnect, so
+# that a WSGI worker isn't held forever
+STOCK_EVENTS_DURATION = 60
+
+
+def stock_events(request):
+    """Streams the stock updates to the tills as soon as commits, undos or
+    admin edits change the items. The version to start from can be passed as
+    the "version" GET parameter, or as the Last-Event-ID header set by the
+    browsers when reconnecting. Unless settings.STOCK_EVENTS is set the tills
+    are told to poll instead, and without a shared cache as well, as the stock
+    versions of this process don't see the changes made by the others."""
+    if not _stock_events():
+        raise Http404
+    since = request.META.get('HTTP_LAST_EVENT_ID',
+                             request.GET.get('version', ''))
+    try:
+        since = int(since)
+    except ValueError:
+        since = None
+    response = StreamingHttpResponse(_stock_event_stream(since),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep proxies like nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _stock_events():
+    return settings.STOCK_EVENTS and settings.SHARED_CACHE
+
+
+def _stock_event_stream(since):
+    yield 'retry: 1000\n\n'
+    started = keepalive = time.time()
+    while time.time() - started < STOCK_EVENTS_DURATION:
+        output = catalog.updates(since)
+        if output is not None:
+            since = output['version']
+            keepalive = time.time()
+            yield 'id: {}\ndata: {}\n\n'.format(
+                since, json.dumps(output, cls=DjangoJSONEncoder))
+        elif time.time() - keepalive > STOCK_EVENTS_KEEPALIVE:
+            keepalive = time.time()
+            yield ':\n\n'
+        else:
+            time.sleep(STOCK_EVENTS_INTERVAL)
 
 
 ### BILL MANAGMENT ################
 
+def _log_bad_request(error_msg, request):
+    """Logs a malformed request by its size and user: its body can be large
+    and holds the names of the customers."""
+    logger.error('{} - Request of {} bytes by {}'.format(
+        error_msg, len(request.body), request.user.get_username()))
+
+
 # INPUT JSON
 # { "customer_name": customer_name,
 #   "items": {"item1": quantity,
@@ -97,13 +183,13 @@ def refresh_buttons(request):
 #   "total": total
 # }
 
-@transaction.atomic  # (using select_for_update() in dbmanager)
 @csrf_protect  # Daro: sarebbe figo integrare CSRF token in questa POST request
 def bill_handler(request):
     """Called in order to commit a bill. The POST request must pass a json
     object structured as:
 
          { "customer_name": "tizio",
+           "idempotency_key": "f81d4fae-7dec-11d0-a765-00a0c91e6bf6",
            "items": [
                 {"name": "item1",
                  "qty": 2,
@@ -135,6 +221,9 @@ def bill_handler(request):
     are no longer available as keys, and the actual database quantity of such
     item as value. If such dictionary is not empty the bill cannot be committed
     and it should be modified and reposted.
+    The optional "idempotency_key", generated by the till for each bill and
+    sent again with its retries, makes the bill committed at most once: a
+    retry of a committed bill gets the same answer as the first request.
     """
     if request.method == 'POST':  # and request.is_ajax():
         output = {'errors': [],
@@ -145,14 +234,30 @@ def bill_handler(request):
                   'pdf_url': ''
                   }
         reqdata = json.loads(request.body)
-        try:
-            repdata, bill = dbmng.commit_bill(output, reqdata, request.user)
-        except dbmng.FormatError as e:
-            error_msg = 'Wrong request JSON formatting: {}'.format(e)
-            logger.error('{} - Request BODY: {}'.format(
-                error_msg,
-                request.body))
-            return HttpResponse(error_msg)
+        key = reqdata.get('idempotency_key')
+        # Looked up before the commit's transaction, which must write first
+        bill = dbmng.committed_bill(key)
+        if bill is None:
+            ledger.prefetch()
+            try:
+                with transaction.atomic():
+                    repdata, bill = dbmng.commit_bill(output, reqdata,
+                                                      request.user)
+                    if bill is not None:
+                        transaction.on_commit(
+                            lambda: tickets.queue_ticket(bill.id))
+            except dbmng.FormatError as e:
+                error_msg = 'Wrong request JSON formatting: {}'.format(e)
+                _log_bad_request(error_msg, request)
+                return HttpResponse(error_msg)
+            except IntegrityError:
+                # A retry of the same bill committed it in the meantime
+                bill = dbmng.committed_bill(key)
+                if bill is None:
+                    raise
+                repdata = dbmng.bill_output(output, bill)
+        else:
+            repdata = dbmng.bill_output(output, bill)
         if not repdata['errors']:
             repdata['pdf_url'] = reverse('webpos:pdf-bill', args=[bill.id])
         return JsonResponse(repdata)
@@ -160,24 +265,56 @@ def bill_handler(request):
         return HttpResponse(status=400)
 
 
+@csrf_protect
+def sync_bills(request):
+    """Called by a till back online to commit the bills it queued while
+    offline. The POST request must pass a json object structured as:
+
+         { "bills": [bill, ...] }
+
+    where every bill is structured as for bill_handler, with its
+    "idempotency_key". At most SYNC_MAX_BILLS bills can be sent, which are
+    committed in a single transaction, and the json object returned has a result for each of them, in order:
+
+         { "results": [result, ...] }
+
+    Each result is the answer of bill_handler for the bill, with its
+    "idempotency_key". It has an "error" instead for the malformed bills and
+    "duplicate" for the ones committed by an earlier request, which the till
+    can drop from its queue as the committed ones.
+    """
+    if request.method != 'POST':
+        return HttpResponse(status=400)
+    try:
+        reqdata = json.loads(request.body)
+        bills = reqdata['bills']
+        if not isinstance(bills, list):
+            raise TypeError('"bills" is not a list')
+        if len(bills) > SYNC_MAX_BILLS:
+            raise ValueError('More than {} bills'.format(SYNC_MAX_BILLS))
+    except (ValueError, KeyError, TypeError) as e:
+        error_msg = 'Wrong request JSON formatting: {}'.format(e)
+        _log_bad_request(error_msg, request)
+        return HttpResponse(error_msg, status=400)
+    results = []
+    # Not in a transaction of the view: commit_bills() looks the keys up
+    # before its own, and has committed it when it returns
+    for output, bill in dbmng.commit_bills(bills, request.user):
+        output['pdf_url'] = ''
+        if bill is not None:
+            output['pdf_url'] = reverse('webpos:pdf-bill', args=[bill.id])
+            if not output.get('duplicate'):
+                tickets.queue_ticket(bill.id)
+        results.append(output)
+    return JsonResponse({'results': results})
+
+
 def pdf_view(request, bill_id):
-    bill = Bill.objects.get(pk=bill_id)
-    items = bill.billitem_set.all()
-    categories = Category.objects.all()
-    billitems = {}
-    headeritems = {}
-    for cat in categories:
-        itemlist = [
-                (i, i.billitemextra_set.all()) for i in items.filter(
-                    category=cat)]
-        if itemlist:
-            if cat.printable:
-                billitems[cat] = itemlist
-            headeritems[cat] = itemlist
-    context = {'bill': bill,
-               'billitems': billitems,
-               'headeritems': headeritems}
-    return render_to_pdf_response(request, 'webpos/comanda.html', context)
+    """Serves the PDF ticket of a bill, rendered in background when the bill
+    was committed."""
+    get_object_or_404(Bill, pk=bill_id)
+    return HttpResponse(tickets.get_ticket(bill_id),
+                        content_type='application/pdf')
 
 
 @transaction.atomic
@@ -191,10 +328,11 @@ def undo_bill(request):
         return JsonResponse(context)
     else:
         error_msg = 'ERROR: billid not int request.POST'
-        logger.error('{} - Request BODY: {}'.format(error_msg, request.body))
+        _log_bad_request(error_msg, request)
         return HttpResponse(error_msg)
 
 
+@reporting
 def report(request, *args):
     """View that renders a report page to fetch all items sold under three
     constraints which are: Category, Begin Date/Time and End Date/Time."""
@@ -217,37 +355,8 @@ def report(request, *args):
                               {'form': form,
                                # 'report': None,
                                'qs_empty': True})
-            report_dict = {}
-            for category in Category.objects.all():
-                report_dict[category] = {'itemss': {},
-                                         'items_sold': 0,
-                                         'total_price': Decimal(0.00)
-                                         }
-                for item in category.item_set.all():
-                    clear = {'quantity': 0, 'price': Decimal(0.00)}
-                    report_dict[category]['itemss'][item] = clear
-            total_earn = Decimal(0)
-            total_cash = Decimal(0)
-            for bill in qs:
-                total_cash += bill.total
-                for billitem in bill.billitem_set.all():
-                    quantity = billitem.quantity
-                    price = billitem.item_price * billitem.quantity
-                    entry_category = report_dict[billitem.category]
-                    entry_category['items_sold'] += quantity
-                    entry_category['total_price'] += abs(price)
-                    entry_item = entry_category['itemss'][billitem.item]
-                    entry_item['quantity'] += quantity
-                    entry_item['price'] += abs(price)
-                    if price > 0:
-                        total_earn += price
-                    for extra in billitem.billitemextra_set.all():
-                        entry_category['items_sold'] += extra.quantity * billitem.quantity
-                        entry_category['total_price'] += extra.total_cost
-                        entry_item = entry_category['itemss'][extra.item]
-                        entry_item['quantity'] += extra.quantity * billitem.quantity
-                        entry_item['price'] += extra.total_cost
-                        total_earn += extra.total_cost
+            report_dict, total_earn, total_cash = dbmng.sales_report(
+                date_start, date_end, [s.username for s in sel_server])
             return render(request, 'webpos/report.html',
                           {'form': form,
                            'report': report_dict,
@@ -268,12 +377,60 @@ def report(request, *args):
                        })
 
 
+EXPORTS = {'bills': (exp.BILL_COLUMNS, exp.bill_rows),
+           'lines': (exp.LINE_COLUMNS, exp.line_rows)}
+
+
+@reporting
+def export(request, kind, fmt):
+    """View that streams the bills, or their lines, selected by the filters of
+    the report page as a CSV or JSON file."""
+    form = ReportForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    categories = list(form.cleaned_data['sel_category'])
+    bills = exp.filtered_bills(
+        form.cleaned_data['date_start'], form.cleaned_data['date_end'],
+        [s.username for s in form.cleaned_data['sel_server']], categories)
+    columns, rows = EXPORTS[kind]
+    rows = rows(bills, categories) if kind == 'lines' else rows(bills)
+    if fmt == 'csv':
+        response = StreamingHttpResponse(
+            _reporting_stream(exp.csv_stream(columns, rows)),
+            content_type='text/csv; charset=utf-8')
+    else:
+        response = StreamingHttpResponse(
+            _reporting_stream(exp.json_stream(columns, rows)),
+            content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+        kind, fmt)
+    return response
+
+
+def _reporting_stream(chunks):
+    """Iterates ``chunks`` reading from the reporting database, as @reporting
+    does for the view, since the response is iterated after it returned."""
+    chunks = iter(chunks)
+    while True:
+        with reporting:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+        yield chunk
+
+
 class BillDetailView(generic.DetailView):
     """Generic detail view to serve the bill_detail.html template"""
     model = Bill
     template_name = 'webpos/bill_detail.html'
 
+    @method_decorator(reporting)
+    def dispatch(self, *args, **kwargs):
+        return super(BillDetailView, self).dispatch(*args, **kwargs)
+
 
+@reporting
 def search(request, *args):
     """View that renders a simple search page that allow the user to find bills
     by customer name, server username or bill ID."""
@@ -284,21 +441,29 @@ def search(request, *args):
             qs = Bill.objects.all().filter(deleted_by='')
             search_text = form.cleaned_data['search']
             if re.match(r'\w+', search_text):
-                qserver = Q(server__icontains=search_text)
-                qcustomer = Q(customer_name__icontains=search_text)
-
-                qs = qs.filter(qserver | qcustomer)
+                qs = fulltext.search_bills(search_text)
 
             elif re.match(r'\#([0-9]+)', search_text):
                 number = re.match(r'\#([0-9]+)', search_text).group(1)
                 qs = qs.filter(pk=int(number))
 
-            if not qs.exists():
+            after = request.GET.get('after')
+            try:
+                bills, next_cursor = dbmng.bills_page(qs, after,
+                                                      SEARCH_PAGE_SIZE)
+            except dbmng.FormatError:
+                after = None
+                bills, next_cursor = dbmng.bills_page(qs, None,
+                                                      SEARCH_PAGE_SIZE)
+            if not bills and not after:
                 qs_empty = True
             return render(request, 'webpos/search.html',
                           {'form': form,
                            'qs_empty': qs_empty,
-                           'queryset': qs
+                           'queryset': bills,
+                           'search_text': search_text,
+                           'after': after,
+                           'next_cursor': next_cursor
                            })
         else:
             return render(request, 'webpos/search.html',
@@ -311,3 +476,31 @@ def search(request, *args):
                       {'form': form,
                        'qs_empty': qs_empty
                        })
+
+
+@reporting
+def bill_list(request):
+    """JSON view listing the bills, newest first, a page at a time. The bills
+    can be restricted by ``search``, as the search page, and by ``server``;
+    ``after`` is the cursor returned as ``next`` by the previous page."""
+    if request.GET.get('search'):
+        qs = fulltext.search_bills(request.GET['search'])
+    else:
+        qs = Bill.objects.filter(deleted_by='')
+    if request.GET.get('server'):
+        qs = qs.filter(server=request.GET['server'])
+    try:
+        size = min(int(request.GET.get('size', SEARCH_PAGE_SIZE)),
+                   BILL_LIST_MAX_SIZE)
+        bills, next_cursor = dbmng.bills_page(qs, request.GET.get('after'),
+                                              max(size, 1))
+    except (ValueError, dbmng.FormatError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(
+        {'bills': [{'id': bill.id,
+                    'customer_id': bill.customer_id,
+                    'customer_name': bill.customer_name,
+                    'date': bill.date,
+                    'server': bill.server,
+                    'total': bill.total} for bill in bills],
+         'next': next_cursor})
@@ -1,14 +1,19 @@
 """
 Custom logging handlers based on logging module.
 """
+import atexit
 import logging
 import logging.handlers
 import os
 import errno
+import threading
+import Queue
 
 
-def mk_log_folder_handler(folder, filename, logging_class, **kwargs):
-    """Creates a folder for a logfile if it doesn't exists"""
+def mk_log_folder_handler(folder, filename, logging_class, queued=False,
+                          **kwargs):
+    """Creates a folder for a logfile if it doesn't exists. With ``queued``
+    the handler writes from a thread of its own, behind a QueueHandler."""
     try:
         os.makedirs(folder)
     except OSError as e:
@@ -20,4 +25,94 @@ def mk_log_folder_handler(folder, filename, logging_class, **kwargs):
         handler = eval(logging_class)
     else:
         raise ValueError('Invalid logging handler')
+    if queued:
+        return QueueHandler(handler(filename, **kwargs))
     return handler(filename, **kwargs)
+
+
+class QueueHandler(logging.Handler):
+    """Queues the records for a QueueListener, which emits them with
+    ``handler``: logging costs the caller a put on a queue, and never waits
+    for the disk or for a rotation. As logging.handlers.QueueHandler of
+    Python 3, but the records are formatted by the thread of the listener,
+    with the formatter set on this handler, and a forked process starts a
+    listener of its own."""
+    def __init__(self, handler):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.listener = None
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        """Returns a copy of ``record`` which the listener can format later:
+        its message merged with its arguments, and its traceback as text."""
+        prepared = logging.LogRecord.__new__(logging.LogRecord)
+        prepared.__dict__.update(record.__dict__)
+        record = prepared
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            formatter = self.formatter or logging._defaultFormatter
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self.listener is None or self.listener.pid != os.getpid():
+                self.listener = QueueListener(self.handler)
+            self.listener.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Waits for the records queued to be written."""
+        if self.listener is not None and self.listener.pid == os.getpid():
+            self.listener.queue.join()
+        self.handler.flush()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+class QueueListener(object):
+    """A queue of records, and the thread emitting them with ``handler``."""
+    def __init__(self, handler):
+        self.pid = os.getpid()
+        self.handler = handler
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='Logging')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Writes the records queued and stops the thread."""
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            # What was queued meanwhile, without waiting again
+            try:
+                while records[-1] is not None:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                for record in records:
+                    if record is not None:
+                        self.handler.handle(record)
+            finally:
+                for _ in records:
+                    self.queue.task_done()
+            if records[-1] is None:
+                break
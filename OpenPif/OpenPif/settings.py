@@ -81,9 +81,63 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # A file, so that the stock is tested with concurrent connections
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
     }
 }
 
+# The report, search and bill pages read from REPORTING_DATABASE, when set (see
+# OpenGenfri.routers). With SQLite it can be a copy of db.sqlite3 refreshed by
+# "manage.py snapshot_reporting --interval 60", added to DATABASES as:
+#     'reporting': {'ENGINE': 'django.db.backends.sqlite3',
+#                   'NAME': os.path.join(BASE_DIR, 'reporting.sqlite3')}
+
+DATABASE_ROUTERS = ['OpenGenfri.routers.ReportingRouter']
+REPORTING_DATABASE = None
+
+# Set in this order on every SQLite connection: WAL lets the reports read
+# while the tills write, a committing till waits up to busy_timeout ms for
+# another one, synchronous = NORMAL only syncs the WAL at checkpoints and the
+# database is read through mmap_size bytes of memory mapped I/O.
+# With WAL, recent commits can still be in db.sqlite3-wal: back the database up
+# with sqlite3's .backup rather than copying db.sqlite3 alone.
+
+SQLITE_PRAGMAS = [
+    ('busy_timeout', 5000),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 64 * 1024 * 1024),
+]
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# The stock versions polled by the tills are kept in the default cache, which
+# must be shared by all the processes (e.g. memcached) if more than one runs.
+# Set SHARED_CACHE once it is, or when a single process runs: the tills then
+# get only the items changed since the last version they saw, or nothing.
+# Otherwise every process has versions of its own, and they get all the items.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # The counters of the stock ledger, which must never be evicted
+    'stock': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'stock',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+SHARED_CACHE = False
+
+# Push the stock updates to the tills over server-sent events, rather than
+# having them poll: every till holds a connection, and a worker of a WSGI
+# server with sync workers, so only for servers with threaded or async ones.
+# Needs SHARED_CACHE.
+
+STOCK_EVENTS = False
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -125,6 +179,29 @@ STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR + '/static/'
 
 
+# PDF tickets, rendered by the requests, or by TICKET_WORKERS processes forked
+# from the server (see OpenGenfri.tickets)
+
+TICKETS_DIR = os.path.join(BASE_DIR, 'tickets')
+TICKET_WORKERS = 0
+
+# Thermal printers of the ESC/POS tickets by category name, '*' for the others,
+# as device files or 'tcp://host:port' (see OpenGenfri.escpos)
+
+TICKET_PRINTERS = {}
+
+
+# Stock of the items kept by counters in the STOCK_LEDGER_CACHE cache, and
+# written to the database every STOCK_LEDGER_FLUSH_INTERVAL seconds (see
+# OpenGenfri.ledger). After a crash run "manage.py recover_stock" before
+# starting the server.
+
+STOCK_LEDGER = False
+STOCK_LEDGER_CACHE = 'stock'
+STOCK_LEDGER_JOURNAL = os.path.join(BASE_DIR, 'stock.journal')
+STOCK_LEDGER_FLUSH_INTERVAL = 1.0
+
+
 # Login
 
 LOGIN_URL = '/login/'
@@ -132,6 +209,8 @@ LOGIN_REDIRECT_URL = '/'
 
 
 # Logging
+# The log files are written by a thread of each handler (see
+# log_handlers.QueueHandler), and rotated every 10 MB.
 
 BASE_LOGDIR = os.path.join(BASE_DIR, 'logs')
 LOGGING = {
@@ -168,7 +247,8 @@ LOGGING = {
                 'folder': BASE_LOGDIR,
                 'filename': os.path.join(BASE_LOGDIR, 'devel.log'),
                 'logging_class': 'logging.handlers.RotatingFileHandler',
-                'maxBytes': 1024,
+                'queued': True,
+                'maxBytes': 10 * 1024 * 1024,
                 'backupCount': 10,
                 },
             'file_prod': {
@@ -179,7 +259,8 @@ LOGGING = {
                 'folder': BASE_LOGDIR,
                 'filename': os.path.join(BASE_LOGDIR, 'production.log'),
                 'logging_class': 'logging.handlers.RotatingFileHandler',
-                'maxBytes': 1024,
+                'queued': True,
+                'maxBytes': 10 * 1024 * 1024,
                 'backupCount': 10,
                 },
             'db': {
@@ -188,7 +269,8 @@ LOGGING = {
                 'folder': BASE_LOGDIR,
                 'filename': os.path.join(BASE_LOGDIR, 'database.log'),
                 'logging_class': 'logging.handlers.RotatingFileHandler',
-                'maxBytes': 1024,
+                'queued': True,
+                'maxBytes': 10 * 1024 * 1024,
                 'backupCount': 10,
                },
             'mail_admins': {
@@ -216,3 +298,15 @@ LOGGING = {
                 },
             },
         }
+
+
+# Journal of the bills committed and deleted and of the stock edits, replayed
+# by "manage.py replay_journal" (see OpenGenfri.journal), e.g.
+# os.path.join(BASE_LOGDIR, 'transactions.jsonl'), or None. Its writes are
+# synced to disk with TRANSACTION_JOURNAL_SYNC.
+
+TRANSACTION_JOURNAL = None
+TRANSACTION_JOURNAL_SYNC = True
+
+# Disables the journal for "manage.py test", when it is enabled
+TEST_RUNNER = 'OpenPif.test_runner.TestRunner'
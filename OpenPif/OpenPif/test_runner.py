@@ -0,0 +1,20 @@
+"""
+Test runner keeping the tests off the journal of the server.
+"""
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """Runs the tests with the transaction journal disabled, so that the
+    bills they commit never reach settings.TRANSACTION_JOURNAL, which
+    "manage.py replay_journal" would insert in the database. The tests of
+    the journal enable it on a temporary file."""
+    def setup_test_environment(self, **kwargs):
+        super(TestRunner, self).setup_test_environment(**kwargs)
+        self._journal = settings.TRANSACTION_JOURNAL
+        settings.TRANSACTION_JOURNAL = None
+
+    def teardown_test_environment(self, **kwargs):
+        settings.TRANSACTION_JOURNAL = self._journal
+        super(TestRunner, self).teardown_test_environment(**kwargs)